@@ -0,0 +1,133 @@
+""" BENCHMARK: COMPARABLE SALES LOOKUP
+Compares ComparablesIndex.query with a brute-force search (the distance from
+every location to every comparable listing, then a sort) on 500k synthetic
+listings, for 1 and 200 locations, masks of comparable listings from all of
+them down to a few, and with and without a distance limit.
+
+The positions and distances found must be the same. The coordinates are
+random, so no two listings are at exactly the same distance from a location
+and the order of the comparables is unambiguous. The brute force is timed
+once, the index query is timed as the best of N_REPEATS.
+
+Then ComparablesIndex.query_others is checked on listings of properties sold
+several times at the same coordinates, from locations that are such listings:
+no sale of the property of a location may be among its comparables, and the
+distances must be those of the brute force without them. Sales of a property
+are at the same distance, so the positions are checked by their distances.
+
+Run from the repository root:
+    python benchmarks/benchmark_comparables.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "dash_application"))
+from comparables import ComparablesIndex, to_metres
+
+# ----------------------- CONFIG -----------------------
+N_ROWS = 500_000
+N_LOCATIONS = [1, 200]
+K = 10
+MASK_DENSITIES = [1.0, 0.1, 0.01, 0.001, 0.0005]
+MAX_DISTANCES = [np.inf, 500.0] # Metres
+N_REPEATS = 3
+N_PROPERTIES = 100_000 # Of the listings of query_others, sold 1 to 5 times each
+SEED = 0
+# ------------------------------------------------------
+
+def brute_force(index, lon, lat, k, mask, max_distance, ids=None, location_ids=None):
+    """ Same as ComparablesIndex.query, or query_others, by the distances to all comparable listings. """
+    points = to_metres(lon, lat, index.origin_lat)
+    positions = np.full((len(points), k), -1, dtype=np.int64)
+    distances = np.full((len(points), k), np.inf)
+    for i, point in enumerate(points):
+        comparable = mask[index.positions]
+        if ids is not None:
+            comparable &= ids[index.positions] != location_ids[i]
+        candidates = np.flatnonzero(comparable)
+        d = np.hypot(*(index.points[candidates] - point).T)
+        nearest = np.argsort(d, kind="stable")[:k]
+        nearest = nearest[d[nearest] <= max_distance]
+        positions[i, :len(nearest)] = index.positions[candidates[nearest]]
+        distances[i, :len(nearest)] = d[nearest]
+    return positions, distances
+
+def best_time(f, n_repeats=N_REPEATS):
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000, result
+
+rng = np.random.default_rng(SEED)
+lon = rng.uniform(17.85, 18.15, N_ROWS)
+lat = rng.uniform(59.25, 59.42, N_ROWS)
+lon[rng.random(N_ROWS) < 0.01] = np.nan # Some listings have no coordinates
+
+start = time.perf_counter()
+index = ComparablesIndex(lon, lat)
+print(f"{N_ROWS:,} listings, index built in {(time.perf_counter() - start) * 1000:.0f} ms " +
+      f"using {index.nbytes():,} bytes")
+print(f"{'locations':>10}{'density':>10}{'max distance':>14}{'found':>10}{'query (ms)':>12}{'brute (ms)':>12}")
+
+for n_locations in N_LOCATIONS:
+    query_lon = rng.uniform(17.9, 18.1, n_locations)
+    query_lat = rng.uniform(59.28, 59.4, n_locations)
+    for density in MASK_DENSITIES:
+        mask = rng.random(N_ROWS) < density
+        for max_distance in MAX_DISTANCES:
+            query_ms, (positions, distances) = best_time(
+                lambda: index.query(query_lon, query_lat, K, mask, max_distance)
+            )
+            brute_ms, (expected_positions, expected_distances) = best_time(
+                lambda: brute_force(index, query_lon, query_lat, K, mask, max_distance), n_repeats=1
+            )
+
+            assert (positions == expected_positions).all(), "Comparables differ"
+            assert np.allclose(distances, expected_distances, rtol=0, atol=1e-6), "Distances differ"
+            found = positions >= 0
+            assert mask[positions[found]].all(), "Not comparable"
+
+            print(f"{n_locations:>10}{density:>10.2%}{max_distance:>14}{found.sum():>10}" +
+                  f"{query_ms:>12.1f}{brute_ms:>12.1f}")
+
+# Listings of properties sold several times, from locations that are listings
+n_sales = rng.integers(1, 6, N_PROPERTIES)
+ids = np.repeat(np.arange(N_PROPERTIES), n_sales)
+lon = rng.uniform(17.85, 18.15, N_PROPERTIES)[ids]
+lat = rng.uniform(59.25, 59.42, N_PROPERTIES)[ids]
+index = ComparablesIndex(lon, lat)
+print(f"\n{len(ids):,} sales of {N_PROPERTIES:,} properties, from locations of their listings")
+print(f"{'locations':>10}{'density':>10}{'max distance':>14}{'found':>10}{'query (ms)':>12}{'brute (ms)':>12}")
+
+for n_locations in N_LOCATIONS:
+    locations = rng.integers(0, len(ids), n_locations)
+    for density in MASK_DENSITIES:
+        mask = rng.random(len(ids)) < density
+        mask[locations] = True # The sale clicked is comparable, as when it was sold recently
+        for max_distance in MAX_DISTANCES:
+            query_ms, (positions, distances) = best_time(lambda: index.query_others(
+                lon[locations], lat[locations], K, ids, ids[locations], mask, max_distance
+            ))
+            brute_ms, (_, expected_distances) = best_time(lambda: brute_force(
+                index, lon[locations], lat[locations], K, mask, max_distance, ids, ids[locations]
+            ), n_repeats=1)
+
+            found = positions >= 0
+            assert (found == np.isfinite(expected_distances)).all(), "Numbers of comparables differ"
+            assert np.allclose(distances, expected_distances, rtol=0, atol=1e-6), "Distances differ"
+            assert mask[positions[found]].all(), "Not comparable"
+            assert (ids[np.maximum(positions, 0)] != ids[locations][:, None])[found].all(), "Own sale"
+            actual = np.hypot(*(
+                to_metres(lon[positions[found]], lat[positions[found]], index.origin_lat) -
+                to_metres(lon[locations], lat[locations], index.origin_lat)[np.nonzero(found)[0]]
+            ).T)
+            assert np.allclose(actual, distances[found], rtol=0, atol=1e-6), "Positions are not at their distances"
+
+            print(f"{n_locations:>10}{density:>10.2%}{max_distance:>14}{found.sum():>10}" +
+                  f"{query_ms:>12.1f}{brute_ms:>12.1f}")
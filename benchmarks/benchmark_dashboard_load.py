@@ -0,0 +1,401 @@
+""" BENCHMARK: DASHBOARD LOAD TEST
+Starts the dashboard on a synthetic dataset and drives its map callback
+(/_dash-update-component) with concurrent simulated users, reporting the
+latency percentiles, throughput and memory of the server per number of users.
+
+Every simulated user loads the page, then follows a trace of random changes
+of the date range, the room slider, the data selection and the plot type,
+with a pause between them, as a user exploring the map would. Like a
+browser, it also fetches the polygons and map tiles that the figure built from
+the map data shows. Changing the data selection only changes the figure in
+the browser, so it does not call the map callback.
+
+The synthetic listings are written as a dashboard snapshot, together with
+the polygons in data/area_polygons, to a temporary data directory, and the
+server is started on it with the (dashboard) data_dir module replaced. The
+server is the threaded Flask server, or gunicorn with SERVER_WORKERS workers.
+
+Run from the repository root:
+    python benchmarks/benchmark_dashboard_load.py
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import pandas as pd
+import psutil
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "data_scraping_pipeline"))
+from spatial_join import PolygonLayer
+
+# ----------------------- CONFIG -----------------------
+AREA_POLYGONS_DIR = os.path.join(REPO_DIR, "data", "area_polygons")
+N_LISTINGS = 500_000
+SOLD_DATE_RANGE = ("2014-01-01", "2021-09-01")
+
+N_USERS = [1, 4, 16] # Each number of concurrent users is run in turn, on the same server
+ACTIONS_PER_USER = 30
+THINK_TIME = (0.0, 0.5) # Seconds between the actions of a user, uniformly random
+TILES_PER_MAP = 6 # Tiles fetched when a figure shows map tiles
+TILE_ZOOM = 12 # Zoom of the map when it shows tiles, see dash_application/assets/map_figure.js
+
+SERVER_WORKERS = 0 # 0 runs the threaded Flask server, more runs gunicorn with this many workers
+PORT = 8077
+STARTUP_TIMEOUT = 600 # Seconds
+REQUEST_TIMEOUT = 120 # Seconds
+SEED = 0
+# ------------------------------------------------------
+
+def synthetic_listings(n_listings, polygon_layer, rng):
+    """ Listings at random locations within the polygons, with plausible values. """
+    min_long, min_lat = polygon_layer.bounds[:, :2].min(axis=0)
+    max_long, max_lat = polygon_layer.bounds[:, 2:].max(axis=0)
+
+    # Only points within some polygon, as most listings are
+    latitudes, longitudes, codes = [], [], []
+    n = 0
+    while n < n_listings:
+        lat = rng.uniform(min_lat, max_lat, n_listings)
+        long = rng.uniform(min_long, max_long, n_listings)
+        c = polygon_layer.assign(lat, long)
+        inside = c >= 0
+        latitudes.append(lat[inside])
+        longitudes.append(long[inside])
+        codes.append(c[inside])
+        n += inside.sum()
+    latitudes = np.concatenate(latitudes)[:n_listings]
+    longitudes = np.concatenate(longitudes)[:n_listings]
+    polygon_ids, polygon_names = polygon_layer.to_columns(np.concatenate(codes)[:n_listings])
+
+    first_day, stop_day = np.array(SOLD_DATE_RANGE, dtype="datetime64[D]")
+    sold_dates = first_day + np.sort(rng.integers(0, (stop_day - first_day).astype(int), n_listings))
+    sqm = np.round(rng.uniform(18, 140, n_listings))
+    rooms = np.clip(np.round(sqm / 25 * 2) / 2, 1, 6)
+    price_per_sqm = np.round(rng.normal(80_000, 20_000, n_listings).clip(20_000, 200_000))
+    rent = np.round(sqm * rng.uniform(40, 90, n_listings))
+    agencies = np.array([f"Mäklarbyrå {i}" for i in range(40)], dtype=object)
+
+    return pd.DataFrame({
+        "property_id": np.arange(n_listings, dtype=np.uint32),
+        "address": pd.Categorical([f"Gatan {i % 5000}" for i in range(n_listings)]),
+        "latitude": latitudes,
+        "longitude": longitudes,
+        "construction_year": rng.integers(1880, 2022, n_listings).astype(np.float32),
+        "energy_class": pd.Categorical(rng.choice(list("ABCDEFG"), n_listings)),
+        "brf_name": pd.Categorical([f"BRF {i % 3000}" for i in range(n_listings)]),
+        "rent": rent.astype(np.float32),
+        "rooms": rooms.astype(np.float32),
+        "sqm": sqm.astype(np.float32),
+        "primary_area": pd.Categorical(polygon_names),
+        "listing_agency_name": pd.Categorical(agencies[rng.integers(0, len(agencies), n_listings)]),
+        "listing_sold_date": sold_dates.astype("datetime64[ns]"),
+        "listing_sold_price": (price_per_sqm * sqm).astype(np.float32),
+        "listing_sold_price_per_sqm": price_per_sqm.astype(np.float32),
+        "listing_rent_per_sqm": np.round(rent / sqm).astype(np.float32),
+        "polygon_id": pd.Categorical(polygon_ids),
+        "polygon_name": pd.Categorical(polygon_names),
+    })
+
+def write_snapshot(df, snapshot_dir):
+    """ Writes df as the only version of a snapshot, in the format of 8_build_dashboard_snapshot.py. """
+    version = "synthetic"
+    version_dir = os.path.join(snapshot_dir, version)
+    os.makedirs(version_dir)
+
+    columns = {}
+    blocks = {}
+    for name, col in df.items():
+        if pd.api.types.is_datetime64_dtype(col):
+            np.save(os.path.join(version_dir, f"{name}.npy"), col.values)
+            columns[name] = {"kind": "datetime"}
+        elif pd.api.types.is_numeric_dtype(col):
+            blocks.setdefault(str(col.dtype), []).append(name)
+            columns[name] = {"kind": "numeric", "block": str(col.dtype), "index": len(blocks[str(col.dtype)]) - 1}
+        else:
+            np.save(os.path.join(version_dir, f"{name}.codes.npy"), col.cat.codes.values)
+            with open(os.path.join(version_dir, f"{name}.categories.json"), "w", encoding="utf8") as f:
+                json.dump(col.cat.categories.tolist(), f, ensure_ascii=False)
+            columns[name] = {"kind": "categorical"}
+        columns[name]["dtype"] = str(col.dtype)
+
+    for dtype, names in blocks.items():
+        np.save(os.path.join(version_dir, f"{dtype}.block.npy"), np.vstack([df[name].values for name in names]))
+
+    with open(os.path.join(version_dir, "meta.json"), "w", encoding="utf8") as f:
+        json.dump({"n_rows": len(df), "created": version, "columns": columns, "blocks": blocks}, f)
+    with open(os.path.join(snapshot_dir, "CURRENT"), "w", encoding="utf8") as f:
+        f.write(version)
+
+def start_server(data_dir, log_path):
+    """ Starts the dashboard on data_dir, and returns the process once it serves requests. """
+    # The app reads DATA_DIR from the data_dir module, replaced by this one
+    server_module = os.path.join(data_dir, "load_test_server.py")
+    with open(server_module, "w", encoding="utf8") as f:
+        f.write(
+            "import sys, types\n"
+            f"sys.path.insert(0, {os.path.join(REPO_DIR, 'dash_application')!r})\n"
+            "data_dir = types.ModuleType('data_dir')\n"
+            f"data_dir.DATA_DIR = {data_dir!r}\n"
+            "sys.modules['data_dir'] = data_dir\n"
+            "import app\n"
+            "app.current_dataset()\n" # Loaded on first use otherwise, in the measured requests
+            "server = app.app.server\n"
+            "if __name__ == '__main__':\n"
+            f"    server.run(port={PORT}, threaded=True)\n"
+        )
+
+    if SERVER_WORKERS > 0:
+        command = ["gunicorn", "--workers", str(SERVER_WORKERS), "--bind", f"127.0.0.1:{PORT}",
+                   "--pythonpath", data_dir, "--timeout", str(REQUEST_TIMEOUT), "load_test_server:server"]
+    else:
+        command = [sys.executable, server_module]
+
+    # The app reads the mapbox token from the working directory
+    log = open(log_path, "w")
+    server = subprocess.Popen(command, cwd=os.path.join(REPO_DIR, "dash_application"), stdout=log, stderr=log)
+
+    start = time.time()
+    while time.time() - start < STARTUP_TIMEOUT:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}, see {log_path}")
+        try:
+            if requests.get(f"http://127.0.0.1:{PORT}/_dash-layout", timeout=5).ok:
+                return server
+        except requests.ConnectionError:
+            pass
+        time.sleep(1)
+
+    server.terminate()
+    raise RuntimeError(f"Server did not start in {STARTUP_TIMEOUT} seconds, see {log_path}")
+
+def find_components(layout, components=None):
+    """ Props of the components in a Dash layout, by id. """
+    components = {} if components is None else components
+    if isinstance(layout, dict):
+        props = layout.get("props", {})
+        if "id" in props:
+            components[props["id"]] = props
+        find_components(props.get("children"), components)
+    elif isinstance(layout, list):
+        for child in layout:
+            find_components(child, components)
+    return components
+
+def lon_lat_to_tile(lon, lat, z):
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n)
+    return x, y
+
+class SimulatedUser(object):
+    def __init__(self, base_url, rng):
+        self.base_url = base_url
+        self.rng = rng
+        self.session = requests.Session()
+        self.timings = [] # (kind, seconds, bytes, ok)
+
+    def request(self, kind, method, path, **kwargs):
+        start = time.perf_counter()
+        url = path if path.startswith("http") else self.base_url + path
+        try:
+            response = self.session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+            ok = response.ok
+            n_bytes = len(response.content)
+        except requests.RequestException:
+            response, ok, n_bytes = None, False, 0
+        self.timings.append((kind, time.perf_counter() - start, n_bytes, ok))
+        return response if ok else None
+
+    def load_page(self):
+        """ Page, layout and callbacks, as fetched by the browser, then the first map data. """
+        self.request("page", "GET", "/")
+        layout = self.request("page", "GET", "/_dash-layout").json()
+        dependencies = self.request("page", "GET", "/_dash-dependencies").json()
+
+        components = find_components(layout)
+        self.callback = next(c for c in dependencies if c["output"] == "map-data.data")
+        self.values = {
+            (i["id"], i["property"]): components[i["id"]].get(i["property"])
+            for i in self.callback["inputs"]
+        }
+
+        # The figure is built in the browser from the map data, these only change it there
+        self.data_selection = components["data-selection"]["value"]
+        self.zoom_level = components["map-zoom-level"]["data"]
+        self.geometry_urls = components["map-base"]["data"]["geometry_urls"]
+        self.fetched_geometry = set() # Cached by the browser
+        self.map_data = None
+        self.update_map(list(self.values))
+
+    def update_map(self, changed):
+        body = {
+            "output": self.callback["output"],
+            "outputs": {"id": "map-data", "property": "data"},
+            "inputs": [
+                {"id": i["id"], "property": i["property"], "value": self.values[i["id"], i["property"]]}
+                for i in self.callback["inputs"]
+            ],
+            "changedPropIds": [f"{id}.{prop}" for id, prop in changed]
+        }
+        response = self.request("map-data", "POST", "/_dash-update-component", json=body)
+        if response is not None:
+            self.map_data = response.json()["response"]["map-data"]["data"]
+            self.show_map()
+
+    def show_map(self):
+        """ Fetches what the figure of the map data shows, as the browser would. """
+        if self.map_data["plot_type"] == "choropleth":
+            url = self.geometry_urls[self.map_data["polygon_layer"]][self.zoom_level]
+            if url not in self.fetched_geometry:
+                self.request("geometry", "GET", url)
+                self.fetched_geometry.add(url)
+        elif self.map_data["plot_type"] == "colormap" and self.map_data["center"]["lat"] is not None:
+            # No center if no listing matches the filters, then nothing is in view
+            self.fetch_tiles(self.map_data["tile_urls"][self.data_selection], self.map_data["center"])
+
+    def fetch_tiles(self, source, center):
+        """ Fetches TILES_PER_MAP tiles around the center of the map. """
+        x0, y0 = lon_lat_to_tile(center["lon"], center["lat"], TILE_ZOOM)
+        for i in range(TILES_PER_MAP):
+            x, y = x0 - 1 + i % 3, y0 + i // 3
+            self.request("tile", "GET", source.format(z=TILE_ZOOM, x=x, y=y))
+
+    def change_input(self):
+        """ Changes one of the inputs at random, as a user would. Returns the changed input. """
+        kind = self.rng.choice(["dates", "rooms", "data", "plot"], p=[0.3, 0.3, 0.2, 0.2])
+        if kind == "dates":
+            first_month, stop_month = np.array(SOLD_DATE_RANGE, dtype="datetime64[M]")
+            start = first_month + self.rng.integers(0, (stop_month - first_month).astype(int))
+            end = min(start + self.rng.integers(1, 49), stop_month)
+            key = ("date-picker-range", "start_date")
+            self.values["date-picker-range", "start_date"] = str(start.astype("datetime64[D]"))
+            self.values["date-picker-range", "end_date"] = str(end.astype("datetime64[D]"))
+        elif kind == "rooms":
+            low, high = np.sort(self.rng.choice(np.arange(1, 5.5, 0.5), 2, replace=False))
+            key = ("n-rooms-slider", "value")
+            self.values[key] = [float(low), float(high)]
+        elif kind == "data":
+            key = ("data-selection", "value")
+            self.data_selection = str(self.rng.choice(["sqm", "year", "rent"]))
+        else:
+            key = ("plot-type", "value")
+            self.values[key] = str(self.rng.choice(["scatter", "choropleth", "hexbin", "colormap"]))
+        return key
+
+    def run(self, n_actions):
+        self.load_page()
+        for _ in range(n_actions):
+            time.sleep(self.rng.uniform(*THINK_TIME))
+            changed = self.change_input()
+            if changed == ("data-selection", "value"):
+                # Only recolors the map in the browser, which may need other tiles
+                if self.map_data is not None:
+                    self.show_map()
+            else:
+                self.update_map([changed])
+
+class MemorySampler(object):
+    """ Samples the RSS of a process and its children in a background thread. """
+    def __init__(self, pid, interval=0.2):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def rss(self):
+        processes = [self.process] + self.process.children(recursive=True)
+        total = 0
+        for p in processes:
+            try:
+                total += p.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def summarize(timings, kind):
+    seconds = np.array([t for k, t, _, ok in timings if k == kind and ok])
+    n_bytes = np.array([b for k, _, b, ok in timings if k == kind and ok])
+    n_errors = sum(1 for k, _, _, ok in timings if k == kind and not ok)
+    if len(seconds) == 0:
+        return f"{kind:<12}{0:>8}{n_errors:>8}"
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99]) * 1000
+    return f"{kind:<12}{len(seconds):>8}{n_errors:>8}{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}{n_bytes.mean() / 1000:>12,.0f}"
+
+data_dir = tempfile.mkdtemp(prefix="dashboard_load_test_")
+try:
+    rng = np.random.default_rng(SEED)
+    shutil.copytree(AREA_POLYGONS_DIR, os.path.join(data_dir, "area_polygons"))
+    with open(os.path.join(AREA_POLYGONS_DIR, "layers.json"), encoding="utf8") as f:
+        layer = json.load(f)[0]
+
+    start = time.time()
+    polygon_layer = PolygonLayer.from_geojson(
+        os.path.join(AREA_POLYGONS_DIR, layer["file"]), layer["id_property"], layer["name_property"]
+    )
+    df = synthetic_listings(N_LISTINGS, polygon_layer, rng)
+    write_snapshot(df, os.path.join(data_dir, "dashboard_snapshot"))
+    print(f"Wrote {len(df):,} synthetic listings to {data_dir} in {time.time() - start:.1f} s")
+    del df
+
+    start = time.time()
+    log_path = os.path.join(data_dir, "server.log")
+    server = start_server(data_dir, log_path)
+    sampler = MemorySampler(server.pid).start()
+    print(f"Server started in {time.time() - start:.1f} s, RSS {sampler.rss() / 1e6:,.0f} MB, log in {log_path}")
+
+    try:
+        for n_users in N_USERS:
+            users = [SimulatedUser(f"http://127.0.0.1:{PORT}", np.random.default_rng([SEED, n_users, i]))
+                     for i in range(n_users)]
+            threads = [threading.Thread(target=user.run, args=(ACTIONS_PER_USER,)) for user in users]
+
+            sampler.peak = 0
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+
+            timings = [t for user in users for t in user.timings]
+            print(f"\n{n_users} users: {len(timings):,} requests in {elapsed:.1f} s " +
+                  f"({len(timings) / elapsed:.1f} requests/s, " +
+                  f"{sum(1 for k, _, _, _ in timings if k == 'map-data') / elapsed:.1f} map updates/s), " +
+                  f"server RSS {sampler.rss() / 1e6:,.0f} MB (peak {sampler.peak / 1e6:,.0f} MB)")
+            print(f"{'request':<12}{'count':>8}{'errors':>8}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}" +
+                  f"{'mean (kB)':>12}")
+            for kind in ["page", "map-data", "geometry", "tile"]:
+                print(summarize(timings, kind))
+
+        # Where the time of the map callback goes, in the worker answering this
+        server_metrics = requests.get(f"http://127.0.0.1:{PORT}/metrics", timeout=REQUEST_TIMEOUT).json()
+        print(f"\nServer timings (one worker):\n{'span':<56}{'count':>8}{'p50 (ms)':>10}{'p95 (ms)':>10}")
+        for name, m in server_metrics["timings_ms"].items():
+            print(f"{name:<56}{m['count']:>8}{m['p50']:>10.1f}{m['p95']:>10.1f}")
+    finally:
+        sampler.stop()
+        server.terminate()
+        server.wait()
+finally:
+    shutil.rmtree(data_dir, ignore_errors=True)
@@ -0,0 +1,157 @@
+""" BENCHMARK: HEX CELL AGGREGATES
+Checks the hex grid and HexCube against pandas on 500k synthetic listings:
+    - every listing is in the cell whose center is nearest to it,
+    - the ranges of view_ranges cover every listing within the view,
+    - for 40 random combinations of cell size, months, room buckets and view
+      (or none), the cells, numbers of listings, means and medians from the
+      cube, merged with those of listings aggregated individually as the
+      dashboard does for the ends of a date range, equal a groupby of the
+      listings. Medians are from histogram sketches, so they may differ by
+      half a bin.
+Also prints the time of each aggregation.
+
+Run from the repository root:
+    python benchmarks/benchmark_hex_grid.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "dash_application"))
+from hex_grid import HexCube, cell_ids, unpack_cells, cell_centers, view_ranges, in_view, merge_cells
+from aggregate_cube import group_quantiles
+from tiles import to_web_mercator
+
+# ----------------------- CONFIG -----------------------
+N_ROWS = 500_000
+SIZES = [4000, 2000, 1000, 500, 250] # Those of HEX_ZOOM_LEVELS in figures.py
+N_BUCKETS = 5
+COLUMNS = ["price_per_sqm", "construction_year"]
+SKETCH_BIN_WIDTHS = {"price_per_sqm": 250, "construction_year": 1}
+N_COMBINATIONS = 40
+ROWS_FRACTION = 0.2 # Listings aggregated individually instead of from the cube
+SEED = 0
+# ------------------------------------------------------
+
+def synthetic_listings(n_rows, rng):
+    lon = rng.normal(18.05, 0.08, n_rows)
+    lat = rng.normal(59.33, 0.04, n_rows)
+    lon[rng.random(n_rows) < 0.01] = np.nan # Some listings have no coordinates
+    price_per_sqm = rng.uniform(30_000, 130_000, n_rows)
+    price_per_sqm[rng.random(n_rows) < 0.05] = np.nan
+    x, y = to_web_mercator(lon, lat)
+    return pd.DataFrame({
+        "x": x,
+        "y": y,
+        "sold_date": (np.datetime64("2012-01-01") + rng.integers(0, 3650, n_rows)).astype("datetime64[ns]"),
+        "bucket": rng.integers(-1, N_BUCKETS, n_rows), # -1 is unknown
+        "price_per_sqm": price_per_sqm,
+        "construction_year": rng.integers(1880, 2022, n_rows).astype(np.float64)
+    })
+
+def check_cells(df, size):
+    """ Every listing is at most size from the center of its cell, and no nearer to a neighbouring cell. """
+    cells = cell_ids(df["x"].values, df["y"].values, size)
+    located = np.isfinite(df["x"].values)
+    assert (cells[~located] == -1).all()
+
+    x, y, cells = df["x"].values[located], df["y"].values[located], cells[located]
+    cx, cy = cell_centers(cells, size)
+    distance = np.hypot(cx - x, cy - y)
+    assert distance.max() <= size * (1 + 1e-9), distance.max()
+    q, r = unpack_cells(cells)
+    for dq, dr in [(1, 0), (-1, 0), (0, 1), (0, -1), (1, -1), (-1, 1)]:
+        nx, ny = size * np.sqrt(3) * (q + dq + (r + dr) / 2), size * 1.5 * (r + dr)
+        assert (np.hypot(nx - x, ny - y) >= distance - 1e-6).all(), "A neighbouring cell is nearer"
+
+def random_view(rng):
+    lon_min, lat_min = rng.uniform(17.9, 18.15), rng.uniform(59.25, 59.4)
+    x, y = to_web_mercator(
+        [lon_min, lon_min + rng.uniform(0.01, 0.3)], [lat_min, lat_min + rng.uniform(0.005, 0.15)]
+    )
+    return x[0], x[1], y[0], y[1]
+
+rng = np.random.default_rng(SEED)
+df = synthetic_listings(N_ROWS, rng)
+months = df["sold_date"].values.astype("datetime64[M]")
+in_rows = rng.random(N_ROWS) < ROWS_FRACTION
+
+cubes, cells = {}, {}
+for size in SIZES:
+    check_cells(df, size)
+    cells[size] = cell_ids(df["x"].values, df["y"].values, size)
+
+    start = time.perf_counter()
+    cubes[size] = HexCube(size, COLUMNS, SKETCH_BIN_WIDTHS)
+    cubes[size].add(
+        cells[size][~in_rows],
+        df["sold_date"].values[~in_rows],
+        df["bucket"].values[~in_rows],
+        {c: df[c].values[~in_rows] for c in COLUMNS}
+    )
+    print(f"Size {size}: cells checked, cube of {len(cubes[size]):,} entries built in " +
+          f"{(time.perf_counter() - start) * 1000:.0f} ms using {cubes[size].nbytes():,} bytes")
+
+print(f"\n{'size':>6}{'months':>20}{'buckets':>10}{'view':>6}{'cells':>8}{'mean (ms)':>12}{'median (ms)':>12}")
+for _ in range(N_COMBINATIONS):
+    size = SIZES[rng.integers(len(SIZES))]
+    first_month = np.datetime64("2012-01", "M") + rng.integers(0, 110)
+    stop_month = first_month + rng.integers(1, 121 - (first_month - np.datetime64("2012-01", "M")).astype(int))
+    bucket_low = int(rng.integers(0, N_BUCKETS))
+    bucket_high = int(rng.integers(bucket_low, N_BUCKETS))
+    bounds = random_view(rng) if rng.random() < 2 / 3 else None
+    ranges = view_ranges(bounds, size) if bounds is not None else None
+    cube = cubes[size]
+
+    # The individually aggregated listings, filtered as the cube is
+    matching = (months >= first_month) & (months < stop_month) & \
+        (df["bucket"].values >= bucket_low) & (df["bucket"].values <= bucket_high)
+    rows = in_rows & matching
+
+    start = time.perf_counter()
+    result_cells, n_rows, sums, counts = merge_cells([
+        cube.aggregate(ranges, first_month, stop_month, bucket_low, bucket_high),
+        cube.aggregate_rows(cells[size][rows], {c: df[c].values[rows] for c in COLUMNS}, ranges)
+    ], COLUMNS)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = {c: sums[c] / counts[c] for c in COLUMNS}
+    mean_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    medians = {}
+    for c in COLUMNS:
+        sketch_cells, bins, bin_counts = [np.concatenate(parts) for parts in zip(
+            cube.sketch(c, ranges, first_month, stop_month, bucket_low, bucket_high),
+            cube.sketch_rows(c, cells[size][rows], df[c].values[rows], ranges)
+        )]
+        medians[c] = group_quantiles(
+            np.searchsorted(result_cells, sketch_cells), bins, bin_counts, 0.5, SKETCH_BIN_WIDTHS[c], len(result_cells)
+        )
+    median_ms = (time.perf_counter() - start) * 1000
+
+    # The reference, by a groupby of the matching listings in view
+    selected = df[matching & (cells[size] >= 0)].assign(cell=cells[size][matching & (cells[size] >= 0)])
+    selected = selected[in_view(selected["cell"].values, ranges)]
+    groups = selected.groupby("cell")
+    assert (result_cells == groups.size().index.values).all(), "Cells differ"
+    assert (n_rows == groups.size().values).all(), "Numbers of listings differ"
+    for c in COLUMNS:
+        assert np.allclose(means[c], groups[c].mean().values, equal_nan=True), f"Means of {c} differ"
+        expected = groups[c].median().values
+        assert (np.isnan(medians[c]) == np.isnan(expected)).all()
+        assert np.nanmax(np.abs(medians[c] - expected), initial=0) <= SKETCH_BIN_WIDTHS[c] / 2 + 1e-6, \
+            f"Medians of {c} differ by more than half a bin"
+
+    # Every listing within the view is in a cell in the ranges
+    if bounds is not None:
+        x_min, x_max, y_min, y_max = bounds
+        inside = (df["x"].values >= x_min) & (df["x"].values <= x_max) & \
+            (df["y"].values >= y_min) & (df["y"].values <= y_max)
+        assert in_view(cells[size][inside], ranges).all(), "A listing in view is not in the ranges"
+
+    print(f"{size:>6}{f'{first_month} to {stop_month}':>20}{f'{bucket_low}-{bucket_high}':>10}" +
+          f"{'yes' if bounds is not None else 'no':>6}{len(result_cells):>8}{mean_ms:>12.1f}{median_ms:>12.1f}")
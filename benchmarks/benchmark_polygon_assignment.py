@@ -0,0 +1,66 @@
+""" BENCHMARK: POINT-IN-POLYGON ASSIGNMENT
+Times the bulk polygon assignment used in stage 7 on uniformly random points
+within the extent of polygons.geojson, and checks it against the previous
+per-listing loop on a small sample.
+
+Run from the repository root:
+    python benchmarks/benchmark_polygon_assignment.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from shapely.geometry import Point
+from shapely.geometry.polygon import Polygon
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "data_scraping_pipeline"))
+from spatial_join import PolygonLayer
+
+# ----------------------- CONFIG -----------------------
+POLYGONS_GEOJSON = os.path.join(REPO_DIR, "data", "area_polygons", "polygons.geojson")
+N_POINTS = 1_000_000
+N_REFERENCE_POINTS = 2_000 # The old loop is far too slow for the full set
+SEED = 0
+# ------------------------------------------------------
+
+def reference_assign(features, latitudes, longitudes):
+    """ The previous implementation of stage 7, kept for comparison. """
+    codes = np.full(len(latitudes), -1, dtype=np.int32)
+    for ind, (lat, long) in enumerate(zip(latitudes, longitudes)):
+        for i, area in enumerate(features):
+            polygon = Polygon(area["geometry"]["coordinates"][0])
+            point = Point(long, lat)
+
+            if point.within(polygon):
+                codes[ind] = i
+                break
+    return codes
+
+build_start = time.time()
+layer = PolygonLayer.from_geojson(POLYGONS_GEOJSON)
+print(f"Built {len(layer)} prepared polygons in {time.time() - build_start:.2f} s")
+
+rng = np.random.default_rng(SEED)
+min_long, min_lat = layer.bounds[:, :2].min(axis=0)
+max_long, max_lat = layer.bounds[:, 2:].max(axis=0)
+latitudes = rng.uniform(min_lat, max_lat, N_POINTS)
+longitudes = rng.uniform(min_long, max_long, N_POINTS)
+
+start = time.time()
+codes = layer.assign(latitudes, longitudes)
+elapsed = time.time() - start
+print(f"Assigned {N_POINTS:,} points in {elapsed:.2f} s " +
+      f"({N_POINTS / elapsed:,.0f} points/s, {(codes >= 0).mean():.1%} inside a polygon)")
+
+features = [{"geometry": {"coordinates": [np.array(p.exterior.coords)]}} for p in layer.polygons]
+start = time.time()
+reference_codes = reference_assign(features, latitudes[:N_REFERENCE_POINTS], longitudes[:N_REFERENCE_POINTS])
+reference_elapsed = time.time() - start
+print(f"Reference loop: {N_REFERENCE_POINTS:,} points in {reference_elapsed:.2f} s " +
+      f"({N_REFERENCE_POINTS / reference_elapsed:,.0f} points/s)")
+
+# The reference ignores polygon holes, so a point in a hole may differ
+n_mismatches = (reference_codes != codes[:N_REFERENCE_POINTS]).sum()
+print(f"Mismatches against reference: {n_mismatches} of {N_REFERENCE_POINTS:,}")
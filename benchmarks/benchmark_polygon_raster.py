@@ -0,0 +1,55 @@
+""" BENCHMARK: POLYGON LOOKUP RASTER
+Times building the polygon lookup raster from polygons.geojson and resolving
+points with it, and checks the result against the exact shapely assignment.
+
+Run from the repository root:
+    python benchmarks/benchmark_polygon_raster.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "data_scraping_pipeline"))
+from polygon_raster import load_or_build_polygon_raster
+from spatial_join import PolygonLayer
+
+# ----------------------- CONFIG -----------------------
+POLYGONS_GEOJSON = os.path.join(REPO_DIR, "data", "area_polygons", "polygons.geojson")
+RESOLUTIONS = [0.002, 0.001, 0.0005, 0.00025]
+N_POINTS = 5_000_000
+N_EXACT_POINTS = 1_000_000
+SEED = 0
+# ------------------------------------------------------
+
+layer = PolygonLayer.from_geojson(POLYGONS_GEOJSON)
+
+rng = np.random.default_rng(SEED)
+min_long, min_lat = layer.bounds[:, :2].min(axis=0)
+max_long, max_lat = layer.bounds[:, 2:].max(axis=0)
+latitudes = rng.uniform(min_lat, max_lat, N_POINTS)
+longitudes = rng.uniform(min_long, max_long, N_POINTS)
+
+exact_codes = layer.assign(latitudes[:N_EXACT_POINTS], longitudes[:N_EXACT_POINTS])
+
+for resolution in RESOLUTIONS:
+    with tempfile.TemporaryDirectory() as raster_dir:
+        start = time.time()
+        raster = load_or_build_polygon_raster(POLYGONS_GEOJSON, raster_dir, resolution)
+        build_elapsed = time.time() - start
+
+        start = time.time()
+        codes = raster.lookup(latitudes, longitudes)
+        elapsed = time.time() - start
+
+        boundary_share = (raster.grid == -2).mean()
+        n_mismatches = (codes[:N_EXACT_POINTS] != exact_codes).sum()
+        print(f"Resolution {resolution}: grid {raster.grid.shape[0]}x{raster.grid.shape[1]} " +
+              f"({raster.grid.nbytes / 1e6:.1f} MB, {boundary_share:.1%} boundary cells), " +
+              f"built in {build_elapsed:.2f} s, " +
+              f"{N_POINTS:,} lookups in {elapsed:.2f} s, " +
+              f"{n_mismatches} mismatches against shapely in {N_EXACT_POINTS:,}")
+        del raster
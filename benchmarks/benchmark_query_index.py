@@ -0,0 +1,77 @@
+""" BENCHMARK: DASHBOARD FILTER LATENCY
+Compares the previous query_df (copy the dataset, then four boolean filters)
+with the query index, on synthetic listings of 1M and 10M rows.
+
+Run from the repository root:
+    python benchmarks/benchmark_query_index.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "dash_application"))
+from query_index import QueryIndex
+
+# ----------------------- CONFIG -----------------------
+N_ROWS = [1_000_000, 10_000_000]
+QUERIES = [
+    # date_range, n_rooms_range
+    (("2020-01-01", "2021-09-01"), [1.0, 5.0]),
+    (("2013-01-01", "2021-09-01"), [2.0, 3.5]),
+    (("2021-06-01", "2021-07-01"), [1.5, 2.5]),
+    (("2012-01-01", "2022-01-01"), [0.5, 5.0]), # All listings
+]
+N_REPEATS = 5
+SEED = 0
+# ------------------------------------------------------
+
+def synthetic_listings(n_rows, rng):
+    sold_dates = np.datetime64("2012-01-01") + np.sort(rng.integers(0, 3500, n_rows)).astype("timedelta64[D]")
+    sqm = rng.uniform(20, 120, n_rows).astype(np.float32)
+    return pd.DataFrame({
+        "listing_sold_date": sold_dates.astype("datetime64[ns]"),
+        "rooms": np.clip(np.round(sqm / 25 * 2) / 2, 1, 6).astype(np.float32),
+        "sqm": sqm,
+        "latitude": rng.uniform(59.25, 59.42, n_rows),
+        "longitude": rng.uniform(17.85, 18.15, n_rows),
+        "listing_sold_price": (sqm * rng.uniform(40000, 120000, n_rows)).astype(np.float32),
+    })
+
+def old_query_df(df, date_range, n_rooms_range):
+    filtered_df = df.copy()
+    filtered_df = filtered_df[filtered_df["listing_sold_date"] > date_range[0]]
+    filtered_df = filtered_df[filtered_df["listing_sold_date"] < date_range[1]]
+    filtered_df = filtered_df[filtered_df["rooms"] > n_rooms_range[0]]
+    if n_rooms_range[1] < 5:
+        filtered_df = filtered_df[filtered_df["rooms"] < n_rooms_range[1]]
+    return filtered_df
+
+def best_time(f):
+    times = []
+    for _ in range(N_REPEATS):
+        start = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000, result
+
+rng = np.random.default_rng(SEED)
+for n_rows in N_ROWS:
+    df = synthetic_listings(n_rows, rng)
+
+    start = time.perf_counter()
+    query_index = QueryIndex(df["listing_sold_date"].values, df["rooms"].values)
+    print(f"\n{n_rows:,} rows, index built in {(time.perf_counter() - start) * 1000:.0f} ms")
+    print(f"{'date range':<26}{'rooms':<12}{'matches':>12}{'old (ms)':>12}{'index (ms)':>12}{'frame (ms)':>12}")
+
+    for date_range, n_rooms_range in QUERIES:
+        old_ms, old_result = best_time(lambda: old_query_df(df, date_range, n_rooms_range))
+        index_ms, rows = best_time(lambda: query_index.query(date_range, n_rooms_range))
+        frame_ms, new_result = best_time(lambda: df.iloc[query_index.query(date_range, n_rooms_range)])
+
+        assert old_result.index.equals(new_result.index)
+        print(f"{' to '.join(date_range):<26}{str(n_rooms_range):<12}{len(new_result):>12,}" + 
+              f"{old_ms:>12.1f}{index_ms:>12.1f}{frame_ms:>12.1f}")
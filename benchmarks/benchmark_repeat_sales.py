@@ -0,0 +1,84 @@
+""" BENCHMARK: REPEAT-SALES INDEX
+Checks that the repeat-sales index recovers a known index, and measures the
+time to pair the sales and fit the index, on synthetic sales of 50k and 500k
+properties. Every property is in one of N_AREAS areas, each with its own
+random walk as log index, and is sold a few times, at the price of its area's
+index in the month of the sale with noise.
+
+Some properties of the first area are only sold in two months after all
+other sales, pairs that no chain of pairs connects to the base of the area,
+so those months must be left out of the fit.
+
+Run from the repository root:
+    python benchmarks/benchmark_repeat_sales.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "dash_application"))
+from repeat_sales import sale_pairs, fit_index
+
+# ----------------------- CONFIG -----------------------
+N_PROPERTIES = [50_000, 500_000]
+N_AREAS = 20
+N_MONTHS = 120
+FIRST_MONTH = np.datetime64("2012-01", "M")
+SALES_PER_PROPERTY = (2, 4)
+NOISE = 0.05 # Standard deviation of the log price of a sale
+
+# Largest allowed mean and maximum absolute error of the fitted log index
+MAX_MEAN_ERROR = 0.02
+MAX_ERROR = 0.08
+SEED = 0
+# ------------------------------------------------------
+
+def synthetic_sales(n_properties, true_index, rng):
+    """ Sales of n_properties, with the true log index per area and month in true_index. """
+    n_sales = rng.integers(SALES_PER_PROPERTY[0], SALES_PER_PROPERTY[1] + 1, n_properties)
+    property_ids = np.repeat(np.arange(n_properties), n_sales)
+    areas = rng.integers(0, N_AREAS, n_properties)[property_ids]
+    months = rng.integers(0, N_MONTHS, len(property_ids))
+    quality = rng.normal(0, 0.3, n_properties)[property_ids]
+    log_prices = 15 + quality + true_index[areas, months] + rng.normal(0, NOISE, len(property_ids))
+
+    # Properties of the first area only sold in two months after all others
+    n_disconnected = 200
+    property_ids = np.r_[property_ids, np.repeat(np.arange(n_properties, n_properties + n_disconnected), 2)]
+    areas = np.r_[areas, np.zeros(2 * n_disconnected, dtype=areas.dtype)]
+    months = np.r_[months, np.tile([N_MONTHS + 10, N_MONTHS + 11], n_disconnected)]
+    log_prices = np.r_[log_prices, 15 + rng.normal(0, NOISE, 2 * n_disconnected)]
+
+    sold_dates = (FIRST_MONTH + months).astype("datetime64[D]") + rng.integers(0, 28, len(months))
+    return property_ids, sold_dates, np.round(np.exp(log_prices), -3), areas
+
+rng = np.random.default_rng(SEED)
+true_index = np.cumsum(rng.normal(0.004, 0.02, (N_AREAS, N_MONTHS)), axis=1)
+true_index -= true_index[:, :1] # The first month is the base of every area
+
+print(f"{'properties':>12}{'pairs':>12}{'pair (ms)':>12}{'fit (ms)':>12}{'mean error':>12}{'max error':>12}")
+for n_properties in N_PROPERTIES:
+    property_ids, sold_dates, prices, areas = synthetic_sales(n_properties, true_index, rng)
+
+    start = time.perf_counter()
+    pairs = sale_pairs(property_ids, sold_dates, prices, areas)
+    pair_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    index_df = fit_index(pairs)
+    fit_ms = (time.perf_counter() - start) * 1000
+
+    # Every month of every area is fitted, close to the true index, but not the disconnected months
+    fitted = index_df
+    month_numbers = (fitted["month"].values.astype("datetime64[M]") - FIRST_MONTH).astype(np.int64)
+    assert month_numbers.max() < N_MONTHS, "Disconnected months were fitted"
+    assert len(fitted) == N_AREAS * N_MONTHS, len(fitted)
+    errors = np.abs(fitted["log_index"].values - true_index[fitted["group"].values, month_numbers])
+    assert errors.mean() <= MAX_MEAN_ERROR and errors.max() <= MAX_ERROR, (errors.mean(), errors.max())
+    assert (fitted.groupby("group")["log_index"].first() == 0).all()
+
+    print(f"{n_properties:>12,}{len(pairs):>12,}{pair_ms:>12.0f}{fit_ms:>12.0f}" +
+          f"{errors.mean():>12.4f}{errors.max():>12.4f}")
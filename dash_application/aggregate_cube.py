@@ -0,0 +1,264 @@
+""" AGGREGATE CUBE
+Sums and counts of listing values per polygon, sold month and room bucket,
+built once at load time so that averages per polygon are computed from the
+aggregated cells instead of from the listings. The cells are stored sparsely
+(only combinations with listings) and ordered by month, so a range of months
+is a contiguous slice of the cells.
+
+New sales are added with add, which merges them into the existing cells
+without rebuilding the cube.
+
+For quantiles, the cube can also hold a histogram sketch of some of the
+columns per cell: the number of values in each bin of a fixed width, stored
+sparsely as (cell, bin, count). Histograms are merged by adding counts, so
+the sketch of any range of cells is exact up to the bin width, which is also
+the accuracy of the quantiles.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Cells are identified by a key packing month, room bucket and polygon code
+BUCKET_BITS = 8
+POLYGON_BITS = 20
+
+
+def to_bins(values, bin_width):
+    """ Bin of each value, where bin i holds the values closest to i * bin_width. """
+    return np.round(np.asarray(values, dtype=np.float64) / bin_width).astype(np.int64)
+
+
+def merge_bins(keys, bins, counts):
+    """ Sums the counts of equal (key, bin) pairs, returned sorted by key and bin. """
+    order = np.lexsort((bins, keys))
+    keys, bins, counts = keys[order], bins[order], counts[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]) | (bins[1:] != bins[:-1])
+    starts = np.flatnonzero(first)
+
+    return keys[starts], bins[starts], np.add.reduceat(counts, starts) if len(starts) else counts
+
+
+def interpolate_quantiles(bins, cumulative, q, bin_width):
+    """ 
+    Quantiles q of a histogram with cumulative counts over sorted bins,
+    interpolated between values as np.percentile does.
+    """
+    position = np.asarray(q) * (cumulative[-1] - 1)
+    lower = np.floor(position)
+    lower_value = bins[np.searchsorted(cumulative, lower, side="right")]
+    upper_value = bins[np.searchsorted(cumulative, np.minimum(lower + 1, cumulative[-1] - 1), side="right")]
+
+    return (lower_value + (position - lower) * (upper_value - lower_value)) * bin_width
+
+
+def quantiles(bins, counts, q, bin_width):
+    """ Quantiles q (between 0 and 1) of a histogram sketch, NaN if it is empty. """
+    bins, inverse = np.unique(bins, return_inverse=True)
+    histogram = np.bincount(inverse, weights=counts, minlength=len(bins))
+    if histogram.sum() == 0:
+        return np.full(len(q), np.nan)
+
+    return interpolate_quantiles(bins, np.cumsum(histogram), q, bin_width)
+
+
+def group_quantiles(groups, bins, counts, q, bin_width, n_groups):
+    """ 
+    Quantile q of the histogram sketch of each group, NaN for empty groups.
+    As interpolate_quantiles for all groups at once, on the sketch sorted by
+    group and bin: the bin of a position in a group is found in the cumulative
+    counts of all groups, offset by the counts of the groups before it.
+    """
+    groups, bins, counts = np.asarray(groups), np.asarray(bins), np.asarray(counts)
+    result = np.full(n_groups, np.nan)
+    if len(bins) == 0:
+        return result
+    totals = np.bincount(groups, weights=counts, minlength=n_groups)
+    filled = np.flatnonzero(totals > 0)
+    if len(filled) == 0:
+        return result
+
+    # Sorted by one key of group and bin, which is much faster than by both
+    low = bins.min()
+    order = np.argsort(groups * (bins.max() - low + 1) + (bins - low))
+    groups, bins, counts = groups[order], bins[order], counts[order]
+
+    cumulative = np.cumsum(counts)
+    starts = np.searchsorted(groups, filled)
+    offsets = cumulative[starts] - counts[starts]
+    totals = totals[filled]
+    position = q * (totals - 1)
+    lower = np.floor(position)
+    lower_value = bins[np.searchsorted(cumulative, offsets + lower, side="right")]
+    upper_value = bins[np.searchsorted(cumulative, offsets + np.minimum(lower + 1, totals - 1), side="right")]
+    result[filled] = (lower_value + (position - lower) * (upper_value - lower_value)) * bin_width
+
+    return result
+
+
+class AggregateCube(object):
+    def __init__(self, columns, sketch_bin_widths=None):
+        """ 
+        columns are the names of the values that are aggregated, and
+        sketch_bin_widths maps the columns to keep histogram sketches of to
+        their bin width.
+        """
+        self.columns = list(columns)
+        self.sketch_bin_widths = sketch_bin_widths or {}
+
+        # Polygon code 0 means no polygon, polygon_names[i] has code i + 1
+        self.polygon_names = []
+        self.polygon_codes = {}
+
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.n_rows = np.zeros(0, dtype=np.int64)
+        self.sums = {c: np.zeros(0, dtype=np.float64) for c in self.columns}
+        self.counts = {c: np.zeros(0, dtype=np.int64) for c in self.columns}
+        self._unpack_keys()
+
+        # Sketches as cell keys, bins and counts, sorted by key and bin
+        self.sketches = {
+            c: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+            for c in self.sketch_bin_widths
+        }
+
+    def __len__(self):
+        return len(self.keys)
+
+    def nbytes(self):
+        return self.keys.nbytes + self.n_rows.nbytes + self.months.nbytes + \
+            self.buckets.nbytes + self.polygons.nbytes + \
+            sum(self.sums[c].nbytes + self.counts[c].nbytes for c in self.columns) + \
+            sum(a.nbytes for sketch in self.sketches.values() for a in sketch)
+
+    def encode_polygons(self, names, add_new=False):
+        """ Polygon codes of names, where missing or (unless add_new) unknown names are 0. """
+        categorical = pd.Categorical(names)
+        if add_new:
+            for name in categorical.categories:
+                if name not in self.polygon_codes:
+                    self.polygon_names.append(name)
+                    self.polygon_codes[name] = len(self.polygon_names)
+
+        category_codes = np.array(
+            [self.polygon_codes.get(name, 0) for name in categorical.categories] + [0],
+            dtype=np.int64
+        )
+        return category_codes[np.asarray(categorical.codes)] # -1 picks the 0 appended last
+
+    def add(self, polygons, sold_dates, buckets, values):
+        """
+        Adds listings to the cube. polygons are the polygon names, buckets the
+        room buckets (negative if unknown) and values maps each of the columns
+        to the values of the listings. Listings without sold date or room
+        bucket are left out.
+        """
+        sold_dates = np.asarray(sold_dates, dtype="datetime64[ns]")
+        buckets = np.asarray(buckets)
+        valid = ~np.isnat(sold_dates) & (buckets >= 0)
+
+        months = sold_dates[valid].astype("datetime64[M]").astype(np.int64)
+        polygons = self.encode_polygons(np.asarray(polygons)[valid], add_new=True)
+        new_keys = (months << (BUCKET_BITS + POLYGON_BITS)) | \
+            (buckets[valid].astype(np.int64) << POLYGON_BITS) | polygons
+
+        # Merge with the existing cells
+        self.keys, inverse = np.unique(np.concatenate([self.keys, new_keys]), return_inverse=True)
+
+        def merge(old, new):
+            return np.bincount(inverse, weights=np.concatenate([old, new]), minlength=len(self.keys))
+
+        self.n_rows = merge(self.n_rows, np.ones(len(new_keys))).astype(np.int64)
+        for c in self.columns:
+            v = np.asarray(values[c], dtype=np.float64)[valid]
+            finite = ~np.isnan(v)
+            self.sums[c] = merge(self.sums[c], np.where(finite, v, 0))
+            self.counts[c] = merge(self.counts[c], finite).astype(np.int64)
+
+        for c, bin_width in self.sketch_bin_widths.items():
+            v = np.asarray(values[c], dtype=np.float64)[valid]
+            finite = ~np.isnan(v)
+            keys, bins, counts = self.sketches[c]
+            self.sketches[c] = merge_bins(
+                np.concatenate([keys, new_keys[finite]]),
+                np.concatenate([bins, to_bins(v[finite], bin_width)]),
+                np.concatenate([counts, np.ones(finite.sum(), dtype=np.int64)])
+            )
+
+        self._unpack_keys()
+
+    def _unpack_keys(self):
+        self.months = self.keys >> (BUCKET_BITS + POLYGON_BITS)
+        self.buckets = (self.keys >> POLYGON_BITS) & ((1 << BUCKET_BITS) - 1)
+        self.polygons = self.keys & ((1 << POLYGON_BITS) - 1)
+
+    def aggregate(self, first_month, stop_month, bucket_low=None, bucket_high=None, columns=None):
+        """
+        Returns the number of listings, and the sums and counts of each of
+        columns (all if None), per polygon code for the months from
+        first_month up to but not including stop_month, and the room buckets
+        from bucket_low to bucket_high inclusive (None means unbounded).
+        """
+        columns = self.columns if columns is None else columns
+        first_key = np.datetime64(first_month, "M").astype(np.int64) << (BUCKET_BITS + POLYGON_BITS)
+        stop_key = np.datetime64(stop_month, "M").astype(np.int64) << (BUCKET_BITS + POLYGON_BITS)
+        cells = slice(*np.searchsorted(self.keys, [first_key, stop_key]))
+
+        mask = np.ones(cells.stop - cells.start, dtype=bool)
+        if bucket_low is not None:
+            mask &= self.buckets[cells] >= bucket_low
+        if bucket_high is not None:
+            mask &= self.buckets[cells] <= bucket_high
+
+        polygons = self.polygons[cells][mask]
+        n = len(self.polygon_names) + 1
+
+        def total(x):
+            return np.bincount(polygons, weights=x[cells][mask], minlength=n)
+
+        return total(self.n_rows), \
+            {c: total(self.sums[c]) for c in columns}, \
+            {c: total(self.counts[c]) for c in columns}
+
+    def sketch(self, column, first_month, stop_month, bucket_low=None, bucket_high=None):
+        """
+        Returns the histogram sketch of column for the same cells as aggregate,
+        as arrays of polygon codes, bins and counts.
+        """
+        keys, bins, counts = self.sketches[column]
+        first_key = np.datetime64(first_month, "M").astype(np.int64) << (BUCKET_BITS + POLYGON_BITS)
+        stop_key = np.datetime64(stop_month, "M").astype(np.int64) << (BUCKET_BITS + POLYGON_BITS)
+        cells = slice(*np.searchsorted(keys, [first_key, stop_key]))
+
+        buckets = (keys[cells] >> POLYGON_BITS) & ((1 << BUCKET_BITS) - 1)
+        mask = np.ones(len(buckets), dtype=bool)
+        if bucket_low is not None:
+            mask &= buckets >= bucket_low
+        if bucket_high is not None:
+            mask &= buckets <= bucket_high
+
+        return keys[cells][mask] & ((1 << POLYGON_BITS) - 1), bins[cells][mask], counts[cells][mask]
+
+    def sketch_rows(self, column, polygons, values):
+        """ Same as sketch, for listings that are not in the cube. polygons may be None. """
+        values = np.asarray(values, dtype=np.float64)
+        finite = ~np.isnan(values)
+        polygons = np.zeros(len(values), dtype=np.int64) if polygons is None else self.encode_polygons(polygons)
+        return polygons[finite], \
+            to_bins(values[finite], self.sketch_bin_widths[column]), \
+            np.ones(finite.sum(), dtype=np.int64)
+
+    def aggregate_rows(self, polygons, values, columns=None):
+        """ Same as aggregate, for listings that are not in the cube. """
+        columns = self.columns if columns is None else columns
+        polygons = self.encode_polygons(polygons)
+        n = len(self.polygon_names) + 1
+
+        sums, counts = {}, {}
+        for c in columns:
+            v = np.asarray(values[c], dtype=np.float64)
+            finite = ~np.isnan(v)
+            sums[c] = np.bincount(polygons[finite], weights=v[finite], minlength=n)
+            counts[c] = np.bincount(polygons[finite], minlength=n)
+
+        return np.bincount(polygons, minlength=n), sums, counts
@@ -1,144 +1,749 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import numpy as np
+import os
+import json
+import time
+import random
+import logging
+import threading
+import flask
+from urllib.parse import quote
 from datetime import date
 
-from figures import choropleth, scatterplot, colormap, query_df
+# Log startup information, e.g. the memory usage of the dataset
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+from figures import map_base, choropleth_data, hexbin_data, scatter_data, colormap_data, serialize_map_data, \
+                    current_dataset, geometry_level, hex_level, prepared_polygons, polygon_geometry_version, \
+                    price_index_figure, trend_figure, POLYGON_LAYERS, BITMAP_NUMERIC_FIELDS, TREND_STATISTICS, \
+                    COMPARABLES_MAX_DISTANCE, ALL_AREAS, GEOMETRY_ZOOM_LEVELS
+from bitmap_index import Range, In, And
+from figure_cache import FigureCache, make_key, quantize_date
+from tiles import TileCache, state_key, snap_to_tiles, EMPTY_TILE, TILE_FORMAT
+from metrics import registry as metrics, SamplingProfiler
+from data_dir import DATA_DIR
+
+# Cache of recently viewed map data. Kept on disk so that it is shared by all
+# worker processes; set FIGURE_CACHE_DIR to None to keep it in memory instead.
+FIGURE_CACHE_SIZE = 256
+FIGURE_CACHE_DIR = os.path.join(DATA_DIR, "figure_cache")
+
+# Rendered colormap tiles, per filter state
+TILE_CACHE_DIR = os.path.join(DATA_DIR, "tile_cache")
+TILE_CACHE_STATES = 64
+MAX_TILE_ZOOM = 22
+
+# The scatterplot only shows the listings within (a margin around) the map
+# view, and at most MAX_SCATTER_POINTS of them. With more than
+# SCATTER_TILE_THRESHOLD listings in view the colormap tiles are shown instead.
+MAX_SCATTER_POINTS = 20_000
+SCATTER_TILE_THRESHOLD = 100_000
+
+# Sampling profiler of requests, written as folded stacks for flame graphs.
+# The fraction PROFILE_SAMPLE_RATE of the requests is profiled (0 is none).
+# If PROFILE_ENABLED is set, requests with the header "X-Profile: 1" are
+# always profiled, and the name of their file is returned in the header
+# X-Profile-File. At most PROFILE_MAX_FILES files are kept, the oldest are removed.
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+PROFILE_SAMPLE_RATE = float(os.environ.get("DASH_PROFILE_SAMPLE_RATE", 0))
+PROFILE_ENABLED = os.environ.get("DASH_PROFILE_ENABLED", "0") == "1"
+PROFILE_MAX_FILES = 500
+PROFILE_INTERVAL = 0.001 # Seconds between samples
+
+# Number of comparable sales shown for a clicked listing
+COMPARABLES_K = 10
+
+# Marks of the number of rooms sliders. The last mark means no upper limit.
+ROOM_SLIDER_MARKS = {1: "1", 1.5: "1.5", 2: "2", 2.5: "2.5", 3: "3", 3.5: "3.5", 4: "4", 4.5: "4.5", 5: "5+"}
+
+# Data selections: (column, description)
+TARGET_COLUMNS = {
+    "sqm": ("listing_sold_price_per_sqm", 'Price per m²'),
+    "year": ("construction_year", 'Construction year'),
+    "rent": ("listing_rent_per_sqm", 'Rent per m²'),
+}
+
+# Sliders of numeric filters: (id, column, label, format of the marks)
+NUMERIC_FILTERS = [
+    ("price-per-sqm-slider", "listing_sold_price_per_sqm", "Price per m²:", lambda x: f"{x // 1000}k"),
+    ("sqm-slider", "sqm", "Living area (m²):", lambda x: f"{x}"),
+    ("construction-year-slider", "construction_year", "Construction year:", lambda x: f"{x}"),
+]
+
+# Dropdowns of categorical filters: (id, column, label)
+CATEGORICAL_FILTERS = [
+    ("area-filter", "polygon_name", "Areas:"),
+    ("agency-filter", "listing_agency_name", "Listing agencies:"),
+    ("energy-class-filter", "energy_class", "Energy classes:"),
+]
+
+def numeric_filter_slider(id, column, format_mark):
+    """ 
+    Range slider stepping along the bin edges of the column in the bitmap 
+    index. The ends of the slider mean no lower and upper limit respectively.
+    """
+    edges = [int(e) for e in BITMAP_NUMERIC_FIELDS[column]]
+    mark_step = max(1, (len(edges) - 1) // 4)
+    marks = {e: format_mark(e) for e in edges[::mark_step]}
+    marks[edges[-1]] = format_mark(edges[-1]) + "+"
+
+    return dcc.RangeSlider(
+        id=id,
+        marks=marks,
+        min=edges[0],
+        max=edges[-1],
+        value=[edges[0], edges[-1]],
+        step=edges[1] - edges[0],
+        allowCross=False
+    )
+
+def filter_expression(numeric_ranges, categorical_values):
+    """ Combines the values of the filter controls to a bitmap index expression. """
+    expressions = []
+    for (_, column, _, _), (low, high) in zip(NUMERIC_FILTERS, numeric_ranges):
+        edges = BITMAP_NUMERIC_FIELDS[column]
+        if low > edges[0] or high < edges[-1]:
+            expressions.append(Range(
+                column, 
+                low if low > edges[0] else None, 
+                high if high < edges[-1] else None
+            ))
+
+    for (_, column, _), values in zip(CATEGORICAL_FILTERS, categorical_values):
+        if values:
+            expressions.append(In(column, values))
+
+    return And(*expressions) if expressions else None
 
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app.title = "Stockholm Apartment Dashboard"
 
-app.layout = html.Div(id="main-container",
-    children=[
-        html.Div(id="sidebar",
-            children=[
-                html.Div(
-                    id="filters",
-                    children=[
-                        html.H3("Filters"),
-
-                        html.P("Listings sold date range:"),
-                        dcc.DatePickerRange(
-                            id="date-picker-range",
-                            start_date=date(2020,1,1),
-                            end_date=date.today(),
-                            display_format='YYYY-MM-DD'
-                        ),
-
-                        html.P("Number of rooms:"),
-                        dcc.RangeSlider(
-                            id="n-rooms-slider",
-                            marks={
-                                1:"1",
-                                1.5: "1.5",
-                                2:"2",
-                                2.5:"2.5",
-                                3:"3",
-                                3.5:"3.5",
-                                4:"4",
-                                4.5:"4.5",
-                                5:"5+",
-                            },
-                            min=1.0,
-                            max=5.0,
-                            value=[1.0, 5.0],
-                            step=0.5,
-                            allowCross=False
-                        )
-                    ]
-                ), 
-                html.Div(
-                    id="options",
-                    children=[
-                        html.H3("Options"),
-
-                        html.P("Data:"),
-                        dcc.Dropdown(
-                            id='data-selection',
-                            options=[
-                                {'label': 'Price per m²', 'value': 'sqm'},
-                                {'label': 'Construction year', 'value': 'year'},
-                                {'label': 'Rent per m²', 'value': 'rent'}
-                            ],
-                            value='sqm',
-                            clearable=False
-                        ),
-
-                        html.P("Plot type:"),
-                        dcc.RadioItems(
-                            id='plot-type',
-                            options=[
-                                {'label': 'Scatterplot', 'value': 'scatter'},
-                                {'label': 'Choropleth', 'value': 'choropleth'},
-                                {'label': 'Colormap (IN DEVELOPMENT)', 'value': 'colormap'}
-                            ],
-                            value='scatter'
-                        )
-                    ]
-                )
-            ]
-        ),
-        dcc.Loading(
-            parent_className="map-loader-wrapper",
-            children=[
-                dcc.Graph(
-                    id='map'
-                )
-            ]
-        ),
-    ]
+figure_cache = FigureCache(max_entries=FIGURE_CACHE_SIZE, directory=FIGURE_CACHE_DIR)
+tile_cache = TileCache(TILE_CACHE_DIR, max_states=TILE_CACHE_STATES)
+
+# The data is loaded on first use, by current_dataset, which also starts
+# swapping to new versions built by the pipeline, without a restart. Figures
+# and tiles are cached per version, so those of the old version are no longer
+# used and age out of the caches.
+
+def request_name():
+    """ Route of the request, and for Dash callbacks also their output, e.g. "/_dash-update-component map-data.data". """
+    rule = flask.request.url_rule.rule if flask.request.url_rule is not None else "unmatched"
+    if rule == "/_dash-update-component":
+        body = flask.request.get_json(silent=True) or {}
+        return f"{rule} {body.get('output', '')}"
+    return rule
+
+@app.server.before_request
+def start_request_metrics():
+    flask.g.request_start = time.perf_counter()
+    requested = PROFILE_ENABLED and flask.request.headers.get("X-Profile") == "1"
+    if requested or random.random() < PROFILE_SAMPLE_RATE:
+        flask.g.profiler = SamplingProfiler(threading.get_ident(), PROFILE_INTERVAL).start()
+
+@app.server.after_request
+def record_request_metrics(response):
+    """ 
+    Records the time of the request, including the JSON encoding of callback 
+    outputs by Dash, and the size of the response as sent (before any 
+    compression).
+    """
+    name = request_name()
+    metrics.record_time(f"request {name}", time.perf_counter() - flask.g.get("request_start", time.perf_counter()))
+    if not response.direct_passthrough:
+        metrics.record_size(f"response {name}", response.content_length or 0)
+
+    profiler = flask.g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        path = profiler.write(PROFILE_DIR, name, max_files=PROFILE_MAX_FILES)
+        logging.info(f"Wrote {profiler.n_samples} samples of {name} to {path}")
+        if PROFILE_ENABLED:
+            response.headers["X-Profile-File"] = os.path.basename(path)
+
+    return response
+
+@app.server.route("/metrics")
+def metrics_summary():
+    """ 
+    Timings and sizes of this worker process: of requests per route, of the 
+    map callback and its parts (queries, map data and serialization),
+    and of the served map data per plot type.
+    """
+    return flask.jsonify({
+        **metrics.summary(),
+        "dataset_version": current_dataset().version,
+        "figure_cache": figure_cache.stats(),
+        "profiler": {"directory": PROFILE_DIR, "sample_rate": PROFILE_SAMPLE_RATE}
+    })
+
+@app.server.route("/figure-cache")
+def figure_cache_stats():
+    """ Hit and miss counters of the figure cache, and the data version, for this worker process. """
+    return flask.jsonify({**figure_cache.stats(), "dataset_version": current_dataset().version})
+
+def tile_url(state):
+    """ XYZ URL template of the colormap tiles for a filter state, which changes with TILE_FORMAT as cached by browsers. """
+    return f"{flask.request.url_root}tiles/{{z}}/{{x}}/{{y}}.png?state={quote(json.dumps(state, sort_keys=True))}" + \
+           f"&v={TILE_FORMAT}"
+
+def geometry_url(prefix, level):
+    """ URL of the polygons of a layer at a level of detail, which changes with their version. """
+    return app.get_relative_path(f"/polygons/{prefix}/{level}.json") + f"?v={polygon_geometry_version(prefix)}"
+
+@app.server.route("/polygons/<prefix>/<int:level>.json")
+def polygon_geometry(prefix, level):
+    """ Polygons of the choropleth, fetched by the browser once per layer and level of detail. """
+    if prefix not in POLYGON_LAYERS or not 0 <= level < len(GEOMETRY_ZOOM_LEVELS):
+        flask.abort(404)
+
+    # The URL changes with the polygons, see geometry_url
+    return flask.Response(
+        prepared_polygons(prefix)[level], 
+        mimetype="application/json", 
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
+
+TILE_STATE_KEYS = {
+    "date_range", "n_rooms_range", "numeric_ranges", "categorical_values", "data_selection", "span", "dataset_version"
+}
+
+def is_pair(value):
+    return isinstance(value, list) and len(value) == 2
+
+def parse_tile_state(query):
+    """ 
+    The filter state of a tile URL, as made by update_map_data, or None if
+    it is not valid. Only valid states are rendered and cached.
+    """
+    try:
+        state = json.loads(query)
+    except ValueError:
+        return None
+    if not isinstance(state, dict) or not TILE_STATE_KEYS <= state.keys():
+        return None
+
+    if state["data_selection"] not in TARGET_COLUMNS:
+        return None
+    if not all(is_pair(state[k]) for k in ["date_range", "n_rooms_range", "span"]):
+        return None
+    if not all(isinstance(v, (int, float)) for v in [*state["n_rooms_range"], *state["span"]]):
+        return None
+    try:
+        for d in state["date_range"]:
+            np.datetime64(d, "ns")
+    except (TypeError, ValueError):
+        return None
+
+    numeric_ranges, categorical_values = state["numeric_ranges"], state["categorical_values"]
+    if not isinstance(numeric_ranges, list) or len(numeric_ranges) != len(NUMERIC_FILTERS) or \
+       not all(is_pair(r) and all(isinstance(v, (int, float)) for v in r) for r in numeric_ranges):
+        return None
+    if not isinstance(categorical_values, list) or len(categorical_values) != len(CATEGORICAL_FILTERS) or \
+       not all(v is None or (isinstance(v, list) and all(isinstance(s, str) for s in v)) for v in categorical_values):
+        return None
+    return state
+
+@app.server.route("/tiles/<int:z>/<int:x>/<int:y>.png")
+def colormap_tile(z, x, y):
+    """ Colormap tile for the filter state in the query string, see update_map_data. """
+    if not 0 <= z <= MAX_TILE_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        flask.abort(400)
+    state = parse_tile_state(flask.request.args.get("state", ""))
+    if state is None:
+        flask.abort(400)
+    key = state_key(state)
+
+    data = current_dataset()
+    png = tile_cache.get(key, z, x, y)
+    if png is None:
+        png = data.listing_tile(
+            state["date_range"],
+            state["n_rooms_range"],
+            filter_expression(state["numeric_ranges"], state["categorical_values"]),
+            TARGET_COLUMNS[state["data_selection"]][0],
+            state["span"],
+            z, x, y
+        )
+
+        # A map made before the data was swapped shows the new data until it is
+        # updated, but the tile is not cached under the state of the old version
+        if state["dataset_version"] != data.version:
+            return flask.Response(png, mimetype="image/png", headers={"Cache-Control": "no-store"})
+        # Empty tiles are cheap to render, and would be most of the cache
+        if png is not EMPTY_TILE:
+            tile_cache.put(key, z, x, y, png)
+
+    # The URL changes with the filter state, so the tile never changes
+    return flask.Response(png, mimetype="image/png", headers={"Cache-Control": "public, max-age=86400"})
+
+def serve_layout():
+    """ 
+    The layout is made per page load, so that the filter options are those of
+    the current data. Dash also makes it once when it is set, to validate the
+    callbacks against its components, which is done without the data.
+    """
+    data = current_dataset() if flask.has_request_context() else None
+
+    # The last room bucket of the trend aggregates is all of them
+    trends = data.trends("polygon") if data is not None else None
+    trend_windows = trends.windows if trends is not None else [12]
+    trend_room_buckets = trends.room_buckets if trends is not None else ["All"]
+    return html.Div(id="main-container",
+        children=[
+            html.Div(id="sidebar",
+                children=[
+                    html.Div(
+                        id="filters",
+                        children=[
+                            html.H3("Filters"),
+
+                            html.P("Listings sold date range:"),
+                            dcc.DatePickerRange(
+                                id="date-picker-range",
+                                start_date=date(2020,1,1),
+                                end_date=date.today(),
+                                display_format='YYYY-MM-DD'
+                            ),
+
+                            html.P("Number of rooms:"),
+                            dcc.RangeSlider(
+                                id="n-rooms-slider",
+                                marks=ROOM_SLIDER_MARKS,
+                                min=1.0,
+                                max=5.0,
+                                value=[1.0, 5.0],
+                                step=0.5,
+                                allowCross=False
+                            ),
+
+                            *[c for id, column, label, format_mark in NUMERIC_FILTERS for c in [
+                                html.P(label),
+                                numeric_filter_slider(id, column, format_mark)
+                            ]],
+
+                            *[c for id, column, label in CATEGORICAL_FILTERS for c in [
+                                html.P(label),
+                                dcc.Dropdown(
+                                    id=id,
+                                    className="filter-dropdown",
+                                    options=[{'label': v, 'value': v} for v in (data.filter_options(column) if data is not None else [])],
+                                    multi=True,
+                                    placeholder="All"
+                                )
+                            ]]
+                        ]
+                    ), 
+                    html.Div(
+                        id="options",
+                        children=[
+                            html.H3("Options"),
+
+                            html.P("Data:"),
+                            dcc.Dropdown(
+                                id='data-selection',
+                                options=[
+                                    {'label': 'Price per m²', 'value': 'sqm'},
+                                    {'label': 'Construction year', 'value': 'year'},
+                                    {'label': 'Rent per m²', 'value': 'rent'}
+                                ],
+                                value='sqm',
+                                clearable=False
+                            ),
+
+                            html.P("Plot type:"),
+                            dcc.RadioItems(
+                                id='plot-type',
+                                options=[
+                                    {'label': 'Scatterplot', 'value': 'scatter'},
+                                    {'label': 'Choropleth', 'value': 'choropleth'},
+                                    {'label': 'Hexbin', 'value': 'hexbin'},
+                                    {'label': 'Colormap (IN DEVELOPMENT)', 'value': 'colormap'}
+                                ],
+                                value='scatter'
+                            ),
+
+                            html.P("Areas (choropleth):"),
+                            dcc.Dropdown(
+                                id='polygon-layer',
+                                options=[
+                                    {'label': layer["description"], 'value': prefix}
+                                    for prefix, layer in POLYGON_LAYERS.items()
+                                ],
+                                value='polygon',
+                                clearable=False
+                            ),
+
+                            html.P("Statistic (choropleth, hexbin):"),
+                            dcc.RadioItems(
+                                id='choropleth-statistic',
+                                options=[
+                                    {'label': 'Mean', 'value': 'mean'},
+                                    {'label': 'Median', 'value': 'median'}
+                                ],
+                                value='mean'
+                            )
+                        ]
+                    )
+                ]
+            ),
+            dcc.Loading(
+                parent_className="map-loader-wrapper",
+                children=[
+                    dcc.Graph(
+                        id='map'
+                    ),
+                    # Data of the map, from which the figure is built in the browser
+                    dcc.Store(id='map-data', data=None)
+                ]
+            ),
+            html.Div(id="side-panel",
+                children=[
+                    html.Div(id="comparables",
+                        children=[
+                            html.H3("Comparable sales"),
+
+                            html.P("Number of rooms:"),
+                            dcc.RangeSlider(
+                                id="comparables-rooms-slider",
+                                marks=ROOM_SLIDER_MARKS,
+                                min=1.0,
+                                max=5.0,
+                                value=[1.0, 5.0],
+                                step=0.5,
+                                allowCross=False
+                            ),
+
+                            html.P("Living area (m²):"),
+                            numeric_filter_slider("comparables-sqm-slider", "sqm", lambda x: f"{x}"),
+
+                            html.P("Sold within:"),
+                            dcc.Dropdown(
+                                id="comparables-months",
+                                options=[{'label': f"{m} months", 'value': m} for m in [3, 6, 12, 24, 36]],
+                                value=12,
+                                clearable=False
+                            ),
+
+                            html.Div(id="comparables-results")
+                        ]
+                    ),
+                    html.Div(id="price-index",
+                        children=[
+                            html.H3("Price index"),
+                            html.P("Repeat sales of the areas in the areas filter, or of all areas."),
+                            dcc.Loading(
+                                dcc.Graph(id="price-index-graph", config={"displayModeBar": False})
+                            )
+                        ]
+                    ),
+                    html.Div(id="trends",
+                        children=[
+                            html.H3("Trends"),
+                            html.P("Rolling aggregates of the areas in the areas filter, or of all areas."),
+                            dcc.Dropdown(
+                                id="trend-statistic",
+                                options=[
+                                    {'label': description, 'value': statistic} 
+                                    for statistic, (description, _) in TREND_STATISTICS.items()
+                                ],
+                                value="median",
+                                clearable=False
+                            ),
+                            dcc.RadioItems(
+                                id="trend-window",
+                                options=[{'label': f"{w} months", 'value': w} for w in trend_windows],
+                                value=trend_windows[-1],
+                                labelStyle={"display": "inline-block", "margin-right": "10px"}
+                            ),
+                            html.P("Number of rooms:"),
+                            dcc.Dropdown(
+                                id="trend-rooms",
+                                options=[{'label': b, 'value': b} for b in trend_room_buckets],
+                                value=trend_room_buckets[-1],
+                                clearable=False
+                            ),
+                            dcc.Graph(id="trend-graph", config={"displayModeBar": False})
+                        ]
+                    )
+                ]
+            ),
+            # The parts of the map figure that never change
+            dcc.Store(
+                id='map-base', 
+                data=map_base({selection: desc for selection, (_, desc) in TARGET_COLUMNS.items()}, geometry_url)
+                     if data is not None else None
+            ),
+            # Level of detail of the choropleth polygons, from the map zoom
+            dcc.Store(id='map-zoom-level', data=geometry_level(10)),
+            # Bounds of the scatterplot listings and hexbin cells, from the map view
+            dcc.Store(id='map-viewport', data=None),
+            # Size of the hexbin cells, from the map zoom
+            dcc.Store(id='map-hex-level', data=hex_level(10)),
+        ]
+    )
+
+app.layout = serve_layout
+
+@app.callback(
+    Output('map-zoom-level', 'data'),
+    Input('map', 'relayoutData'),
+    State('map-zoom-level', 'data'),
+    State('plot-type', 'value')
+)
+def update_zoom_level(relayout_data, zoom_level, plot_type):
+    """ Only changes when zooming the choropleth past another level of detail. """
+    if plot_type != "choropleth" or not relayout_data or "mapbox.zoom" not in relayout_data:
+        raise PreventUpdate
+
+    new_zoom_level = geometry_level(relayout_data["mapbox.zoom"])
+    if new_zoom_level == zoom_level:
+        raise PreventUpdate
+    return new_zoom_level
+
+@app.callback(
+    Output('map-viewport', 'data'),
+    Output('map-hex-level', 'data'),
+    Input('map', 'relayoutData'),
+    Input('plot-type', 'value'),
+    State('map-viewport', 'data'),
+    State('map-hex-level', 'data')
 )
+def update_viewport(relayout_data, plot_type, viewport, level):
+    """ 
+    Bounds of the map view snapped to map tiles, so that the scatterplot and
+    hexbin are only updated when the map is moved or zoomed noticeably, and
+    the size of the hexbin cells at the zoom, both set together so that the
+    map data is only updated once.
+    """
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+    if plot_type not in ["scatter", "hexbin"] or "plot-type.value" in triggered:
+        # A new map starts from the full view
+        new_viewport, new_level = None, hex_level(10)
+    elif relayout_data and "mapbox._derived" in relayout_data and "mapbox.zoom" in relayout_data:
+        corners = np.array(relayout_data["mapbox._derived"]["coordinates"])
+        new_viewport = list(snap_to_tiles(
+            corners[:, 0].min(), corners[:, 0].max(), corners[:, 1].min(), corners[:, 1].max(), 
+            relayout_data["mapbox.zoom"]
+        ))
+        new_level = hex_level(relayout_data["mapbox.zoom"]) if plot_type == "hexbin" else level
+    else:
+        raise PreventUpdate
+
+    if new_viewport == viewport and new_level == level:
+        raise PreventUpdate
+    return new_viewport, new_level
 
 @app.callback(
-    Output('map', 'figure'),
+    Output('map-data', 'data'),
     Input('date-picker-range', 'start_date'),
     Input('date-picker-range', 'end_date'),
     Input('n-rooms-slider', 'value'),
-    Input('data-selection', 'value'),
-    Input('plot-type', 'value')
+    Input('plot-type', 'value'),
+    Input('polygon-layer', 'value'),
+    Input('choropleth-statistic', 'value'),
+    Input('map-viewport', 'data'),
+    Input('map-hex-level', 'data'),
+    *[Input(id, 'value') for id, _, _, _ in NUMERIC_FILTERS],
+    *[Input(id, 'value') for id, _, _ in CATEGORICAL_FILTERS]
 )
-def update_figure(start_date, end_date, n_rooms_range, data_selection, plot_type):
-    # Apply filters
-    filtered_df = query_df([start_date, end_date], n_rooms_range)
-
-    # Select data for plotting
-    if data_selection == "sqm":
-        target_col = "listing_sold_price_per_sqm"
-        target_col_desc = 'Price per m²'
-
-    elif data_selection == "year":
-        target_col = "construction_year"
-        target_col_desc = 'Construction year'
-
-    elif data_selection == "rent":
-        target_col = "listing_rent_per_sqm"
-        target_col_desc = 'Rent per m²'
-
-    # Plot according to user preference
-    if plot_type == "scatter":
-        fig = scatterplot(
-            filtered_df, 
-            target_col=target_col, 
-            target_col_desc=target_col_desc
-        )
-    elif plot_type == "choropleth":
-        fig = choropleth(
-            filtered_df, 
-            target_col=target_col, 
-            target_col_desc=target_col_desc
-        )
-    elif plot_type == "colormap":
-        fig = colormap(
-            filtered_df, 
-            target_col=target_col, 
-            target_col_desc=target_col_desc
+@metrics.timed("callback.update_map_data")
+def update_map_data(start_date, end_date, n_rooms_range, plot_type, polygon_layer, statistic, viewport, level,
+                    *filter_values):
+    """ 
+    Data of the map for every data selection, which the figure is built from
+    by the clientside map.figure callback in assets/map_figure.js. Changing
+    the data selection, or the level of detail of the choropleth, therefore
+    only updates the figure in the browser.
+    """
+    # Only the day of the dates matters, and not the order of the selected values
+    start_date, end_date = quantize_date(start_date), quantize_date(end_date)
+    numeric_ranges = filter_values[:len(NUMERIC_FILTERS)]
+    categorical_values = [sorted(values or []) for values in filter_values[len(NUMERIC_FILTERS):]]
+
+    # The same version of the data throughout, even if it is swapped meanwhile
+    data = current_dataset()
+
+    # Return the map data as is if these inputs were recently viewed
+    key = make_key(
+        start_date, end_date, n_rooms_range, plot_type, 
+        (polygon_layer, statistic) if plot_type == "choropleth" else None, 
+        (statistic, level) if plot_type == "hexbin" else None,
+        viewport if plot_type in ["scatter", "hexbin"] else None,
+        flask.request.url_root if plot_type in ["scatter", "colormap"] else None,
+        numeric_ranges, categorical_values, data.version
+    )
+    with metrics.span("figure_cache.get"):
+        cached = figure_cache.get(key)
+    if cached is not None:
+        metrics.record_size(f"map_data.{plot_type} cached", len(cached))
+        return json.loads(cached)
+
+    expression = filter_expression(numeric_ranges, categorical_values)
+    date_range = [start_date, end_date]
+    targets = {selection: column for selection, (column, _) in TARGET_COLUMNS.items()}
+
+    # The choropleth is aggregated from the cube, the other plots need the listings
+    if plot_type == "choropleth":
+        averages = {}
+        for selection, column in targets.items():
+            averages[selection], center = data.polygon_averages(
+                date_range, 
+                n_rooms_range, 
+                column, 
+                polygon_layer=polygon_layer,
+                filter_expression=expression,
+                statistic=statistic
+            )
+        map_data = choropleth_data(averages, center, polygon_layer=polygon_layer, statistic=statistic)
+    elif plot_type == "hexbin":
+        # Only the cells in view, of a size from the zoom
+        plot_df, center = data.hex_averages(
+            date_range, 
+            n_rooms_range, 
+            list(targets.values()), 
+            level, 
+            viewport=viewport,
+            filter_expression=expression,
+            statistic=statistic
         )
+        map_data = hexbin_data(plot_df, targets, level, center, statistic=statistic)
+    else:
+        rows = data.query_rows(date_range, n_rooms_range, expression)
+        filtered_df = data.df.iloc[rows]
+        center = dict(lat=filtered_df["latitude"].mean(), lon=filtered_df["longitude"].mean())
+        spans = {
+            selection: data.colorbar_range(date_range, n_rooms_range, column, expression)
+            for selection, column in targets.items()
+        }
+
+        uirevision = None
+        if plot_type == "scatter":
+            # Only the listings in view, and a sample of them if there are many
+            scatter_df, n_in_view = data.viewport_sample(rows, viewport, MAX_SCATTER_POINTS)
+            if n_in_view > SCATTER_TILE_THRESHOLD:
+                plot_type = "colormap"
+                uirevision = "scatter" # Keep the view when switching back to points
+            else:
+                map_data = scatter_data(scatter_df, targets, spans, center)
+
+        if plot_type == "colormap":
+            # The tiles are rendered by colormap_tile, from the state in their URL
+            tile_urls = {
+                selection: tile_url({
+                    "date_range": date_range,
+                    "n_rooms_range": n_rooms_range,
+                    "numeric_ranges": numeric_ranges,
+                    "categorical_values": categorical_values,
+                    "data_selection": selection,
+                    "span": spans[selection],
+                    "dataset_version": data.version
+                })
+                for selection in targets
+            }
+            map_data = colormap_data(tile_urls, spans, center, uirevision=uirevision)
+
+    with metrics.span("serialize.map_data"):
+        serialized = serialize_map_data(map_data)
+    metrics.record_size(f"map_data.{plot_type}", len(serialized))
+
+    with metrics.span("figure_cache.put"):
+        figure_cache.put(key, serialized)
+    return map_data
+
+@app.callback(
+    Output('comparables-results', 'children'),
+    Input('map', 'clickData'),
+    Input('comparables-rooms-slider', 'value'),
+    Input('comparables-sqm-slider', 'value'),
+    Input('comparables-months', 'value')
+)
+@metrics.timed("callback.update_comparables")
+def update_comparables(click_data, n_rooms_range, sqm_range, months):
+    """ The sales nearest to the listing clicked on the map, and the price per sqm estimated from them. """
+    points = (click_data or {}).get("points", [])
+    if not points or "lat" not in points[0]:
+        return html.P("Click a listing in the scatterplot to see the nearest comparable sales.")
+    point = points[0]
+
+    # The ends of the slider mean no lower and upper limit
+    edges = BITMAP_NUMERIC_FIELDS["sqm"]
+    low, high = sqm_range
+    comparables, estimates = current_dataset().nearest_comparables(
+        [point["lon"]], 
+        [point["lat"]], 
+        k=COMPARABLES_K, 
+        n_rooms_range=n_rooms_range,
+        sqm_range=(low if low > edges[0] else None, high if high < edges[-1] else None),
+        months=months,
+        property_ids=[point["customdata"][1]] if len(point.get("customdata") or []) > 1 else None
+    )
+    comparables, estimate = comparables[0], estimates[0]
+
+    heading = html.P(f"Near {point['hovertext']}:") if point.get("hovertext") else None
+    if len(comparables) == 0:
+        return [heading, html.P(f"No comparable sales within {COMPARABLES_MAX_DISTANCE / 1000:g} km.")]
+
+    return [
+        heading,
+        html.H4(f"Estimate: {estimate:,.0f} kr/m²"),
+        html.Table([
+            html.Thead(html.Tr([html.Th(h) for h in ["Address", "Rooms", "m²", "Sold", "kr/m²", "Distance"]])),
+            html.Tbody([
+                html.Tr([
+                    html.Td(row.address),
+                    html.Td(f"{row.rooms:g}"),
+                    html.Td(f"{row.sqm:g}"),
+                    html.Td(f"{row.listing_sold_date:%Y-%m-%d}"),
+                    html.Td(f"{row.listing_sold_price_per_sqm:,.0f}"),
+                    html.Td(f"{row.distance:,.0f} m")
+                ])
+                for row in comparables.itertuples()
+            ])
+        ])
+    ]
+
+@app.callback(
+    Output('price-index-graph', 'figure'),
+    Input('area-filter', 'value')
+)
+@metrics.timed("callback.update_price_index")
+def update_price_index(areas):
+    """ Repeat-sales index of the areas selected in the areas filter, or of all areas if none are. """
+    index_df = current_dataset().repeat_sales_index("polygon")
+    return price_index_figure(index_df, areas or [ALL_AREAS])
+
+@app.callback(
+    Output('trend-graph', 'figure'),
+    Input('area-filter', 'value'),
+    Input('trend-rooms', 'value'),
+    Input('trend-window', 'value'),
+    Input('trend-statistic', 'value')
+)
+@metrics.timed("callback.update_trend")
+def update_trend(areas, room_bucket, window, statistic):
+    """ Trend of the areas selected in the areas filter, or of all areas if none are, sliced from the aggregates. """
+    return trend_figure(current_dataset().trends("polygon"), areas or [ALL_AREAS], room_bucket, window, statistic)
+
+# The figure is built in the browser by assets/map_figure.js
+app.clientside_callback(
+    ClientsideFunction(namespace="map", function_name="figure"),
+    Output('map', 'figure'),
+    Input('map-data', 'data'),
+    Input('data-selection', 'value'),
+    Input('map-zoom-level', 'data'),
+    State('map-base', 'data')
+)
 
-    return fig
+def main():
+    current_dataset() # Load the data before serving the first request
+    app.run_server(debug=True)
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,179 @@
+/* MAP FIGURE
+Builds the figure of the map in the browser, from the map data sent by the
+map callback in app.py and the parts that never change (map_base in
+figures.py), which are sent once with the page. The map data has the values
+of every data selection, so changing it only recolors the map here, and the
+polygons of the choropleth are fetched (and cached) by plotly from their URL.
+The hexagons of the hexbin plot are built here from their axial coordinates,
+see hex_grid.py.
+*/
+
+var EARTH_RADIUS = 6378137.0; // Of Web Mercator, as in tiles.py
+
+function decodeArray(encoded) {
+    // Base64 of the little-endian bytes of an array, see encode_array in figures.py
+    var binary = atob(encoded.data);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    var types = {float32: Float32Array, int32: Int32Array, uint32: Uint32Array};
+    return new types[encoded.dtype](bytes.buffer);
+}
+
+function scatterTrace(data, dataSelection, description) {
+    var values = decodeArray(data.values[dataSelection]);
+    var lat = decodeArray(data.lat);
+    var lon = decodeArray(data.lon);
+    var soldDays = decodeArray(data.sold_days);
+    var propertyIds = decodeArray(data.property_ids);
+    var addressCodes = decodeArray(data.address_codes);
+
+    // Listings without a value are left out. The property_id in customdata is sent
+    // with a click, so that the comparables of a listing leave out its own sales.
+    var trace = {
+        type: "scattermapbox",
+        mode: "markers",
+        lat: [],
+        lon: [],
+        marker: {color: [], coloraxis: "coloraxis"},
+        hovertext: [],
+        customdata: [],
+        hovertemplate: "<b>%{hovertext}</b><br><br>" + description + "=%{marker.color}<br>" +
+                       "Sold date=%{customdata[0]}<extra></extra>"
+    };
+    for (var i = 0; i < values.length; i++) {
+        if (isNaN(values[i])) {
+            continue;
+        }
+        trace.lat.push(lat[i]);
+        trace.lon.push(lon[i]);
+        trace.marker.color.push(values[i]);
+        trace.hovertext.push(addressCodes[i] >= 0 ? data.addresses[addressCodes[i]] : "");
+        trace.customdata.push([new Date(soldDays[i] * 86400000).toISOString().slice(0, 10), propertyIds[i]]);
+    }
+    return trace;
+}
+
+function hexbinTrace(data, dataSelection, description) {
+    var values = decodeArray(data.values[dataSelection]);
+    var q = decodeArray(data.q);
+    var r = decodeArray(data.r);
+    var nListings = decodeArray(data.n_listings);
+    var size = data.size;
+
+    // Pointy-top hexagons around the centers of the cells, in Web Mercator
+    // metres converted to longitude and latitude. Cells without a value are left out.
+    var features = [];
+    var trace = {
+        type: "choroplethmapbox",
+        geojson: {type: "FeatureCollection", features: features},
+        featureidkey: "id",
+        locations: [],
+        z: [],
+        customdata: [],
+        coloraxis: "coloraxis",
+        marker: {opacity: 0.6, line: {width: 0}},
+        hovertemplate: description + "=%{z}<br>Listings=%{customdata}<extra></extra>"
+    };
+    for (var i = 0; i < values.length; i++) {
+        if (isNaN(values[i])) {
+            continue;
+        }
+        var x = size * Math.sqrt(3) * (q[i] + r[i] / 2);
+        var y = size * 1.5 * r[i];
+        var ring = [];
+        for (var k = 0; k <= 6; k++) {
+            var angle = Math.PI / 180 * (60 * k - 30);
+            ring.push([
+                (x + size * Math.cos(angle)) / EARTH_RADIUS * 180 / Math.PI,
+                (2 * Math.atan(Math.exp((y + size * Math.sin(angle)) / EARTH_RADIUS)) - Math.PI / 2) * 180 / Math.PI
+            ]);
+        }
+        features.push({type: "Feature", id: String(i), geometry: {type: "Polygon", coordinates: [ring]}});
+        trace.locations.push(String(i));
+        trace.z.push(values[i]);
+        trace.customdata.push(nListings[i]);
+    }
+    return trace;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        figure: function(data, dataSelection, zoomLevel, base) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+
+            var description = base.descriptions[dataSelection];
+            var layout = {
+                template: base.template,
+                margin: {l: 0, r: 0, t: 0, b: 0},
+                mapbox: Object.assign({center: data.center}, base.mapbox),
+                coloraxis: {colorbar: {title: {text: description}}}
+            };
+            var trace;
+
+            if (data.plot_type === "scatter") {
+                var rangeColor = data.range_colors[dataSelection];
+                trace = scatterTrace(data, dataSelection, description);
+                layout.mapbox.zoom = 12;
+                layout.coloraxis.colorscale = base.colorscales.scatter;
+                layout.coloraxis.cmin = rangeColor[0];
+                layout.coloraxis.cmax = rangeColor[1];
+                layout.uirevision = "scatter"; // Keep the map view when the points in view are replaced
+            } else if (data.plot_type === "hexbin") {
+                if (data.statistic === "median") {
+                    description = "Median " + description[0].toLowerCase() + description.slice(1);
+                    layout.coloraxis.colorbar.title.text = description;
+                }
+                trace = hexbinTrace(data, dataSelection, description);
+                layout.mapbox.zoom = 10;
+                layout.coloraxis.colorscale = base.colorscales.choropleth;
+                layout.uirevision = "hexbin"; // Keep the map view when the cells in view are replaced
+            } else if (data.plot_type === "choropleth") {
+                if (data.statistic === "median") {
+                    description = "Median " + description[0].toLowerCase() + description.slice(1);
+                    layout.coloraxis.colorbar.title.text = description;
+                }
+                trace = {
+                    type: "choroplethmapbox",
+                    geojson: base.geometry_urls[data.polygon_layer][zoomLevel],
+                    featureidkey: "id",
+                    locations: data.locations,
+                    z: data.values[dataSelection],
+                    coloraxis: "coloraxis",
+                    marker: {opacity: 0.5},
+                    hovertemplate: "Område=%{location}<br>" + description + "=%{z}<extra></extra>"
+                };
+                layout.mapbox.zoom = 10;
+                layout.coloraxis.colorscale = base.colorscales.choropleth;
+                layout.uirevision = "choropleth"; // Keep the map view when the polygons are replaced
+            } else {
+                // An invisible point, only for showing the colorbar of the tiles
+                var span = data.spans[dataSelection];
+                trace = {
+                    type: "scattermapbox",
+                    mode: "markers",
+                    lat: [data.center.lat],
+                    lon: [data.center.lon],
+                    marker: {size: 0, opacity: 0, color: [span[0]], coloraxis: "coloraxis"},
+                    hoverinfo: "skip"
+                };
+                layout.mapbox.zoom = 12;
+                layout.mapbox.layers = [{
+                    sourcetype: "raster",
+                    source: [data.tile_urls[dataSelection]],
+                    opacity: 0.7,
+                    below: "traces"
+                }];
+                layout.coloraxis.colorscale = base.colorscales.colormap;
+                layout.coloraxis.cmin = span[0];
+                layout.coloraxis.cmax = span[1];
+                layout.uirevision = data.uirevision;
+            }
+
+            return {data: [trace], layout: layout};
+        }
+    }
+});
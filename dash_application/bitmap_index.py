@@ -0,0 +1,207 @@
+""" BITMAP INDEX
+Bitmap index over binned listing values, built once at load time, so that any
+combination of filters is answered by intersecting bitmaps instead of scanning
+the columns. Bitmaps are packed numpy bit arrays (8 rows per byte).
+
+Numeric fields are binned by fixed edges and range encoded: for every bin there
+is a bitmap of the rows in that bin or below, so any range of bins is the AND
+of two bitmaps. Ranges not aligned to the bin edges are refined by checking
+the values of the rows in the two boundary bins only.
+
+Categorical fields have one bitmap per value. As in roaring bitmaps, values
+matching few rows are stored as sorted row positions instead of as a bitmap.
+
+Filters are expressed by combining Range, In, And, Or and Not, e.g.
+    And(Range("sqm", 40, 80), In("energy_class", ["A", "B"]))
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class Range(object):
+    """ Rows where low <= value < high. None means unbounded. """
+    def __init__(self, field, low=None, high=None):
+        self.field, self.low, self.high = field, low, high
+
+    def evaluate(self, index):
+        return index.fields[self.field].range(self.low, self.high)
+
+
+class In(object):
+    """ Rows where the value is one of values. """
+    def __init__(self, field, values):
+        self.field, self.values = field, values
+
+    def evaluate(self, index):
+        return index.fields[self.field].isin(self.values)
+
+
+class And(object):
+    def __init__(self, *expressions):
+        self.expressions = expressions
+
+    def evaluate(self, index):
+        bits = index.all_rows()
+        for expression in self.expressions:
+            bits &= expression.evaluate(index)
+        return bits
+
+
+class Or(object):
+    def __init__(self, *expressions):
+        self.expressions = expressions
+
+    def evaluate(self, index):
+        bits = index.no_rows()
+        for expression in self.expressions:
+            bits |= expression.evaluate(index)
+        return bits
+
+
+class Not(object):
+    def __init__(self, expression):
+        self.expression = expression
+
+    def evaluate(self, index):
+        return ~self.expression.evaluate(index) & index.all_rows()
+
+
+def pack(mask):
+    return np.packbits(mask)
+
+
+def positions_to_bits(positions, n_rows):
+    mask = np.zeros(n_rows, dtype=bool)
+    mask[positions] = True
+    return pack(mask)
+
+
+class NumericField(object):
+    def __init__(self, values, edges):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.n_rows = len(self.values)
+        self.edges = np.asarray(edges, dtype=np.float64)
+
+        # Bin j + 1 holds the values in [edges[j], edges[j+1]); bin 0 the values
+        # below the first edge and the last bin the values from the last edge.
+        valid = ~np.isnan(self.values)
+        bins = np.searchsorted(self.edges, self.values, side="right")
+        bins[~valid] = -1
+
+        # Row positions grouped by bin, for refining ranges within a bin
+        self.bin_order = np.argsort(bins, kind="stable").astype(np.uint32)
+        counts = np.bincount(bins[valid], minlength=len(self.edges) + 1)
+        self.bin_starts = np.concatenate([[0], np.cumsum(counts)]) + (~valid).sum()
+
+        # cumulative[j] holds the rows in bin j or below, cumulative[-1] all valid rows
+        self.cumulative = np.vstack([
+            pack(valid & (bins <= j)) for j in range(len(self.edges) + 1)
+        ])
+
+    def nbytes(self):
+        return self.cumulative.nbytes + self.bin_order.nbytes
+
+    def range(self, low, high):
+        bits = self.cumulative[-1].copy()
+
+        if low is not None:
+            j = np.searchsorted(self.edges, low, side="right") # Bin of low
+            if j > 0:
+                bits &= ~self.cumulative[j - 1]
+            if j == 0 or self.edges[j - 1] != low:
+                bits &= ~self._boundary_bits(j, lambda v: v < low)
+
+        if high is not None:
+            j = np.searchsorted(self.edges, high, side="right") # Bin of high
+            if j > 0 and self.edges[j - 1] == high:
+                bits &= self.cumulative[j - 1]
+            else:
+                bits &= self.cumulative[j]
+                bits &= ~self._boundary_bits(j, lambda v: v >= high)
+
+        return bits
+
+    def _boundary_bits(self, j, outside):
+        """ Bits of the rows in bin j whose value is outside the range. """
+        rows = self.bin_order[self.bin_starts[j]:self.bin_starts[j + 1]]
+        return positions_to_bits(rows[outside(self.values[rows])], self.n_rows)
+
+
+class CategoricalField(object):
+    def __init__(self, values, sparse_threshold=32):
+        categorical = pd.Categorical(values)
+        codes = np.asarray(categorical.codes)
+        self.n_rows = len(codes)
+
+        # Group the row positions by value
+        order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes[codes >= 0], minlength=len(categorical.categories))
+        starts = np.cumsum(counts) - counts + (codes < 0).sum()
+
+        # Values matching at most 1 in sparse_threshold rows are stored as
+        # positions, which is then smaller than a bitmap (32 bit vs 1 bit per row).
+        self.containers = {}
+        for value, start, count in zip(categorical.categories, starts, counts):
+            positions = order[start:start + count].astype(np.uint32)
+            if count * sparse_threshold <= self.n_rows:
+                self.containers[value] = positions
+            else:
+                self.containers[value] = positions_to_bits(positions, self.n_rows)
+
+    def nbytes(self):
+        return sum(c.nbytes for c in self.containers.values())
+
+    def isin(self, values):
+        mask = np.zeros(self.n_rows, dtype=bool)
+        bits = pack(mask)
+        for value in values:
+            container = self.containers.get(value)
+            if container is None:
+                continue
+            if container.dtype == np.uint32:
+                mask[container] = True
+            else:
+                bits |= container
+
+        return bits | pack(mask)
+
+
+class BitmapIndex(object):
+    def __init__(self, df, numeric_fields, categorical_fields):
+        """
+        numeric_fields maps column names to bin edges, categorical_fields is a
+        list of column names.
+        """
+        self.n_rows = len(df)
+        self.fields = {}
+        for name, edges in numeric_fields.items():
+            self.fields[name] = NumericField(df[name].values, edges)
+        for name in categorical_fields:
+            self.fields[name] = CategoricalField(df[name].values)
+
+    def nbytes(self):
+        return sum(field.nbytes() for field in self.fields.values())
+
+    def all_rows(self):
+        return pack(np.ones(self.n_rows, dtype=bool))
+
+    def no_rows(self):
+        return pack(np.zeros(self.n_rows, dtype=bool))
+
+    def evaluate(self, expression):
+        """ Returns the packed bitmap of the rows matching expression. """
+        return expression.evaluate(self)
+
+    def mask(self, bits, rows):
+        """
+        Returns a boolean mask of the bits for rows, which is either a slice
+        or an array of row positions. Only the bytes covering rows are unpacked.
+        """
+        if isinstance(rows, slice):
+            first_byte = rows.start // 8
+            unpacked = np.unpackbits(bits[first_byte:(rows.stop + 7) // 8])
+            return unpacked[rows.start - 8 * first_byte:rows.stop - 8 * first_byte].astype(bool)
+
+        rows = np.asarray(rows)
+        return ((bits[rows >> 3] >> (7 - (rows & 7))) & 1).astype(bool)
@@ -0,0 +1,129 @@
+""" COMPARABLES
+Nearest comparable sales of locations, from a KD-tree over the coordinates of
+the listings projected to metres, built once per version of the data.
+
+Only some listings are comparable, e.g. those with a similar number of rooms
+and living area sold recently, given as a mask. The tree is queried for more
+neighbours than needed, as many as should contain enough comparable ones if
+they are spread evenly, and the others are skipped. Where too few of them are
+comparable, more neighbours are queried, unless that would visit more
+listings than there are comparable ones. Then, as when the comparable
+listings are few, a tree over only those is built for the remaining
+locations instead. Neither computes the distance to all listings.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS = 6_371_000 # Metres
+
+
+def to_metres(lon, lat, origin_lat):
+    """
+    Points as an array of x, y in metres, by the equirectangular projection
+    around the latitude origin_lat, which is accurate within a city.
+    """
+    x = np.radians(lon) * EARTH_RADIUS * np.cos(np.radians(origin_lat))
+    y = np.radians(lat) * EARTH_RADIUS
+    return np.column_stack([x, y])
+
+
+class ComparablesIndex(object):
+    def __init__(self, lon, lat):
+        """ Listings without coordinates are left out. """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        located = np.isfinite(lon) & np.isfinite(lat)
+
+        # Positions of the listings in the tree, by their position in the tree
+        self.positions = np.flatnonzero(located)
+        self.origin_lat = float(lat[located].mean()) if located.any() else 0.0
+        self.points = to_metres(lon[located], lat[located], self.origin_lat)
+        self.tree = cKDTree(self.points)
+
+    def nbytes(self):
+        # The tree keeps a copy of the points and their order
+        return self.positions.nbytes + 2 * self.points.nbytes + self.tree.indices.nbytes
+
+    def query(self, lon, lat, k, mask=None, max_distance=np.inf):
+        """
+        The k nearest listings to each of the locations lon, lat (arrays) among
+        the listings where mask is True (all if None), within max_distance
+        metres. Returns the positions of the listings and their distances in
+        metres, as arrays of shape (locations, k), nearest first, padded with
+        -1 and inf where there are fewer than k.
+        """
+        points = to_metres(np.atleast_1d(lon), np.atleast_1d(lat), self.origin_lat)
+        positions = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.inf)
+
+        comparable = np.ones(len(self.positions), dtype=bool) if mask is None else np.asarray(mask)[self.positions]
+        n_comparable = comparable.sum()
+        if n_comparable == 0 or k == 0 or len(points) == 0:
+            return positions, distances
+
+        # Neighbours to query so that about 2k of them are comparable, if evenly spread,
+        # widened for the locations where too few are. When that would mean visiting
+        # more listings than there are comparable ones, a tree of those is built instead.
+        n_candidates = min(len(self.positions), int(np.ceil(2 * k * len(self.positions) / n_comparable)))
+        remaining = np.arange(len(points))
+        while len(remaining) > 0 and len(remaining) * n_candidates < n_comparable:
+            candidate_distances, candidates = self.tree.query(
+                points[remaining], n_candidates, distance_upper_bound=max_distance
+            )
+            candidate_distances = candidate_distances.reshape(len(remaining), -1)
+            candidates = candidates.reshape(len(remaining), -1)
+
+            # Missing neighbours, beyond max_distance, have the index len(self.positions)
+            found = candidates < len(self.positions)
+            keep = found.copy()
+            keep[found] = comparable[candidates[found]]
+            rank = np.cumsum(keep, axis=1)
+            keep &= rank <= k
+            rows, columns = np.nonzero(keep)
+            slots = rank[rows, columns] - 1
+            positions[remaining[rows], slots] = self.positions[candidates[rows, columns]]
+            distances[remaining[rows], slots] = candidate_distances[rows, columns]
+
+            # With missing neighbours all comparables within max_distance were seen
+            exhausted = ~found.all(axis=1) | (n_candidates == len(self.positions))
+            remaining = remaining[(keep.sum(axis=1) < k) & ~exhausted]
+            n_candidates = min(len(self.positions), 4 * n_candidates)
+
+        if len(remaining) > 0:
+            subset = np.flatnonzero(comparable)
+            n = min(k, len(subset))
+            subset_distances, nearest = cKDTree(self.points[subset]).query(
+                points[remaining], n, distance_upper_bound=max_distance
+            )
+            subset_distances = subset_distances.reshape(len(remaining), -1)
+            nearest = nearest.reshape(len(remaining), -1)
+
+            found = nearest < len(subset)
+            positions[remaining, :n] = np.where(found, self.positions[subset[np.where(found, nearest, 0)]], -1)
+            distances[remaining, :n] = subset_distances
+
+        return positions, distances
+
+    def query_others(self, lon, lat, k, ids, location_ids, mask=None, max_distance=np.inf):
+        """
+        As query, but leaving out the listings whose id in ids (an array of
+        all listings, e.g. their property_id) is the id in location_ids of the
+        location, as when the locations are listings themselves.
+        """
+        ids = np.asarray(ids)
+        location_ids = np.atleast_1d(location_ids)
+        comparable = np.ones(len(ids), dtype=bool) if mask is None else np.asarray(mask)
+
+        # Queried for as many more as there are comparable listings of any of the ids,
+        # which are then dropped and the others moved forward in their place
+        own = ids[comparable & np.isin(ids, location_ids)]
+        n_own = int(np.unique(own, return_counts=True)[1].max(initial=0))
+        positions, distances = self.query(lon, lat, k + n_own, comparable, max_distance)
+
+        other = (positions >= 0) & (ids[np.maximum(positions, 0)] != location_ids[:, None])
+        order = np.argsort(~other, axis=1, kind="stable")[:, :k]
+        other = np.take_along_axis(other, order, axis=1)
+        positions = np.where(other, np.take_along_axis(positions, order, axis=1), -1)
+        distances = np.where(other, np.take_along_axis(distances, order, axis=1), np.inf)
+        return positions, distances
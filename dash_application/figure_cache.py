@@ -0,0 +1,163 @@
+""" FIGURE CACHE
+Bounded LRU cache of the serialized output of the map callback (the map
+data the figure is built from), keyed on its inputs and the dataset version,
+so that revisiting a combination of inputs does not recompute it.
+
+Two backends are available:
+    - MemoryBackend keeps the entries in the process.
+    - DiskBackend keeps one file per entry in a directory, which makes the
+      cache shared by all worker processes on the host. Using a directory on
+      a tmpfs such as /dev/shm keeps it in shared memory.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Part of every key. The disk cache outlives the process, so bump this whenever
+# the cached value changes for the same inputs, e.g. the format of the map data.
+CACHE_FORMAT = 3
+
+
+def quantize_date(d):
+    """ Date strings from the date picker may include a time; only the day matters. """
+    return None if d is None else str(d)[:10]
+
+
+def make_key(*inputs):
+    """ Hash of JSON serializable callback inputs and CACHE_FORMAT, usable as a file name. """
+    return hashlib.sha1(json.dumps([CACHE_FORMAT, inputs], sort_keys=True, default=str).encode("utf8")).hexdigest()
+
+
+class MemoryBackend(object):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskBackend(object):
+    """ Entries are files, and their modification time is used as the LRU order. """
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _entries(self):
+        return [e for e in os.scandir(self.directory) if e.name.endswith(".json")]
+
+    def _entries_by_age(self):
+        """ Paths of the entries, least recently used first, without those removed meanwhile. """
+        entries = []
+        for e in self._entries():
+            try:
+                entries.append((e.stat().st_mtime, e.path))
+            except FileNotFoundError:
+                pass # Evicted by another worker meanwhile
+        return [path for _, path in sorted(entries)]
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding="utf8") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(self._path(key)) # Mark as recently used
+        except FileNotFoundError:
+            pass # Evicted by another worker meanwhile
+        return value
+
+    def put(self, key, value):
+        # Write to a temporary file of this thread first, so other workers never read a partial entry
+        temp_path = self._path(key) + f".{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            f.write(value)
+        os.replace(temp_path, self._path(key))
+
+        if len(self._entries()) > self.max_entries:
+            entries = self._entries_by_age()
+            for path in entries[:max(0, len(entries) - self.max_entries)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        for e in self._entries():
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self._entries())
+
+
+class FigureCache(object):
+    def __init__(self, max_entries=256, directory=None):
+        """ Caches in directory if given, shared by all processes, otherwise in memory. """
+        if directory is None:
+            self.backend = MemoryBackend(max_entries)
+        else:
+            self.backend = DiskBackend(directory, max_entries)
+
+        self.hits = 0
+        self.misses = 0
+        self.created = time.time()
+
+    def get(self, key):
+        """ Returns the serialized value for key, or None. """
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.backend.put(key, value)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        """ Counters of this process, and the number of entries in the backend. """
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": len(self.backend),
+            "max_entries": self.backend.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else None,
+            "uptime_seconds": round(time.time() - self.created)
+        }
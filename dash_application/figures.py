@@ -1,18 +1,114 @@
-import datashader as ds
 import colorcet as cc
 import pandas as pd
 import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+from plotly.colors import make_colorscale
+from plotly.utils import PlotlyJSONEncoder
 import re    
 import json
+import warnings
+import base64
 import os
+import time
+import logging
+import threading
 from data_dir import DATA_DIR
+from snapshot import current_version, load_snapshot, load_column, read_meta, compact, memory_report
+from query_index import QueryIndex
+from bitmap_index import BitmapIndex
+from aggregate_cube import AggregateCube, quantiles, group_quantiles
+from hex_grid import HexCube, snapshot_cell_sizes, cell_ids, unpack_cells, cell_centers, view_ranges, merge_cells
+from polygon_geometry import prepare_geojson, count_vertices
+from tiles import to_web_mercator, tile_bounds, render_tile, EARTH_RADIUS
+from sampling import grid_sample
+from comparables import ComparablesIndex
+from repeat_sales import sale_pairs, fit_index
+from trends import TrendAggregates, trends_exist
+from hot_reload import HotReloader
+from metrics import timed
 
-# Initialize
-with open("mapbox_access_token.txt") as f:
-    mapbox_accesstoken = f.read()
+_mapbox_access_token = None
+
+def mapbox_access_token():
+    """ The mapbox access token, read from mapbox_access_token.txt on first use. """
+    global _mapbox_access_token
+    if _mapbox_access_token is None:
+        with open("mapbox_access_token.txt") as f:
+            _mapbox_access_token = f.read()
+    return _mapbox_access_token
+
+# Polygon layers that listings are assigned to in stage 7, keyed by column prefix
+with open(os.path.join(DATA_DIR, "area_polygons", "layers.json"), encoding='utf-8') as f:
+    POLYGON_LAYERS = {layer["prefix"]: layer for layer in json.load(f)}
+
+# Simplification tolerance (degrees) of the choropleth polygons from each map
+# zoom level and up. 0.0001 degrees is about 10 m north-south.
+GEOMETRY_ZOOM_LEVELS = [
+    (0, 0.0005),
+    (11, 0.0002),
+    (12.5, 0.00005),
+    (14, 0)
+]
+
+def geometry_level(zoom):
+    """ Index of the entry in GEOMETRY_ZOOM_LEVELS to use at zoom. """
+    return max(i for i, (min_zoom, _) in enumerate(GEOMETRY_ZOOM_LEVELS) if zoom >= min_zoom)
+
+# Size (Web Mercator metres from center to corner) of the cells of the hexbin
+# plot from each map zoom level and up, about 13 pixels on the map. The
+# snapshot has the cell of every listing at each size, see hex_grid.
+HEX_ZOOM_LEVELS = [
+    (0, 4000),
+    (10, 2000),
+    (11, 1000),
+    (12, 500),
+    (13, 250)
+]
+
+def hex_level(zoom):
+    """ Index of the entry in HEX_ZOOM_LEVELS to use at zoom. """
+    return max(i for i, (min_zoom, _) in enumerate(HEX_ZOOM_LEVELS) if zoom >= min_zoom)
+
+# Polygons of each layer at each level, prepared and serialized once, when the
+# layer is first requested. They are served as files, fetched and cached by the
+# browser, so only the values of the polygons are sent for every choropleth.
+# Their version changes with the file.
+_polygon_geojson = {}
+_polygon_geojson_lock = threading.Lock()
+
+def polygon_layer_path(prefix):
+    return os.path.join(DATA_DIR, "area_polygons", POLYGON_LAYERS[prefix]["file"])
+
+def polygon_geometry_version(prefix):
+    return str(int(os.path.getmtime(polygon_layer_path(prefix))))
+
+def prepared_polygons(prefix):
+    """ GeoJSON strings of the polygons of a layer, one per entry in GEOMETRY_ZOOM_LEVELS. """
+    with _polygon_geojson_lock:
+        if prefix not in _polygon_geojson:
+            collections = prepare_geojson(
+                polygon_layer_path(prefix), 
+                POLYGON_LAYERS[prefix]["name_property"], 
+                [tolerance for _, tolerance in GEOMETRY_ZOOM_LEVELS]
+            )
+            logging.info(f"Prepared polygons of {prefix} with " + ", ".join(
+                f"{count_vertices(c)} vertices" for c in collections.values()
+            ))
+            _polygon_geojson[prefix] = [json.dumps(collections[tolerance]) for _, tolerance in GEOMETRY_ZOOM_LEVELS]
+        return _polygon_geojson[prefix]
+
+POLYGON_LAYER_DTYPES = {
+    f"{prefix}_{c}": 'str' for prefix in POLYGON_LAYERS for c in ["id", "name"]
+}
 
 # ------------------ LOAD DATAFRAME -----------------------
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "dashboard_snapshot")
+
+# Rolling aggregates per snapshot version, built by stage 9 of the pipeline
+TREND_AGGREGATES_DIR = os.path.join(DATA_DIR, "trend_aggregates")
+
 DTYPES = {
     'property_id': np.uint32, 
     'property_URL': 'str', 
@@ -34,198 +130,839 @@ DTYPES = {
     'primary_area': 'str', 
     'floor': 'str', 
     'operating_cost': np.float64, # IN REALITY INT; BUT EASIER THIS WAY
-    #'estimate_price' # Parsed to int using converters later
-    #'estimate_low'  # Parsed to int using converters later
-    #'estimate_high'  # Parsed to int using converters later
+    # Prices are stored as integers by the pipeline, as float for missing values
+    'estimate_price': np.float64,
+    'estimate_low': np.float64,
+    'estimate_high': np.float64,
     'listing_agent': 'str',
     'listing_agency_name': 'str', 
     'listing_agency_URL': 'str', 
     'listing_days_active': np.uint32,
     'listing_sold_date': 'str', 
     'listing_sold_price_type': 'str', 
-    #'listing_sold_price'  # Parsed to int using converters later
-    #'listing_listed_price' # Parsed to int using converters later
-    'polygon_id': 'str',
-    'polygon_name': 'str'
-    
+    'listing_sold_price': np.float64,
+    'listing_listed_price': np.float64,
+    **POLYGON_LAYER_DTYPES
 }
 
-def parse_price_string(x):
-    price = re.sub(" (kr)?", "", x)
-    if price != "":
-        return int(float(price))
-    else:
-        return None
-
-# Change price to be integer instead of formatted string
+# Align area names format somewhat
 CONVERTERS = {
-    c : lambda x : parse_price_string(x) for c in [
-        "estimate_price",
-        "estimate_low",
-        "estimate_high",
-        "listing_sold_price",
-        "listing_listed_price"
-    ]
+    "descriptive_area_name": lambda x : re.sub(" ?(-|/) ?", " ", x).title()
 }
 
-# Align area names format somewhat
-CONVERTERS["descriptive_area_name"] = lambda x : re.sub(" ?(-|/) ?", " ", x).title()
-
-df = pd.read_csv(os.path.join(DATA_DIR, "listings_data", "listings_data.csv"), 
-                 sep=";", 
-                 encoding="utf8", 
-                 dtype=DTYPES, 
-                 converters=CONVERTERS,
-                 parse_dates=["listing_sold_date"], 
-                 index_col=0, 
-                 low_memory=False)
-
-# Add a price per sqm column
-df = df.assign(listing_sold_price_per_sqm = (df["listing_sold_price"] / df["sqm"]).round(0))
-
-# Add a rent per sqm column
-df = df.assign(listing_rent_per_sqm = (df["rent"] / df["sqm"]).round(0))
+def load_listings_csv():
+    """ Parses listings_data.csv, which is slow. Only used if no snapshot has been built. """
+    df = pd.read_csv(os.path.join(DATA_DIR, "listings_data", "listings_data.csv"), 
+                     sep=";", 
+                     encoding="utf8", 
+                     dtype=DTYPES, 
+                     converters=CONVERTERS,
+                     parse_dates=["listing_sold_date"], 
+                     index_col=0, 
+                     low_memory=False)
+
+    # Polygons assigned incrementally by stage 7 are stored in a side table keyed by
+    # property_id, and take precedence over the columns in listings_data.csv
+    listing_polygons_csv = os.path.join(DATA_DIR, "listings_data", "listing_polygons.csv")
+    if os.path.isfile(listing_polygons_csv):
+        listing_polygons = pd.read_csv(listing_polygons_csv, 
+                                       sep=";", 
+                                       encoding="utf8", 
+                                       dtype={"property_id": np.uint32, **POLYGON_LAYER_DTYPES},
+                                       index_col="property_id")
+        listing_polygons = listing_polygons.drop(columns=["latitude", "longitude"])
+        df = df.drop(columns=listing_polygons.columns, errors="ignore")
+        df = df.join(listing_polygons, on="property_id")
+
+    return df
+
+# Columns used by the dashboard. When loading from a snapshot, all other (cold)
+# columns are left on disk and only loaded on demand by get_cold_column.
+HOT_COLUMNS = [
+    'property_id',
+    'address',
+    'latitude',
+    'longitude',
+    'construction_year',
+    'energy_class',
+    'brf_name',
+    'rent',
+    'rooms',
+    'sqm',
+    'primary_area',
+    'listing_agency_name',
+    'listing_sold_date',
+    'listing_sold_price',
+    'listing_sold_price_per_sqm',
+    'listing_rent_per_sqm',
+    *POLYGON_LAYER_DTYPES,
+    *[f"hex_{size}" for _, size in HEX_ZOOM_LEVELS]
+]
+
+# Narrower dtypes where the value range allows, for data loaded from the CSV.
+# Prices as float32 are exact up to 16 777 216 kr, and within a krona up to
+# twice that. The snapshot is loaded in the dtypes it was stored with by the
+# pipeline (COMPACT_DTYPES in 8_build_dashboard_snapshot.py, recorded in its
+# meta.json), so that its columns are used without copying them.
+COMPACT_DTYPES = {
+    'construction_year': np.float32,
+    'rent': np.float32,
+    'rooms': np.float32,
+    'sqm': np.float32,
+    'operating_cost': np.float32,
+    'listing_days_active': np.uint16,
+    'estimate_price': np.float32,
+    'estimate_low': np.float32,
+    'estimate_high': np.float32,
+    'listing_sold_price': np.float32,
+    'listing_listed_price': np.float32,
+    'listing_sold_price_per_sqm': np.float32,
+    'listing_rent_per_sqm': np.float32,
+}
+
+# String columns with at most this many distinct values per row are categorical
+MAX_CATEGORY_RATIO = 0.5
+
+# How often (in seconds) to check for a new snapshot version built by the pipeline
+RELOAD_INTERVAL = 60
+
+# Bitmap index for the additional filters, binned by the given edges. The
+# edges are also the steps of the corresponding sliders in the app.
+BITMAP_NUMERIC_FIELDS = {
+    "listing_sold_price_per_sqm": np.arange(0, 200_001, 10_000),
+    "sqm": np.arange(0, 201, 10),
+    "construction_year": np.arange(1850, 2031, 10),
+}
+BITMAP_CATEGORICAL_FIELDS = [
+    *[f"{prefix}_name" for prefix in POLYGON_LAYERS],
+    "listing_agency_name",
+    "energy_class"
+]
+
+# Sums and counts per polygon, sold month and room bucket, one cube per polygon
+# layer, for the choropleth. The coordinates are used for centering the map.
+CUBE_COLUMNS = [
+    "listing_sold_price_per_sqm",
+    "construction_year",
+    "listing_rent_per_sqm",
+    "latitude",
+    "longitude"
+]
+# Bin widths of the histogram sketches of the plotted columns in the cube, for
+# quantiles such as the colorbar range and medians. Quantiles are accurate to
+# half a bin width.
+SKETCH_BIN_WIDTHS = {
+    "listing_sold_price_per_sqm": 250,
+    "construction_year": 1,
+    "listing_rent_per_sqm": 1
+}
+
+# Sums and counts per hex cell, sold month and room bucket, one cube per cell
+# size, for the hexbin plot, with the same sketches as the aggregate cubes
+HEX_CUBE_COLUMNS = [
+    "listing_sold_price_per_sqm",
+    "construction_year",
+    "listing_rent_per_sqm"
+]
+
+# Distance (metres) within which comparable sales are looked for
+COMPARABLES_MAX_DISTANCE = 3000
+
+# Name of the repeat-sales index of all listings, next to those per polygon
+ALL_AREAS = "All areas"
+
+def dataset_version():
+    """ 
+    Identifies the data to load: the current snapshot version, or if no 
+    snapshot has been built the modification times of the CSV files. 
+    Cached figures and tiles are keyed on it, so those of other data are 
+    never used.
+    """
+    version = current_version(SNAPSHOT_DIR)
+    if version is not None:
+        return f"snapshot {version}"
+
+    return "csv " + " ".join(
+        str(os.path.getmtime(path)) for path in [
+            os.path.join(DATA_DIR, "listings_data", "listings_data.csv"),
+            os.path.join(DATA_DIR, "listings_data", "listing_polygons.csv")
+        ] if os.path.isfile(path)
+    )
+
+@timed("dataset.load")
+def load_dataset(version):
+    """ Loads the data of version, as returned by dataset_version, as a Dataset. """
+    # Load the typed snapshot built by the pipeline, falling back to the CSV
+    if version.startswith("snapshot "):
+        snapshot_dir = os.path.join(SNAPSHOT_DIR, version[len("snapshot "):])
+        df = load_snapshot(
+            snapshot_dir, 
+            columns=[c for c in HOT_COLUMNS if c in read_meta(snapshot_dir)["columns"]],
+            max_category_ratio=MAX_CATEGORY_RATIO
+        )
+    else:
+        snapshot_dir = None
+        # Positions in df are used as row numbers of the indexes, not its index
+        df = load_listings_csv().reset_index(drop=True)
+
+        # Add a price per sqm column
+        df = df.assign(listing_sold_price_per_sqm = (df["listing_sold_price"] / df["sqm"]).round(0))
+
+        # Add a rent per sqm column
+        df = df.assign(listing_rent_per_sqm = (df["rent"] / df["sqm"]).round(0))
+
+        df = compact(df, COMPACT_DTYPES, MAX_CATEGORY_RATIO)
+
+    # The snapshot is already sorted by sold date (missing dates last), which the
+    # query index relies on. Sorting a snapshot would copy it into this process.
+    sold_dates = df["listing_sold_date"].values
+    n_dated = len(sold_dates) - np.isnat(sold_dates).sum()
+    if np.isnat(sold_dates[:n_dated]).any() or (np.diff(sold_dates[:n_dated].view(np.int64)) < 0).any():
+        df = df.sort_values("listing_sold_date", kind="mergesort", na_position="last").reset_index(drop=True)
+
+    logging.info(f"Loaded {len(df)} listings of {version}, memory usage per column:\n" + memory_report(df))
+
+    return Dataset(df, version, snapshot_dir)
+
+class Dataset(object):
+    """ 
+    The listings of one version of the data, the indexes and aggregate cubes
+    built from them, and the queries answered from these.
+    """
+    def __init__(self, df, version, snapshot_dir=None):
+        """ snapshot_dir is the snapshot version directory df was loaded from, if any. """
+        self.df = df
+        self.version = version
+        self.snapshot_dir = snapshot_dir
+
+        # Coordinates of the listings for the map tiles
+        self.mercator_x, self.mercator_y = to_web_mercator(df["longitude"].values, df["latitude"].values)
+
+        # Fixed random order of the listings for sampling the scatterplot, so that the
+        # same listings are shown when the map is moved
+        self.sample_priority = np.random.default_rng(0).random(len(df)).astype(np.float32)
+
+        # Index for answering the sidebar filters
+        self.query_index = QueryIndex(df["listing_sold_date"].values, df["rooms"].values)
+
+        self.bitmap_index = BitmapIndex(df, BITMAP_NUMERIC_FIELDS, BITMAP_CATEGORICAL_FIELDS)
+        logging.info(f"Built bitmap index using {self.bitmap_index.nbytes():,} bytes")
+
+        self.aggregate_cubes = {}
+        for prefix in POLYGON_LAYERS:
+            self.aggregate_cubes[prefix] = AggregateCube(CUBE_COLUMNS, SKETCH_BIN_WIDTHS)
+            self.aggregate_cubes[prefix].add(
+                df[f"{prefix}_name"].values,
+                df["listing_sold_date"].values,
+                self.query_index.room_buckets(),
+                {c: df[c].values for c in CUBE_COLUMNS}
+            )
+            logging.info(f"Built aggregate cube for {prefix} with {len(self.aggregate_cubes[prefix])} cells " + 
+                         f"using {self.aggregate_cubes[prefix].nbytes():,} bytes")
+
+        # Hex cells of the listings at each size, assigned by the pipeline, or here
+        # for data without them (from the CSV, or a snapshot of another grid format)
+        self.hex_cells = {}
+        self.hex_cubes = {}
+        snapshot_sizes = snapshot_cell_sizes(read_meta(snapshot_dir)) if snapshot_dir is not None else set()
+        for _, size in HEX_ZOOM_LEVELS:
+            name = f"hex_{size}"
+            if name in df.columns and size in snapshot_sizes:
+                self.hex_cells[size] = df[name].values
+            else:
+                if name in df.columns:
+                    logging.warning(f"Hex cells {name} of the snapshot are of another grid format, assigning them again")
+                self.hex_cells[size] = cell_ids(self.mercator_x, self.mercator_y, size)
+            self.hex_cubes[size] = HexCube(size, HEX_CUBE_COLUMNS, SKETCH_BIN_WIDTHS)
+            self.hex_cubes[size].add(
+                self.hex_cells[size],
+                df["listing_sold_date"].values,
+                self.query_index.room_buckets(),
+                {c: df[c].values for c in HEX_CUBE_COLUMNS}
+            )
+            logging.info(f"Built hex cube of size {size} with {len(self.hex_cubes[size])} entries " + 
+                         f"using {self.hex_cubes[size].nbytes():,} bytes")
+
+        # KD-tree of the listing coordinates for the comparable sales
+        self.comparables_index = ComparablesIndex(df["longitude"].values, df["latitude"].values)
+        logging.info(f"Built comparables index using {self.comparables_index.nbytes():,} bytes")
+
+        # Repeat-sales indexes per polygon layer, fitted here, off the request path
+        self.repeat_sales_indexes = {
+            prefix: self.fit_repeat_sales_index(prefix) for prefix in POLYGON_LAYERS
+        }
+
+        # Trend aggregates per polygon layer, loaded once they have been built
+        self.trend_aggregates = {}
+
+    def get_cold_column(self, name, index=None):
+        """ 
+        Returns a column that is not kept in df, for the rows in index (all rows if
+        None). Only the pages of the memory-mapped snapshot holding them are read.
+        """
+        if name in self.df.columns:
+            return self.df[name] if index is None else self.df.loc[index, name]
+
+        values = load_column(self.snapshot_dir, name)
+        if index is None:
+            return pd.Series(values, index=self.df.index, name=name)
+        return pd.Series(values[np.asarray(index)], index=index, name=name)
+
+    def filter_options(self, column):
+        """ Sorted values of a categorical filter column, for dropdown options. """
+        return sorted(self.df[column].dropna().unique())
+
+    def query_rows(self, date_range, n_rooms_range, filter_expression=None):
+        """ 
+        Returns the positions in df of the listings matching the filters, where
+        filter_expression is an expression from bitmap_index (or None), as a 
+        slice if no listings in the date range are filtered out.
+        """
+        rows = self.query_index.query(date_range, n_rooms_range)
+
+        if filter_expression is not None:
+            mask = self.bitmap_index.mask(self.bitmap_index.evaluate(filter_expression), rows)
+            if isinstance(rows, slice):
+                rows = rows if mask.all() else rows.start + np.flatnonzero(mask)
+            else:
+                rows = rows[mask]
+
+        return rows
+
+    @timed("query.query_df")
+    def query_df(self, date_range, n_rooms_range, filter_expression=None):
+        """ 
+        Returns the listings matching the filters, as in query_rows. If it is a 
+        slice this is a slice of df without copying, otherwise only the matching
+        rows are copied.
+        """
+        return self.df.iloc[self.query_rows(date_range, n_rooms_range, filter_expression)]
+
+    @timed("query.viewport_sample")
+    def viewport_sample(self, rows, viewport=None, max_points=None):
+        """
+        Returns the listings at rows (positions in df, as from query_rows) within
+        viewport, given as (lon_min, lon_max, lat_min, lat_max), or all if None,
+        and the number of such listings. If there are more than max_points, only
+        a spatial grid sample of max_points of them is returned.
+        """
+        positions = np.arange(len(self.df))[rows]
+        if viewport is not None:
+            lon_min, lon_max, lat_min, lat_max = viewport
+            longitudes = self.df["longitude"].values[positions]
+            latitudes = self.df["latitude"].values[positions]
+            positions = positions[
+                (longitudes >= lon_min) & (longitudes <= lon_max) & (latitudes >= lat_min) & (latitudes <= lat_max)
+            ]
+
+        n = len(positions)
+        if max_points is not None and n > max_points:
+            positions = positions[grid_sample(
+                self.mercator_x[positions], 
+                self.mercator_y[positions], 
+                self.sample_priority[positions], 
+                max_points
+            )]
+
+        return self.df.iloc[positions], n
+
+    def split_months(self, date_range):
+        """
+        Splits date_range into the whole months in it, which can be answered by
+        the aggregate cubes, and the rest. Returns the first and stop month of 
+        the whole months (equal if there are none), and slices of df with the 
+        listings in the date range that are not in those months.
+        """
+        # Months from the first one starting after the start date, up to the
+        # one the end date is in, are entirely in the date range
+        first_month = np.datetime64(date_range[0], "ns").astype("datetime64[M]") + 1
+        stop_month = np.datetime64(date_range[1], "ns").astype("datetime64[M]")
+        rows = self.query_index.date_slice(*date_range)
+        if first_month >= stop_month:
+            return first_month, first_month, [rows]
+
+        start, stop = np.searchsorted(
+            self.query_index.sold_dates, np.array([first_month, stop_month], dtype="datetime64[ns]")
+        )
+        return first_month, stop_month, [slice(rows.start, start), slice(stop, rows.stop)]
+
+    def edge_positions(self, edge_rows, n_rooms_range):
+        """ Positions in df of the listings in the slices of df from split_months matching n_rooms_range. """
+        return np.concatenate([
+            r.start + np.flatnonzero(self.query_index.rooms_mask(r, n_rooms_range)) for r in edge_rows
+        ])
+
+    def edge_listings(self, edge_rows, n_rooms_range):
+        """ Listings in the slices of df from split_months matching n_rooms_range. """
+        return self.df.iloc[self.edge_positions(edge_rows, n_rooms_range)]
+
+    @timed("query.colorbar_range")
+    def colorbar_range(self, date_range, n_rooms_range, target_col, filter_expression=None, percentile_range=[1,99]):
+        """
+        Returns the percentile_range percentiles of target_col for the listings
+        matching the filters. The whole months in the date range are answered by
+        merging the histogram sketches of the aggregate cube, so only the listings
+        in the months at either end are read, unless there is a filter_expression.
+        """
+        cube = self.aggregate_cubes[next(iter(POLYGON_LAYERS))]
+        bucket_range = self.query_index.bucket_range(n_rooms_range)
+        q = np.array(percentile_range) / 100
+
+        if filter_expression is not None or bucket_range is None:
+            values = self.query_df(date_range, n_rooms_range, filter_expression)[target_col].dropna()
+            span = np.percentile(values, percentile_range) if len(values) > 0 else [np.nan, np.nan]
+        else:
+            first_month, stop_month, edge_rows = self.split_months(date_range)
+            _, bins, counts = cube.sketch(target_col, first_month, stop_month, *bucket_range)
+            _, edge_bins, edge_counts = cube.sketch_rows(
+                target_col, None, self.edge_listings(edge_rows, n_rooms_range)[target_col].values
+            )
+            span = quantiles(
+                np.concatenate([bins, edge_bins]), 
+                np.concatenate([counts, edge_counts]), 
+                q, 
+                SKETCH_BIN_WIDTHS[target_col]
+            )
+
+        if np.isnan(span).any():
+            return [0, 1] # No listings
+        return [float(v) for v in span]
+
+    @timed("query.polygon_averages")
+    def polygon_averages(self, date_range, n_rooms_range, target_col, polygon_layer="polygon", filter_expression=None,
+                         statistic="mean"):
+        """
+        Returns the mean (or median, if statistic is "median") of target_col per 
+        polygon of polygon_layer for the listings matching the filters, as a 
+        DataFrame, and the average coordinates of the listings. Whole months in 
+        the date range are summed from the aggregate cube, and only the listings 
+        in the months at either end of the range are aggregated individually. The 
+        cube can't answer the bitmap index filters, so with a filter_expression 
+        all matching listings are aggregated. Medians are computed from the 
+        histogram sketches of the cube.
+        """
+        name_col = f"{polygon_layer}_name"
+        columns = [target_col, "latitude", "longitude"]
+        cube = self.aggregate_cubes[polygon_layer]
+        bucket_range = self.query_index.bucket_range(n_rooms_range)
+
+        if filter_expression is not None or bucket_range is None:
+            rows_df = self.query_df(date_range, n_rooms_range, filter_expression)
+            n_rows, sums, counts = cube.aggregate_rows(rows_df[name_col].values, rows_df, columns)
+            sketch = cube.sketch_rows(target_col, rows_df[name_col].values, rows_df[target_col].values) \
+                if statistic == "median" else None
+        else:
+            first_month, stop_month, edge_rows = self.split_months(date_range)
+            n_rows, sums, counts = cube.aggregate(first_month, stop_month, *bucket_range, columns=columns)
+            sketch = cube.sketch(target_col, first_month, stop_month, *bucket_range) \
+                if statistic == "median" else None
+
+            edge_df = self.edge_listings(edge_rows, n_rooms_range)
+            edge_n_rows, edge_sums, edge_counts = cube.aggregate_rows(edge_df[name_col].values, edge_df, columns)
+            n_rows = n_rows + edge_n_rows
+            for c in columns:
+                sums[c] = sums[c] + edge_sums[c]
+                counts[c] = counts[c] + edge_counts[c]
+            if statistic == "median":
+                edge_sketch = cube.sketch_rows(target_col, edge_df[name_col].values, edge_df[target_col].values)
+                sketch = [np.concatenate([a, b]) for a, b in zip(sketch, edge_sketch)]
+
+        # Code 0 is the listings without polygon, which only count for the center
+        present = np.flatnonzero(n_rows[1:] > 0) + 1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if statistic == "median":
+                values = group_quantiles(*sketch, 0.5, SKETCH_BIN_WIDTHS[target_col], len(n_rows))
+            else:
+                values = sums[target_col] / counts[target_col]
+
+            plot_df = pd.DataFrame({
+                name_col: np.array(cube.polygon_names, dtype=object)[present - 1],
+                target_col: values[present]
+            })
+            center = dict(
+                lat=sums["latitude"].sum() / counts["latitude"].sum(),
+                lon=sums["longitude"].sum() / counts["longitude"].sum()
+            )
+
+        return plot_df.sort_values(name_col, ignore_index=True), center
+
+    @timed("query.hex_averages")
+    def hex_averages(self, date_range, n_rooms_range, target_cols, level, viewport=None, filter_expression=None,
+                     statistic="mean"):
+        """
+        Returns the mean (or median, if statistic is "median") of each of 
+        target_cols per hex cell of HEX_ZOOM_LEVELS[level] within viewport 
+        (lon_min, lon_max, lat_min, lat_max, all cells if None) for the 
+        listings matching the filters, as a DataFrame of the packed cells, 
+        their number of listings and a column per target column, and the 
+        center of the listings. As in polygon_averages, whole months are 
+        summed from the hex cube and only the listings at either end of the
+        date range, or all with a filter_expression, are aggregated 
+        individually. Only the cells in view are read from the cube.
+        """
+        size = HEX_ZOOM_LEVELS[level][1]
+        cube = self.hex_cubes[size]
+        bucket_range = self.query_index.bucket_range(n_rooms_range)
+        ranges = None
+        if viewport is not None:
+            lon_min, lon_max, lat_min, lat_max = viewport
+            x, y = to_web_mercator([lon_min, lon_max], [lat_min, lat_max])
+            ranges = view_ranges((x[0], x[1], y[0], y[1]), size)
+
+        if filter_expression is not None or bucket_range is None:
+            rows = self.query_rows(date_range, n_rooms_range, filter_expression)
+            rows_df = self.df.iloc[rows]
+            row_cells = self.hex_cells[size][rows]
+            cells, n_rows, sums, counts = cube.aggregate_rows(row_cells, rows_df, ranges, target_cols)
+            sketches = {
+                c: cube.sketch_rows(c, row_cells, rows_df[c].values, ranges) for c in target_cols
+            } if statistic == "median" else None
+        else:
+            first_month, stop_month, edge_rows = self.split_months(date_range)
+            edge_positions = self.edge_positions(edge_rows, n_rooms_range)
+            edge_df = self.df.iloc[edge_positions]
+            edge_cells = self.hex_cells[size][edge_positions]
+            cells, n_rows, sums, counts = merge_cells([
+                cube.aggregate(ranges, first_month, stop_month, *bucket_range, columns=target_cols),
+                cube.aggregate_rows(edge_cells, edge_df, ranges, target_cols)
+            ], target_cols)
+            sketches = {
+                c: [np.concatenate(parts) for parts in zip(
+                    cube.sketch(c, ranges, first_month, stop_month, *bucket_range),
+                    cube.sketch_rows(c, edge_cells, edge_df[c].values, ranges)
+                )]
+                for c in target_cols
+            } if statistic == "median" else None
+
+        plot_df = pd.DataFrame({"cell": cells, "n_listings": n_rows})
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for c in target_cols:
+                if statistic == "median":
+                    sketch_cells, bins, bin_counts = sketches[c]
+                    plot_df[c] = group_quantiles(
+                        np.searchsorted(cells, sketch_cells), bins, bin_counts, 0.5, SKETCH_BIN_WIDTHS[c], len(cells)
+                    )
+                else:
+                    plot_df[c] = sums[c] / counts[c]
+
+        # The center of the cells, weighted by their listings
+        x, y = cell_centers(cells, size)
+        center_x, center_y = (np.average(x, weights=n_rows), np.average(y, weights=n_rows)) if n_rows.sum() > 0 \
+            else (np.nan, np.nan)
+        center = dict(
+            lat=float(np.degrees(2 * np.arctan(np.exp(center_y / EARTH_RADIUS)) - np.pi / 2)),
+            lon=float(np.degrees(center_x / EARTH_RADIUS))
+        )
+
+        return plot_df, center
+
+    @timed("query.nearest_comparables")
+    def nearest_comparables(self, lon, lat, k=10, n_rooms_range=None, sqm_range=None, months=12,
+                            max_distance=COMPARABLES_MAX_DISTANCE, property_ids=None):
+        """
+        The k nearest sales to each of the locations lon, lat (arrays) within
+        max_distance metres, with n_rooms_range rooms (as the room slider, any
+        if None) and a living area in sqm_range ((low, high), where None is
+        unbounded), sold in the last months months of the data. If the
+        locations are listings, property_ids has their property_id, and sales
+        of the same property are not comparables of them. Returns a 
+        DataFrame of the comparables of each location, nearest first and with
+        their distance in metres, and an array of the median price per sqm of
+        the comparables of each location as its estimate (NaN if none).
+        """
+        # The listings sold last are at the end, as df is sorted by sold date
+        sold_dates = self.query_index.sold_dates
+        if len(sold_dates) > 0:
+            latest = pd.Timestamp(sold_dates[-1])
+            rows = self.query_index.date_slice(latest - pd.DateOffset(months=months), latest + pd.Timedelta(1))
+        else:
+            rows = slice(0, 0)
+
+        # Comparable listings have a price per sqm, and the rooms and area asked for
+        mask = ~np.isnan(self.df["listing_sold_price_per_sqm"].values[rows])
+        if n_rooms_range is not None:
+            mask &= self.query_index.rooms_mask(rows, n_rooms_range)
+        low, high = sqm_range if sqm_range is not None else (None, None)
+        sqm = self.df["sqm"].values[rows]
+        if low is not None:
+            mask &= sqm >= low
+        if high is not None:
+            mask &= sqm <= high
+        comparable = np.zeros(len(self.df), dtype=bool)
+        comparable[rows] = mask
+
+        if property_ids is None:
+            positions, distances = self.comparables_index.query(lon, lat, k, comparable, max_distance)
+        else:
+            positions, distances = self.comparables_index.query_others(
+                lon, lat, k, self.df["property_id"].values, property_ids, comparable, max_distance
+            )
+
+        # The comparables of all locations are taken from df at once, and then split
+        columns = ["address", "rooms", "sqm", "listing_sold_date", "listing_sold_price", "listing_sold_price_per_sqm"]
+        found = positions >= 0
+        comparables_df = self.df.iloc[positions[found]][columns].assign(distance=distances[found])
+        stops = np.cumsum(found.sum(axis=1))
+        comparables = [comparables_df.iloc[stop - n:stop] for n, stop in zip(found.sum(axis=1), stops)]
+
+        prices = np.where(found, self.df["listing_sold_price_per_sqm"].values[np.maximum(positions, 0)], np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # Locations without comparables
+            estimates = np.nanmedian(prices.astype(np.float64), axis=1)
+
+        return comparables, estimates
+
+    def repeat_sales_index(self, polygon_layer="polygon"):
+        """
+        Repeat-sales price index per polygon of polygon_layer and month, and of
+        all listings as ALL_AREAS, as a DataFrame with the area, month, index
+        (100 in the first month of each area), log index and number of sales in
+        pairs. Fitted per layer when this version of the data is loaded, by one
+        solve for all areas, see repeat_sales.
+        """
+        return self.repeat_sales_indexes[polygon_layer]
+
+    @timed("query.fit_repeat_sales_index")
+    def fit_repeat_sales_index(self, polygon_layer):
+        start = time.time()
+        codes, areas = pd.factorize(self.df[f"{polygon_layer}_name"])
+        pairs = sale_pairs(
+            self.df["property_id"].values,
+            self.df["listing_sold_date"].values,
+            self.df["listing_sold_price"].values,
+            codes
+        )
+
+        # The index of all listings is one more group, in the same solve
+        index_df = fit_index(pd.concat([pairs, pairs.assign(group=len(areas))], ignore_index=True))
+        index_df.insert(0, "area", np.append(np.asarray(areas, dtype=object), ALL_AREAS)[index_df["group"].values])
+        index_df.insert(3, "index", 100 * np.exp(index_df["log_index"]))
+
+        logging.info(f"Fitted repeat-sales index of {polygon_layer} from {len(pairs):,} sale pairs " + 
+                     f"in {time.time() - start:.2f} seconds")
+        return index_df.drop(columns="group")
+
+    def trends(self, polygon_layer="polygon"):
+        """
+        Rolling aggregates of polygon_layer for the snapshot version of this
+        data, as TrendAggregates, or None if they have not been built (yet).
+        Stage 9 of the pipeline builds them after the snapshot, so they are
+        looked for again until found.
+        """
+        if polygon_layer not in self.trend_aggregates:
+            if self.snapshot_dir is None:
+                return None
+            directory = os.path.join(TREND_AGGREGATES_DIR, os.path.basename(self.snapshot_dir), polygon_layer)
+            if not trends_exist(directory):
+                return None
+            self.trend_aggregates[polygon_layer] = TrendAggregates(directory)
+        return self.trend_aggregates[polygon_layer]
+
+    @timed("tile.render")
+    def listing_tile(self, date_range, n_rooms_range, filter_expression, target_col, span, z, x, y):
+        """ PNG of tile x, y at zoom z of the mean of target_col for the listings matching the filters. """
+        rows = np.arange(len(self.df))[self.query_rows(date_range, n_rooms_range, filter_expression)]
+
+        # Only aggregate the listings within the tile
+        x_min, x_max, y_min, y_max = bounds = tile_bounds(z, x, y)
+        tile_x, tile_y = self.mercator_x[rows], self.mercator_y[rows]
+        inside = (tile_x >= x_min) & (tile_x <= x_max) & (tile_y >= y_min) & (tile_y <= y_max)
+        rows = rows[inside]
+
+        return render_tile(
+            tile_x[inside], 
+            tile_y[inside], 
+            self.df[target_col].values[rows].astype(np.float64), 
+            bounds, 
+            span, 
+            COLORMAP_CMAP
+        )
+
+
+# The data of the current version, loaded on first use. It is swapped to new
+# versions in the background from then on; get it once per request with current_dataset.
+reloader = HotReloader(dataset_version, load_dataset, interval=RELOAD_INTERVAL)
+
+def current_dataset():
+    reloader.start()
+    return reloader.current
 # --------------------------------------------------------
 
-def query_df(date_range, n_rooms_range):
-    filtered_df = df.copy()
-    # Apply date range
-    filtered_df = filtered_df[filtered_df["listing_sold_date"] > date_range[0]]
-    filtered_df = filtered_df[filtered_df["listing_sold_date"] < date_range[1]]
-
-    # Apply n_rooms range
-    filtered_df = filtered_df[filtered_df["rooms"] > n_rooms_range[0]]
-    if n_rooms_range[1] < 5: # 5 is displayed as 5+ to the user, i.e. no upper limit
-        filtered_df = filtered_df[filtered_df["rooms"] < n_rooms_range[1]]
-
-    return filtered_df
-
-def choropleth(choropleth_df, target_col="listing_sold_price_per_sqm", target_col_desc = 'Price per m²'):
-    # Settings to use for plot
-    plot_df = (choropleth_df.groupby('polygon_name')[target_col].mean()).reset_index()
-    color = "IceFire"
-    #range_color = (40, 140)
-    
-    # Prepare polygon data
-    with open(os.path.join(DATA_DIR, "area_polygons", "polygons.geojson"), encoding='utf-8') as f:
-        polygon_data = json.load(f)
-    for f in polygon_data['features']:
-        f['id'] = str(f['properties']['NAMN'])
-
-    fig = px.choropleth_mapbox(
-        plot_df,
-        geojson=polygon_data,
-        locations='polygon_name',
-        color=target_col,
-        color_continuous_scale=color,
-        #range_color=range_color, 
-        #mapbox_style="carto-positron",
-        mapbox_style="dark",
-        center=dict(lat=choropleth_df["latitude"].mean(), lon=choropleth_df["longitude"].mean()), 
-        zoom=10,
-        opacity=0.5,
-        labels={'polygon_name':'Område', target_col:target_col_desc}
+# Colorscales of the plot types. The colormap tiles are colored by COLORMAP_CMAP,
+# and COLORMAP_COLORSCALE has the same colors, for the colorbar.
+SCATTER_COLORSCALE = make_colorscale(px.colors.sequential.Plasma)
+CHOROPLETH_COLORSCALE = make_colorscale(px.colors.cyclical.IceFire)
+COLORMAP_CMAP = cc.bmy
+COLORMAP_COLORSCALE = [[i / 10, cc.bmy[round(i * (len(cc.bmy) - 1) / 10)]] for i in range(11)]
+
+def map_base(descriptions, geometry_url):
+    """ 
+    The parts of the map figure that never change, sent once with the page:
+    the descriptions of the data selections, the layout template, mapbox
+    settings, colorscales, and the URLs of the polygons of each layer per 
+    level of detail, from geometry_url(prefix, level).
+    """
+    return {
+        "descriptions": descriptions,
+        "template": pio.templates["plotly_dark"].to_plotly_json(),
+        "mapbox": {"style": "dark", "accesstoken": mapbox_access_token()},
+        "colorscales": {
+            "scatter": SCATTER_COLORSCALE,
+            "choropleth": CHOROPLETH_COLORSCALE,
+            "colormap": COLORMAP_COLORSCALE
+        },
+        "geometry_urls": {
+            prefix: [geometry_url(prefix, level) for level in range(len(GEOMETRY_ZOOM_LEVELS))]
+            for prefix in POLYGON_LAYERS
+        }
+    }
+
+def encode_array(values, dtype):
+    """ Array as base64 of its little-endian bytes, which assets/map_figure.js decodes to a typed array. """
+    data = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder("<")).tobytes()
+    return {"dtype": dtype, "data": base64.b64encode(data).decode("ascii")}
+
+def serialize_map_data(data):
+    """ JSON of map data, with NaN as null. """
+    return json.dumps(data, cls=PlotlyJSONEncoder)
+
+# The map data below is what the map callback sends. The figure is built from
+# it, and from map_base, in the browser by assets/map_figure.js. Values are
+# included for every data selection, so that changing it only recolors the map.
+
+@timed("figure.price_index")
+def price_index_figure(index_df, areas):
+    """ Line chart of the repeat-sales index of each of areas, from index_df as from repeat_sales_index. """
+    fig = px.line(
+        index_df[index_df["area"].isin(areas)],
+        x="month",
+        y="index",
+        color="area",
+        hover_data=["n_sales"],
+        labels={"month": "Month", "index": "Index", "area": "Area", "n_sales": "Sales in pairs"},
+        template="plotly_dark"
     )
-    
     fig.update_layout(
-        margin=dict(l = 0, r = 0, t = 0, b = 0),
-        template="plotly_dark", # For dark colorbar as well
-        mapbox_accesstoken=mapbox_accesstoken
+        margin=dict(l=0, r=0, t=0, b=0),
+        legend=dict(orientation="h", title_text=""),
+        yaxis_title="Index (first month = 100)"
     )
-
     return fig
 
-def scatterplot(scatter_df, target_col="listing_sold_price_per_sqm", 
-                target_col_desc = 'Price per m²', colorbar_percentile_range=[1,99]):
-
-    scatter_df = scatter_df[scatter_df[target_col].notna()]
-
-    range_color = [ # Avoid extreme values to get higher constrast
-        np.percentile(scatter_df[target_col], colorbar_percentile_range[0]), 
-        np.percentile(scatter_df[target_col], colorbar_percentile_range[1])
-    ]
-
-    fig = px.scatter_mapbox(
-        scatter_df, 
-        lat='latitude', 
-        lon='longitude',
-        color=target_col,
-        range_color=range_color,
-        zoom=12,
-        hover_name=scatter_df.address,
-        hover_data={
-            target_col_desc: scatter_df[target_col],
-            "Sold date": scatter_df["listing_sold_date"].apply(lambda x: x.strftime("%Y-%m-%d")),
-            "latitude": False,
-            "longitude": False,
-            target_col: False
-        }
-    )
+# Statistics of the trend aggregates: (description, format of the hover value)
+TREND_STATISTICS = {
+    "median": ("Median price per m²", ",.0f"),
+    "mean": ("Mean price per m²", ",.0f"),
+    "count": ("Listings sold", ",d"),
+    "days_active": ("Mean days active", ",.0f")
+}
+
+@timed("figure.trend")
+def trend_figure(trends, areas, room_bucket, window, statistic):
+    """ 
+    Line chart of statistic over window months for each of areas, from trends
+    as from Dataset.trends, which shows a note instead if trends is None.
+    """
+    description, value_format = TREND_STATISTICS[statistic]
+    fig = go.Figure()
+    if trends is None:
+        fig.add_annotation(text="No trend aggregates have been built for this data", showarrow=False)
+        areas = []
+
+    for area in areas:
+        values = trends.series(statistic, window, area, room_bucket)
+        if values is not None:
+            fig.add_trace(go.Scatter(
+                x=trends.months.astype("datetime64[D]"),
+                y=np.asarray(values),
+                mode="lines",
+                name=area,
+                hovertemplate=f"%{{y:{value_format}}}"
+            ))
 
     fig.update_layout(
-        mapbox_style="dark",#"stamen-terrain",#"carto-darkmatter",
-        margin=dict(l = 0, r = 0, t = 0, b = 0),
-        template="plotly_dark", # For dark colorbar as well
-        mapbox_accesstoken=mapbox_accesstoken,
+        template="plotly_dark",
+        margin=dict(l=0, r=0, t=0, b=0),
+        legend=dict(orientation="h"),
+        hovermode="x unified",
+        yaxis_title=f"{description}, {window} months"
     )
-
     return fig
 
-def colormap(colormap_df, target_col="listing_sold_price_per_sqm", target_col_desc = 'Price per m²'):
-    # Make sure grid pixels are close to quadratic
-    d_long = colormap_df["longitude"].max() - colormap_df["longitude"].min()
-    d_lat = colormap_df["latitude"].max() - colormap_df["latitude"].min()
-
-    canvases = [
-        # canvas, minzoom, maxzoom
-        (ds.Canvas(plot_width=int(d_long*500), plot_height=int(d_lat*500)),0,24),
-        #(ds.Canvas(plot_width=int(d_long*150), plot_height=int(d_lat*150)),0,10),
-        #(ds.Canvas(plot_width=int(d_long*500), plot_height=int(d_lat*500)),10,12),
-        #(ds.Canvas(plot_width=int(d_long*1000), plot_height=int(d_lat*1000)),12,14),
-        #(ds.Canvas(plot_width=int(d_long*2000), plot_height=int(d_lat*2000)),14,24)
-    ]
-
-    images = []
-    for cvs, minzoom, maxzoom in canvases:
-        # Aggregate
-        agg = cvs.points(colormap_df, x="longitude", y="latitude", agg=ds.mean(column=target_col))
-
-        coords_lat, coords_long = agg.coords["latitude"].values, agg.coords["longitude"].values
-        coordinates = [[coords_long[0], coords_lat[-1]],
-                    [coords_long[-1], coords_lat[-1]],
-                    [coords_long[-1], coords_lat[0]],
-                    [coords_long[0], coords_lat[0]]]
-        img = ds.transfer_functions.shade(agg, cmap=cc.bmy).to_pil()
-        images.append((img, minzoom, maxzoom))
-
-    fig = px.scatter_mapbox(
-        colormap_df, 
-        lat='latitude', 
-        lon='longitude', 
-        zoom=12,
-        hover_name=colormap_df.address,
-        hover_data={
-            target_col_desc: colormap_df[target_col],
-            "Sold date": colormap_df["listing_sold_date"].apply(lambda x: x.strftime("%Y-%m-%d")),
-            "latitude": False,
-            "longitude": False
+@timed("data.choropleth")
+def choropleth_data(averages, center, polygon_layer="polygon", statistic="mean"):
+    """ 
+    averages maps each data selection to the polygon averages of its column,
+    as returned by polygon_averages with center, which all have the same 
+    polygons in the same order.
+    """
+    polygons = next(iter(averages.values())).iloc[:, 0]
+    return {
+        "plot_type": "choropleth",
+        "polygon_layer": polygon_layer,
+        "statistic": statistic,
+        "center": center,
+        "locations": polygons.tolist(),
+        "values": {selection: plot_df.iloc[:, 1].round(1).tolist() for selection, plot_df in averages.items()}
+    }
+
+@timed("data.hexbin")
+def hexbin_data(plot_df, targets, level, center, statistic="mean"):
+    """
+    plot_df has the hex cells at HEX_ZOOM_LEVELS[level] and the values of
+    each column in targets (by data selection) per cell, as returned by
+    hex_averages with center. The browser draws the hexagons from their 
+    axial coordinates, so only the cells in view are sent.
+    """
+    q, r = unpack_cells(plot_df["cell"].values)
+    return {
+        "plot_type": "hexbin",
+        "statistic": statistic,
+        "center": center,
+        "size": HEX_ZOOM_LEVELS[level][1],
+        "q": encode_array(q, "int32"),
+        "r": encode_array(r, "int32"),
+        "n_listings": encode_array(plot_df["n_listings"].values, "int32"),
+        "values": {
+            selection: encode_array(plot_df[column].values, "float32") for selection, column in targets.items()
         }
-    )
+    }
 
-    fig.update_layout(
-        mapbox_style="dark",#"stamen-terrain",#"carto-darkmatter",
-        margin=dict(l = 0, r = 0, t = 0, b = 0),
-        template="plotly_dark", # For dark colorbar as well
-        mapbox_accesstoken=mapbox_accesstoken,
-        mapbox_layers=[
-        {
-            "sourcetype": "image",
-            "source": img,
-            "coordinates": coordinates,
-            "opacity":0.7,
-            "maxzoom":maxzoom,
-            "minzoom":minzoom
-        } for img, minzoom, maxzoom in images]
-    )
+@timed("data.scatter")
+def scatter_data(scatter_df, targets, range_colors, center):
+    """ 
+    targets maps each data selection to its column in scatter_df, and
+    range_colors to the range of the colorbar. Listings without a value are
+    left out by the browser, per data selection.
+    """
+    address_codes, addresses = pd.factorize(scatter_df["address"])
+    sold_days = scatter_df["listing_sold_date"].values.astype("datetime64[D]").astype(np.int64)
+
+    return {
+        "plot_type": "scatter",
+        "center": center,
+        "lat": encode_array(scatter_df["latitude"].values, "float32"),
+        "lon": encode_array(scatter_df["longitude"].values, "float32"),
+        "values": {
+            selection: encode_array(scatter_df[column].values, "float32") for selection, column in targets.items()
+        },
+        "range_colors": range_colors,
+        "sold_days": encode_array(sold_days, "int32"),
+        "property_ids": encode_array(scatter_df["property_id"].values, "uint32"),
+        "address_codes": encode_array(address_codes, "int32"),
+        "addresses": list(addresses)
+    }
 
-    return fig
\ No newline at end of file
+@timed("data.colormap")
+def colormap_data(tile_urls, spans, center, uirevision=None):
+    """
+    tile_urls maps each data selection to an XYZ URL template of tiles served
+    by listing_tile, colored from span[0] to span[1] of the selection in spans.
+    """
+    return {
+        "plot_type": "colormap",
+        "center": center,
+        "tile_urls": tile_urls,
+        "spans": spans,
+        "uirevision": uirevision
+    }
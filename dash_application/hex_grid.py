@@ -0,0 +1,284 @@
+""" HEX GRID
+Hexagonal cells over the map, as an alternative to the irregular polygons of
+the choropleth. The grid is of pointy-top hexagons in Web Mercator metres,
+where size is the distance from the center of a cell to its corners, so that
+the cells are regular on the map. A cell is identified by its axial
+coordinates q, r (see https://www.redblobgames.com/grids/hexagons/), packed
+into one integer ordered by r and then q, so that a row of cells across the
+map view is a contiguous range of identifiers.
+
+The pipeline assigns the listings their cell at each size when building the
+dashboard snapshot (hex_cell_ids in 8_build_dashboard_snapshot.py, which
+must use the same grid and packing as here). It records the sizes and its
+grid format in the snapshot, and the cells of a snapshot are only used if
+its format is GRID_FORMAT, see snapshot_cell_sizes.
+
+The HexCube holds sums, counts and histogram sketches of listing values per
+cell, sold month and room bucket, like the AggregateCube does per polygon, but
+ordered by cell instead of by month. The cells in the map view are then a few
+slices of it, one per row of cells, so the work of aggregating them is bounded
+by the cells in view, not by the listings or all cells.
+"""
+
+import numpy as np
+from aggregate_cube import to_bins, merge_bins
+
+SQRT3 = np.sqrt(3)
+
+# Version of the grid and packing, HEX_GRID_FORMAT in 8_build_dashboard_snapshot.py.
+# Bump both whenever either changes.
+GRID_FORMAT = 1
+
+# Axial coordinates are offset to be non-negative and packed as r << AXIAL_BITS | q
+AXIAL_BITS = 31
+AXIAL_OFFSET = 1 << 30
+
+# Entries of the cube are identified by a key packing cell index, month and room bucket
+MONTH_BITS = 20
+BUCKET_BITS = 8
+CELL_SHIFT = MONTH_BITS + BUCKET_BITS
+
+
+def hex_cells(x, y, size):
+    """ Axial coordinates q, r of the cells of the given size containing the points x, y (Web Mercator). """
+    fractional_q = (SQRT3 / 3 * x - y / 3) / size
+    fractional_r = 2 / 3 * y / size
+    fractional_s = -fractional_q - fractional_r
+
+    # Round to the nearest cell in cube coordinates, where q + r + s = 0
+    q, r, s = np.round(fractional_q), np.round(fractional_r), np.round(fractional_s)
+    q_error, r_error, s_error = np.abs(q - fractional_q), np.abs(r - fractional_r), np.abs(s - fractional_s)
+    fix_q = (q_error > r_error) & (q_error > s_error)
+    fix_r = ~fix_q & (r_error > s_error)
+    return np.where(fix_q, -r - s, q), np.where(fix_r, -q - s, r)
+
+
+def pack_cells(q, r):
+    return ((np.asarray(r, dtype=np.int64) + AXIAL_OFFSET) << AXIAL_BITS) | \
+        (np.asarray(q, dtype=np.int64) + AXIAL_OFFSET)
+
+
+def unpack_cells(cells):
+    return (cells & ((1 << AXIAL_BITS) - 1)) - AXIAL_OFFSET, (cells >> AXIAL_BITS) - AXIAL_OFFSET
+
+
+def snapshot_cell_sizes(meta):
+    """ Sizes of the cells in a snapshot (by its meta.json) that can be used as is, those of GRID_FORMAT. """
+    hex_grid = meta.get("hex_grid", {})
+    return set(hex_grid.get("sizes", [])) if hex_grid.get("format") == GRID_FORMAT else set()
+
+
+def cell_ids(x, y, size):
+    """ Packed cells of the given size containing the points x, y (Web Mercator), -1 where not finite. """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    located = np.isfinite(x) & np.isfinite(y)
+
+    ids = np.full(len(x), -1, dtype=np.int64)
+    q, r = hex_cells(x[located], y[located], size)
+    ids[located] = pack_cells(q, r)
+    return ids
+
+
+def cell_centers(cells, size):
+    """ Web Mercator coordinates of the centers of packed cells. """
+    q, r = unpack_cells(cells)
+    return size * SQRT3 * (q + r / 2), size * 3 / 2 * r
+
+
+def view_ranges(bounds, size):
+    """
+    Ranges of packed cells covering bounds (x_min, x_max, y_min, y_max in Web
+    Mercator), one per row of cells, as arrays of the first and last cell of
+    each. The ranges have a margin of a cell, so cells partly in view are in.
+    """
+    x_min, x_max, y_min, y_max = bounds
+    r = np.arange(np.floor(y_min / (1.5 * size)) - 1, np.ceil(y_max / (1.5 * size)) + 2)
+    q_low = np.floor(x_min / (SQRT3 * size) - r / 2) - 1
+    q_high = np.ceil(x_max / (SQRT3 * size) - r / 2) + 1
+    return pack_cells(q_low, r), pack_cells(q_high, r)
+
+
+def in_view(cells, ranges):
+    """ Mask of the packed cells that are in ranges, as from view_ranges (all if None). """
+    if ranges is None:
+        return cells >= 0
+    lows, highs = ranges
+    row = np.searchsorted(lows, cells, side="right") - 1
+    return (row >= 0) & (cells <= highs[np.maximum(row, 0)]) & (cells >= 0)
+
+
+def merge_cells(parts, columns):
+    """
+    Sums parts, each the cells, number of listings, and sums and counts of
+    columns of some listings, as returned by HexCube.aggregate, into one
+    for all their cells, sorted by cell.
+    """
+    cells, inverse = np.unique(np.concatenate([part[0] for part in parts]), return_inverse=True)
+
+    def total(values):
+        return np.bincount(inverse, weights=np.concatenate(values), minlength=len(cells))
+
+    return cells, \
+        total([part[1] for part in parts]).astype(np.int64), \
+        {c: total([part[2][c] for part in parts]) for c in columns}, \
+        {c: total([part[3][c] for part in parts]).astype(np.int64) for c in columns}
+
+
+class HexCube(object):
+    def __init__(self, size, columns, sketch_bin_widths=None):
+        """
+        size is that of the cells, columns are the names of the values that
+        are aggregated, and sketch_bin_widths maps the columns to keep
+        histogram sketches of to their bin width, as for the AggregateCube.
+        """
+        self.size = size
+        self.columns = list(columns)
+        self.sketch_bin_widths = sketch_bin_widths or {}
+
+        # Packed cells with listings, sorted, and the entries per cell (index), month and bucket
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.n_rows = np.zeros(0, dtype=np.int64)
+        self.sums = {c: np.zeros(0, dtype=np.float64) for c in self.columns}
+        self.counts = {c: np.zeros(0, dtype=np.int64) for c in self.columns}
+
+        # Sketches as entry keys, bins and counts, sorted by key and bin
+        self.sketches = {
+            c: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+            for c in self.sketch_bin_widths
+        }
+
+    def __len__(self):
+        return len(self.keys)
+
+    def nbytes(self):
+        return self.cells.nbytes + self.keys.nbytes + self.n_rows.nbytes + \
+            sum(self.sums[c].nbytes + self.counts[c].nbytes for c in self.columns) + \
+            sum(a.nbytes for sketch in self.sketches.values() for a in sketch)
+
+    def add(self, cells, sold_dates, buckets, values):
+        """
+        Adds listings to the cube. cells are the packed cells of the listings
+        (negative if they have none), buckets the room buckets (negative if
+        unknown) and values maps each of the columns to the values of the
+        listings. Listings without cell, sold date or room bucket are left out.
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        sold_dates = np.asarray(sold_dates, dtype="datetime64[ns]")
+        buckets = np.asarray(buckets)
+        valid = (cells >= 0) & ~np.isnat(sold_dates) & (buckets >= 0)
+
+        # The indexes of the existing cells change with the new cells
+        all_cells = np.union1d(self.cells, cells[valid])
+        cell_indexes = np.searchsorted(all_cells, self.cells)
+
+        def rekey(keys):
+            return (cell_indexes[keys >> CELL_SHIFT] << CELL_SHIFT) | (keys & ((1 << CELL_SHIFT) - 1))
+
+        months = sold_dates[valid].astype("datetime64[M]").astype(np.int64)
+        new_keys = (np.searchsorted(all_cells, cells[valid]) << CELL_SHIFT) | \
+            (months << BUCKET_BITS) | buckets[valid].astype(np.int64)
+        self.cells = all_cells
+
+        # Merge with the existing entries
+        self.keys, inverse = np.unique(np.concatenate([rekey(self.keys), new_keys]), return_inverse=True)
+
+        def merge(old, new):
+            return np.bincount(inverse, weights=np.concatenate([old, new]), minlength=len(self.keys))
+
+        self.n_rows = merge(self.n_rows, np.ones(len(new_keys))).astype(np.int64)
+        for c in self.columns:
+            v = np.asarray(values[c], dtype=np.float64)[valid]
+            finite = ~np.isnan(v)
+            self.sums[c] = merge(self.sums[c], np.where(finite, v, 0))
+            self.counts[c] = merge(self.counts[c], finite).astype(np.int64)
+
+        for c, bin_width in self.sketch_bin_widths.items():
+            v = np.asarray(values[c], dtype=np.float64)[valid]
+            finite = ~np.isnan(v)
+            keys, bins, counts = self.sketches[c]
+            self.sketches[c] = merge_bins(
+                np.concatenate([rekey(keys), new_keys[finite]]),
+                np.concatenate([bins, to_bins(v[finite], bin_width)]),
+                np.concatenate([counts, np.ones(finite.sum(), dtype=np.int64)])
+            )
+
+    def _entries(self, keys, ranges, first_month, stop_month, bucket_low, bucket_high):
+        """
+        Positions in keys (entry keys, sorted) of the entries of the cells in
+        ranges (as from view_ranges, all if None), for the months from
+        first_month up to but not including stop_month, and the room buckets
+        from bucket_low to bucket_high inclusive (None means unbounded).
+        """
+        if ranges is None:
+            positions = np.arange(len(keys))
+        else:
+            # One slice of the entries per row of cells in view
+            lows, highs = ranges
+            starts = np.searchsorted(keys, np.searchsorted(self.cells, lows) << CELL_SHIFT)
+            stops = np.searchsorted(keys, np.searchsorted(self.cells, highs, side="right") << CELL_SHIFT)
+            lengths = stops - starts
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+        months = (keys[positions] >> BUCKET_BITS) & ((1 << MONTH_BITS) - 1)
+        buckets = keys[positions] & ((1 << BUCKET_BITS) - 1)
+        mask = (months >= np.datetime64(first_month, "M").astype(np.int64)) & \
+            (months < np.datetime64(stop_month, "M").astype(np.int64))
+        if bucket_low is not None:
+            mask &= buckets >= bucket_low
+        if bucket_high is not None:
+            mask &= buckets <= bucket_high
+        return positions[mask]
+
+    def aggregate(self, ranges, first_month, stop_month, bucket_low=None, bucket_high=None, columns=None):
+        """
+        Returns the cells with listings in ranges (as from view_ranges, all if
+        None), the number of listings, and the sums and counts of each of
+        columns (all if None) per cell, for the months from first_month up to
+        but not including stop_month, and the room buckets from bucket_low to
+        bucket_high inclusive (None means unbounded).
+        """
+        columns = self.columns if columns is None else columns
+        entries = self._entries(self.keys, ranges, first_month, stop_month, bucket_low, bucket_high)
+        cells, inverse = np.unique(self.keys[entries] >> CELL_SHIFT, return_inverse=True)
+
+        def total(x):
+            return np.bincount(inverse, weights=x[entries], minlength=len(cells))
+
+        return self.cells[cells], \
+            total(self.n_rows).astype(np.int64), \
+            {c: total(self.sums[c]) for c in columns}, \
+            {c: total(self.counts[c]).astype(np.int64) for c in columns}
+
+    def sketch(self, column, ranges, first_month, stop_month, bucket_low=None, bucket_high=None):
+        """
+        Returns the histogram sketch of column for the same cells as
+        aggregate, as arrays of packed cells, bins and counts.
+        """
+        keys, bins, counts = self.sketches[column]
+        entries = self._entries(keys, ranges, first_month, stop_month, bucket_low, bucket_high)
+        return self.cells[keys[entries] >> CELL_SHIFT], bins[entries], counts[entries]
+
+    def aggregate_rows(self, cells, values, ranges=None, columns=None):
+        """ Same as aggregate, for listings that are not in the cube, with their packed cells. """
+        columns = self.columns if columns is None else columns
+        visible = in_view(np.asarray(cells, dtype=np.int64), ranges)
+        cells, inverse = np.unique(np.asarray(cells)[visible], return_inverse=True)
+
+        sums, counts = {}, {}
+        for c in columns:
+            v = np.asarray(values[c], dtype=np.float64)[visible]
+            finite = ~np.isnan(v)
+            sums[c] = np.bincount(inverse[finite], weights=v[finite], minlength=len(cells))
+            counts[c] = np.bincount(inverse[finite], minlength=len(cells))
+
+        return cells, np.bincount(inverse, minlength=len(cells)), sums, counts
+
+    def sketch_rows(self, column, cells, values, ranges=None):
+        """ Same as sketch, for listings that are not in the cube, with their packed cells. """
+        values = np.asarray(values, dtype=np.float64)
+        keep = ~np.isnan(values) & in_view(np.asarray(cells, dtype=np.int64), ranges)
+        return np.asarray(cells, dtype=np.int64)[keep], \
+            to_bins(values[keep], self.sketch_bin_widths[column]), \
+            np.ones(keep.sum(), dtype=np.int64)
@@ -0,0 +1,87 @@
+""" HOT RELOAD
+Swaps the data of the running dashboard to a new version without a restart.
+A background thread checks every interval seconds whether a new version of
+the data is available, and if so loads it, including everything built from
+it such as indexes, off the request path. The loaded data then replaces the
+current data in a single assignment, and the previous data is released once
+no request uses it anymore. A request that gets current once and uses that
+throughout therefore sees either the old or the new version, never a mix.
+
+Nothing is loaded until current is first used, so that creating a reloader,
+e.g. at import, is cheap.
+"""
+
+import time
+import logging
+import threading
+
+
+class HotReloader(object):
+    def __init__(self, get_version, load, interval=60):
+        """
+        get_version returns the version of the data that is available, and
+        load(version) loads that version. The loaded data must have its
+        version as attribute version. The first version is loaded when
+        current is first used.
+        """
+        self.get_version = get_version
+        self.load = load
+        self.interval = interval
+        self._current = None
+        self.failed_version = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def current(self):
+        """ The data of the current version, loading the available version if none is loaded yet. """
+        current = self._current
+        if current is None:
+            with self.lock:
+                if self._current is None:
+                    self._current = self.load(self.get_version())
+                current = self._current
+        return current
+
+    def reload(self):
+        """ Loads and swaps to the available version, if new. Returns True if swapped. """
+        with self.lock:
+            if self._current is None:
+                # Loaded on first use instead
+                return False
+
+            version = self.get_version()
+            if version == self._current.version or version == self.failed_version:
+                return False
+
+            start = time.time()
+            try:
+                data = self.load(version)
+            except Exception:
+                # Not retried until there is another version, the current one is kept
+                self.failed_version = version
+                logging.exception(f"Failed to load version {version}, keeping {self._current.version}")
+                return False
+
+            previous_version = self._current.version
+            self._current = data
+            logging.info(f"Swapped data from version {previous_version} to {version}, " +
+                         f"loaded in {time.time() - start:.2f} seconds")
+            return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reload()
+            except Exception:
+                logging.exception("Failed to check for a new version")
+
+    def start(self):
+        """ Starts checking for new versions in a background thread, once per process. """
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="hot-reload", daemon=True)
+                self.thread.start()
@@ -0,0 +1,164 @@
+""" METRICS
+Timings and sizes recorded in the dashboard process, which the app serves at
+/metrics, and a sampling profiler for single requests.
+
+Timings are recorded by spans, named by what they time such as
+"data.scatter", either with the span context manager or by decorating
+a function with timed. Sizes, such as the bytes of a response, are recorded
+with record_size. For each name the count and total are kept, and the most
+recent values for percentiles.
+
+The profiler samples the stack of the thread handling a request, and writes
+the sampled stacks in the folded format ("outer;inner;innermost count" per
+line) that flamegraph.pl, speedscope and similar tools read.
+"""
+
+import os
+import sys
+import time
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+
+class Metrics(object):
+    def __init__(self, max_samples=1000):
+        """ Percentiles are computed over the max_samples most recent values of each name. """
+        self.max_samples = max_samples
+        self.timings = {}
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.created = time.time()
+
+    def _record(self, metrics, name, value):
+        with self.lock:
+            if name not in metrics:
+                metrics[name] = {"count": 0, "total": 0.0, "recent": deque(maxlen=self.max_samples)}
+            metric = metrics[name]
+            metric["count"] += 1
+            metric["total"] += value
+            metric["recent"].append(value)
+
+    def record_time(self, name, seconds):
+        self._record(self.timings, name, seconds)
+
+    def record_size(self, name, n_bytes):
+        self._record(self.sizes, name, n_bytes)
+
+    @contextmanager
+    def span(self, name):
+        """ Records the time spent in the with block as name, also if it raises. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """ Decorator recording the time spent in each call of the function as name. """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _summary(self, metrics, scale):
+        with self.lock:
+            metrics = {name: (m["count"], m["total"], np.array(m["recent"])) for name, m in metrics.items()}
+
+        summary = {}
+        for name, (count, total, recent) in sorted(metrics.items()):
+            p50, p95, p99 = np.percentile(recent, [50, 95, 99]) * scale
+            summary[name] = {
+                "count": count,
+                "mean": float(total / count * scale),
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "max": float(recent.max() * scale) # Of the recent values
+            }
+        return summary
+
+    def summary(self):
+        """ Timings in milliseconds and sizes in bytes, per name. """
+        return {
+            "uptime_seconds": round(time.time() - self.created),
+            "timings_ms": self._summary(self.timings, 1000),
+            "sizes_bytes": self._summary(self.sizes, 1)
+        }
+
+
+# Metrics of this process
+registry = Metrics()
+span = registry.span
+timed = registry.timed
+record_time = registry.record_time
+record_size = registry.record_size
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a thread every interval seconds from a background
+    thread, and counts how often each stack is seen.
+    """
+    def __init__(self, thread_id=None, interval=0.001):
+        """ thread_id defaults to the thread creating the profiler. """
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.n_samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.n_samples += 1
+
+    def folded(self):
+        return "".join(f"{stack} {n}\n" for stack, n in sorted(self.stacks.items()))
+
+    def write(self, directory, name, max_files=None):
+        """ 
+        Writes the folded stacks to a new file in directory, with name in the
+        file name. Returns the path. If max_files is given, the oldest files
+        are removed so that at most max_files are kept.
+        """
+        os.makedirs(directory, exist_ok=True)
+        safe_name = "".join(c if c.isalnum() or c in "-." else "_" for c in name).strip("_")[:100]
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{safe_name}.folded")
+        with open(path, "w", encoding="utf8") as f:
+            f.write(self.folded())
+
+        if max_files is not None:
+            # The file names start with the time they were written
+            files = sorted(f for f in os.listdir(directory) if f.endswith(".folded"))
+            for f in files[:max(0, len(files) - max_files)]:
+                try:
+                    os.remove(os.path.join(directory, f))
+                except FileNotFoundError:
+                    pass # Removed by another process
+        return path
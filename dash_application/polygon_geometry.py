@@ -0,0 +1,149 @@
+""" POLYGON GEOMETRY
+Prepares the polygon GeoJSON for the choropleth once, at startup, instead of
+on every call:
+    - Only the geometry is kept, with the polygon name as feature id. All other
+      properties are dropped.
+    - Coordinates are quantized to a number of decimals (5 decimals is about
+      a meter), which also makes vertices shared by neighbouring polygons
+      exactly equal.
+    - The polygons are simplified at several tolerances, for different map
+      zoom levels. As in TopoJSON, the rings are split into arcs at the
+      vertices where neighbouring polygons meet, and every arc is simplified
+      once, so shared borders stay shared and no gaps or overlaps appear.
+"""
+
+import json
+from shapely.geometry import LineString
+
+
+def quantize_ring(ring, scale):
+    """ Ring as a list of integer points, without repeated points and the closing point. """
+    points = []
+    for x, y in ring:
+        p = (int(round(x * scale)), int(round(y * scale)))
+        if not points or p != points[-1]:
+            points.append(p)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+
+    return points
+
+
+def get_polygons(geometry):
+    """ List of polygons, each a list of rings, of a Polygon or MultiPolygon geometry. """
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    assert geometry["type"] == "MultiPolygon", f"Unsupported geometry type {geometry['type']}"
+    return geometry["coordinates"]
+
+
+def find_junctions(rings):
+    """ Vertices that have different neighbours in different rings, or within a ring. """
+    neighbours = {}
+    for ring in rings:
+        n = len(ring)
+        for i, p in enumerate(ring):
+            neighbours.setdefault(p, set()).add(frozenset((ring[i - 1], ring[(i + 1) % n])))
+
+    return {p for p, s in neighbours.items() if len(s) > 1}
+
+
+def simplify_line(points, tolerance):
+    """ Douglas-Peucker simplification keeping the end points. """
+    if tolerance <= 0 or len(points) <= 2:
+        return points
+    simplified = LineString(points).simplify(tolerance, preserve_topology=False)
+    return [(int(x), int(y)) for x, y in simplified.coords]
+
+
+class ArcSimplifier(object):
+    def __init__(self, rings, tolerance):
+        self.junctions = find_junctions(rings)
+        self.tolerance = tolerance
+        self.arcs = {}
+
+    def simplify_arc(self, arc):
+        """ Shared arcs are simplified in one direction only, so the results are identical. """
+        key = tuple(arc)
+        reverse_key = key[::-1]
+        if reverse_key < key:
+            return self.simplify_arc(arc[::-1])[::-1]
+        if key not in self.arcs:
+            self.arcs[key] = simplify_line(arc, self.tolerance)
+        return self.arcs[key]
+
+    def simplify_ring(self, ring):
+        """ Returns the simplified ring as a closed list of points. """
+        cuts = [i for i, p in enumerate(ring) if p in self.junctions]
+        if not cuts:
+            # Start from the smallest point in a fixed direction, so that a ring
+            # equal to another ring (e.g. a hole filled by a polygon) is simplified alike
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            if ring[-1] < ring[1]:
+                ring = ring[:1] + ring[:0:-1]
+            closed_ring = ring + ring[:1]
+            simplified = self.simplify_arc(closed_ring)
+        else:
+            closed_ring = ring[cuts[0]:] + ring[:cuts[0] + 1]
+            cuts = [i - cuts[0] for i in cuts] + [len(ring)]
+            simplified = closed_ring[:1]
+            for start, stop in zip(cuts[:-1], cuts[1:]):
+                simplified += self.simplify_arc(closed_ring[start:stop + 1])[1:]
+
+        # Keep rings that would collapse as they are
+        if len(set(simplified)) < 3:
+            return closed_ring
+        return simplified
+
+
+def prepare_geojson(path, id_property, tolerances, precision=5):
+    """
+    Returns a dict of GeoJSON FeatureCollections, one per tolerance (in
+    degrees, 0 meaning no simplification), with the id_property of each
+    polygon as feature id and coordinates rounded to precision decimals.
+    """
+    with open(path, encoding="utf-8") as f:
+        features = json.load(f)["features"]
+
+    scale = 10 ** precision
+    polygons = [
+        [[quantize_ring(ring, scale) for ring in polygon] for polygon in get_polygons(feature["geometry"])]
+        for feature in features
+    ]
+    rings = [ring for feature in polygons for polygon in feature for ring in polygon]
+
+    collections = {}
+    for tolerance in tolerances:
+        simplifier = ArcSimplifier(rings, tolerance * scale)
+        collections[tolerance] = {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "id": str(feature["properties"][id_property]),
+                    "geometry": {
+                        "type": "MultiPolygon",
+                        "coordinates": [
+                            [
+                                [[x / scale, y / scale] for x, y in simplifier.simplify_ring(ring)]
+                                for ring in polygon
+                            ]
+                            for polygon in feature_polygons
+                        ]
+                    }
+                }
+                for feature, feature_polygons in zip(features, polygons)
+            ]
+        }
+
+    return collections
+
+
+def count_vertices(collection):
+    return sum(
+        len(ring)
+        for feature in collection["features"]
+        for polygon in feature["geometry"]["coordinates"]
+        for ring in polygon
+    )
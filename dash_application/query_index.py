@@ -0,0 +1,98 @@
+""" QUERY INDEX
+Index over the listings used to answer the sidebar filters without scanning or
+copying the full dataset. The listings are kept sorted by sold date, so a date
+range is a contiguous slice found by binary search. The number of rooms is
+precomputed into small integer buckets relative to the room slider's marks, so
+the room filter is a comparison of int8 arrays within that slice.
+"""
+
+import numpy as np
+
+# Marks of the number of rooms slider in app.py. The last mark is shown as "5+".
+ROOM_MARKS = np.array([1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0])
+
+
+class QueryIndex(object):
+    def __init__(self, sold_dates, rooms, room_marks=ROOM_MARKS):
+        sold_dates = np.asarray(sold_dates, dtype="datetime64[ns]")
+        rooms = np.asarray(rooms, dtype=np.float64)
+
+        # Missing dates are sorted last, and never match a date range
+        self.n_dated = len(sold_dates) - np.isnat(sold_dates).sum()
+        self.sold_dates = sold_dates[:self.n_dated]
+        assert (np.diff(self.sold_dates.view(np.int64)) >= 0).all(), \
+            "Listings must be sorted by listing_sold_date."
+
+        # For each listing, the number of marks strictly below and at or below
+        # its number of rooms. Then rooms > room_marks[i] is rooms_above > i,
+        # and rooms < room_marks[j] is rooms_up_to <= j. Listings without a
+        # number of rooms never match.
+        self.room_marks = np.asarray(room_marks, dtype=np.float64)
+        self.rooms = rooms
+        missing = np.isnan(rooms)
+        self.rooms_above = np.where(
+            missing, -1, np.searchsorted(self.room_marks, rooms, side="left")
+        ).astype(np.int8)
+        self.rooms_up_to = np.where(
+            missing, np.iinfo(np.int8).max, np.searchsorted(self.room_marks, rooms, side="right")
+        ).astype(np.int8)
+
+    def date_slice(self, start_date, end_date):
+        """ Slice of the listings sold strictly after start_date and strictly before end_date. """
+        start = np.searchsorted(self.sold_dates, np.datetime64(start_date, "ns"), side="right")
+        stop = np.searchsorted(self.sold_dates, np.datetime64(end_date, "ns"), side="left")
+
+        return slice(start, max(start, stop))
+
+    def rooms_mask(self, rows, n_rooms_range):
+        """ Mask of the listings in rows with more than n_rooms_range[0] and less than n_rooms_range[1] rooms. """
+        low, high = n_rooms_range
+        mark = {m: i for i, m in enumerate(self.room_marks)}
+
+        if low in mark:
+            mask = self.rooms_above[rows] > mark[low]
+        else:
+            mask = self.rooms[rows] > low
+
+        if high < self.room_marks[-1]: # The last mark means no upper limit
+            if high in mark:
+                mask &= self.rooms_up_to[rows] <= mark[high]
+            else:
+                mask &= self.rooms[rows] < high
+
+        return mask
+
+    def room_buckets(self):
+        """
+        Buckets of the number of rooms, such that bucket 2 * i + 1 holds the
+        listings with exactly room_marks[i] rooms and bucket 2 * i those in
+        between room_marks[i - 1] and room_marks[i]. Missing is -1.
+        """
+        return np.where(
+            self.rooms_up_to == np.iinfo(np.int8).max, -1, self.rooms_above + self.rooms_up_to
+        ).astype(np.int8)
+
+    def bucket_range(self, n_rooms_range):
+        """
+        Inclusive range of room buckets matching n_rooms_range as in
+        rooms_mask, where None means unbounded. Returns None if the range is
+        not given in marks, and can't be expressed in buckets.
+        """
+        low, high = n_rooms_range
+        mark = {m: i for i, m in enumerate(self.room_marks)}
+        if low not in mark or high not in mark:
+            return None
+
+        return 2 * mark[low] + 2, (2 * mark[high] if high < self.room_marks[-1] else None)
+
+    def query(self, date_range, n_rooms_range):
+        """
+        Returns the positions of the listings matching the filters, as a slice
+        if they are contiguous and as an array of positions otherwise.
+        """
+        rows = self.date_slice(*date_range)
+        mask = self.rooms_mask(rows, n_rooms_range)
+
+        if mask.all():
+            return rows
+        return rows.start + np.flatnonzero(mask)
@@ -0,0 +1,150 @@
+""" REPEAT SALES
+Case-Shiller style repeat-sales price index per area and month. Every sale of
+a property is paired with its previous sale, and the log price ratio of each
+pair is explained by the difference of the log index of its area between the
+months of the two sales:
+
+    log(price2 / price1) = index[area, month2] - index[area, month1] + error
+
+All areas are fitted together in one sparse least squares problem, where each
+area has its own block of columns, by solving its normal equations with a
+sparse direct solver. As in Case & Shiller (1987) the errors of pairs further
+apart in time are larger, so the fit is done in three stages: an unweighted
+fit, a regression of its squared residuals on the time between the sales,
+and a fit weighted by the inverse of the variance that predicts.
+
+The first month of each area is its base, with index 0 (100 as a price index).
+Months that no chain of pairs connects to the base can't be compared to it,
+and are left out.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import spsolve
+
+
+def sale_pairs(property_ids, sold_dates, prices, groups):
+    """
+    Consecutive sales of the same property. The arguments are arrays per sale,
+    where groups are integer codes such as of the area of the property (-1 for
+    none). Returns a DataFrame with the group, the months (since 1970) of the
+    first and second sale, and the log price ratio of each pair. Sales without
+    a date or price are skipped, and pairs within a month carry no information
+    of the index and are skipped too.
+    """
+    sold_dates = np.asarray(sold_dates, dtype="datetime64[ns]")
+    prices = np.asarray(prices, dtype=np.float64)
+    property_ids = np.asarray(property_ids)
+    months = sold_dates.astype("datetime64[M]").astype(np.int64)
+
+    with np.errstate(invalid="ignore"):
+        sales = np.flatnonzero(~np.isnat(sold_dates) & (prices > 0))
+
+    # Sorted by property and month, by a single key which is faster than lexsort
+    if len(sales) > 0:
+        sale_months = months[sales] - months[sales].min()
+        month_bits = int(sale_months.max()).bit_length()
+        _, property_codes = np.unique(property_ids[sales], return_inverse=True)
+        sales = sales[np.argsort((property_codes.astype(np.int64) << month_bits) | sale_months)]
+
+    same_property = property_ids[sales[1:]] == property_ids[sales[:-1]]
+    first, second = sales[:-1][same_property], sales[1:][same_property]
+    apart = months[second] > months[first]
+    first, second = first[apart], second[apart]
+
+    return pd.DataFrame({
+        "group": np.asarray(groups)[second],
+        "first_month": months[first],
+        "second_month": months[second],
+        "log_ratio": np.log(prices[second]) - np.log(prices[first])
+    })
+
+
+def _solve(X, y, weights=None):
+    """ Least squares solution of X b = y (with weights per row), by the normal equations. """
+    if weights is not None:
+        X = sparse.diags(weights) @ X
+        y = weights * y
+    return spsolve((X.T @ X).tocsc(), X.T @ y)
+
+
+def fit_index(pairs, max_log_ratio=1.5):
+    """
+    Log price index per group and month, from pairs as returned by sale_pairs.
+    Pairs whose price changed by more than a factor exp(max_log_ratio) are
+    taken to be errors, or not the same apartment, and are left out. Returns a
+    DataFrame with the group, month (as datetime64), log index and number of
+    sales in pairs of each group and month, sorted by group and month.
+    """
+    pairs = pairs[(pairs["group"] >= 0) & (pairs["log_ratio"].abs() <= max_log_ratio)]
+    n = len(pairs)
+    if n == 0:
+        return pd.DataFrame({
+            "group": np.array([], dtype=np.int64),
+            "month": np.array([], dtype="datetime64[M]"),
+            "log_index": np.array([], dtype=np.float64),
+            "n_sales": np.array([], dtype=np.int64)
+        })
+
+    groups = pairs["group"].values.astype(np.int64)
+    first_months = pairs["first_month"].values
+    second_months = pairs["second_month"].values
+    y = pairs["log_ratio"].values
+
+    # The months of each group with sales are the nodes, sorted by group and month
+    min_month = first_months.min()
+    n_months = second_months.max() - min_month + 1
+    keys, nodes = np.unique(
+        np.concatenate([groups * n_months + first_months - min_month, groups * n_months + second_months - min_month]),
+        return_inverse=True
+    )
+    first_nodes, second_nodes = nodes[:n], nodes[n:]
+    node_groups = keys // n_months
+    is_base = np.r_[True, node_groups[1:] != node_groups[:-1]]
+
+    # Only the nodes connected to the base of their group by pairs can be fitted
+    graph = sparse.coo_matrix((np.ones(n), (first_nodes, second_nodes)), shape=(len(keys), len(keys)))
+    _, components = connected_components(graph, directed=False)
+    fitted = components == components[np.flatnonzero(is_base)[np.cumsum(is_base) - 1]]
+    pair_fitted = fitted[first_nodes]
+
+    # A column per fitted node except the bases, which have log index 0
+    column = np.cumsum(fitted & ~is_base) - 1
+    column[~fitted | is_base] = -1
+    first_columns = column[first_nodes][pair_fitted]
+    second_columns = column[second_nodes][pair_fitted]
+    rows = np.arange(pair_fitted.sum())
+    entry_rows = np.r_[rows, rows]
+    entry_columns = np.r_[second_columns, first_columns]
+    entry_values = np.r_[np.ones(len(rows)), -np.ones(len(rows))]
+    present = entry_columns >= 0
+    X = sparse.csr_matrix(
+        (entry_values[present], (entry_rows[present], entry_columns[present])),
+        shape=(len(rows), column.max() + 1)
+    )
+    y = y[pair_fitted]
+    intervals = (second_months - first_months)[pair_fitted].astype(np.float64)
+
+    log_index = np.zeros(len(keys))
+    if X.shape[1] > 0:
+        # Stage 1, unweighted
+        b = _solve(X, y)
+
+        # Stage 2, the variance of the errors grows with the time between the sales
+        residuals = y - X @ b
+        A = np.column_stack([np.ones(len(intervals)), intervals])
+        variance = A @ np.linalg.lstsq(A, residuals ** 2, rcond=None)[0]
+        if (variance > 0).all():
+            # Stage 3, weighted by the inverse of the predicted variance
+            b = _solve(X, y, 1 / np.sqrt(variance))
+
+        log_index[column >= 0] = b[column[column >= 0]]
+
+    return pd.DataFrame({
+        "group": node_groups,
+        "month": (keys % n_months + min_month).astype("datetime64[M]"),
+        "log_index": log_index,
+        "n_sales": np.bincount(nodes, minlength=len(keys))
+    })[fitted].reset_index(drop=True)
@@ -0,0 +1,54 @@
+""" SAMPLING
+Spatial grid sampling of points for the scatterplot, so that a capped number
+of points still covers the whole map instead of only the densest areas.
+"""
+
+import numpy as np
+
+
+def grid_sample(x, y, priority, max_points, grid_size=128):
+    """
+    Returns the (sorted) positions of at most max_points of the points x, y.
+    The bounding box of the points is divided into grid_size x grid_size
+    cells, and every cell keeps its k points of lowest priority, with k as
+    large as possible, and some cells one more to reach max_points. Using a fixed random priority per point keeps the same
+    points when the sample is taken again over a slightly different area.
+    """
+    n = len(x)
+    if n <= max_points:
+        return np.arange(n)
+
+    def cell_index(v):
+        low, high = np.nanmin(v), np.nanmax(v)
+        scale = grid_size / (high - low) if high > low else 0
+        return np.clip(((v - low) * scale).astype(np.int64), 0, grid_size - 1)
+
+    cells = cell_index(x) * grid_size + cell_index(y)
+
+    # Rank of each point within its cell, by priority
+    order = np.lexsort((priority, cells))
+    sorted_cells = cells[order]
+    counts = np.bincount(sorted_cells, minlength=grid_size * grid_size)
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(n) - starts[sorted_cells]
+
+    # Largest k such that keeping k points per cell keeps at most max_points
+    sorted_counts = np.sort(counts[counts > 0])
+    low, high = 0, sorted_counts[-1]
+    while low < high:
+        k = (low + high + 1) // 2
+        if np.minimum(sorted_counts, k).sum() <= max_points:
+            low = k
+        else:
+            high = k - 1
+
+    keep = order[rank < low]
+
+    # Fill up to max_points with the next point of some of the cells
+    candidates = order[rank == low]
+    n_fill = max_points - len(keep)
+    if n_fill > 0:
+        candidates = candidates[np.argpartition(priority[candidates], n_fill - 1)[:n_fill]]
+        keep = np.concatenate([keep, candidates])
+
+    return np.sort(keep)
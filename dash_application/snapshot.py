@@ -0,0 +1,140 @@
+""" DASHBOARD SNAPSHOT
+Reads the columnar snapshot written by 8_build_dashboard_snapshot.py in the
+data scraping pipeline. Column files are memory-mapped read-only, so nothing
+is parsed at startup, and numeric, datetime and categorical columns are used
+in the DataFrame without copying. All processes loading the same snapshot
+therefore share its pages in the OS page cache, instead of each holding its
+own copy.
+
+The pipeline writes every snapshot as a new version, in a directory of its
+own within the snapshot directory, and the file CURRENT names the version to
+use. A version directory is never modified after it is written.
+"""
+
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+
+def snapshot_exists(directory):
+    return os.path.isfile(os.path.join(directory, "meta.json"))
+
+
+def current_version(snapshot_dir):
+    """ Name of the version that CURRENT in snapshot_dir points to, or None if there is none. """
+    try:
+        with open(os.path.join(snapshot_dir, "CURRENT"), encoding="utf8") as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+
+    if not version or not snapshot_exists(os.path.join(snapshot_dir, version)):
+        return None
+    return version
+
+
+def read_meta(directory):
+    with open(os.path.join(directory, "meta.json"), encoding="utf8") as f:
+        return json.load(f)
+
+
+def read_categories(directory, name):
+    with open(os.path.join(directory, f"{name}.categories.json"), encoding="utf8") as f:
+        return json.load(f)
+
+
+def load_block(directory, dtype):
+    """ Memory-mapped 2D array of the numeric columns of dtype, one row per column. """
+    return np.load(os.path.join(directory, f"{dtype}.block.npy"), mmap_mode="r")
+
+
+def load_column(directory, name, as_categorical=False, meta=None):
+    """
+    Returns a column of the snapshot as a (memory-mapped, if possible) array.
+    String columns are returned as object arrays, or as pd.Categorical if
+    as_categorical is set.
+    """
+    meta = meta or read_meta(directory)
+    column = meta["columns"][name]
+
+    if column["kind"] == "categorical":
+        codes = np.load(os.path.join(directory, f"{name}.codes.npy"), mmap_mode="r")
+        categories = read_categories(directory, name)
+
+        if as_categorical:
+            return pd.Categorical.from_codes(codes, categories)
+
+        # Missing values have code -1, which picks the None appended last
+        return np.array(categories + [None], dtype=object)[codes]
+
+    if column["kind"] == "numeric":
+        return load_block(directory, column["block"])[column["index"]]
+
+    return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+
+
+def load_snapshot(directory, columns=None, dtypes=None, max_category_ratio=None):
+    """
+    Loads the snapshot in directory as a DataFrame, optionally only some of
+    the columns. Numeric columns are stored in blocks of one dtype, which are
+    mapped as is, so all columns in the block of a requested column are
+    loaded as well (which costs nothing until they are used). The columns
+    have the dtypes they were stored with, as in meta.json. Numeric columns
+    in dtypes are cast to the given dtype, which copies them into this
+    process unless they already have it, and is logged. If
+    max_category_ratio is set, string columns with at most that many
+    distinct values per row are loaded as categoricals.
+    """
+    meta = read_meta(directory)
+    if columns is None:
+        columns = list(meta["columns"])
+    dtypes = dtypes or {}
+
+    frames = []
+    for dtype in sorted({meta["columns"][name]["block"] for name in columns if "block" in meta["columns"][name]}):
+        names = meta["blocks"][dtype]
+        frame = pd.DataFrame(load_block(directory, dtype).T, columns=names, copy=False)
+        for name in names:
+            if name in dtypes and frame[name].dtype != dtypes[name]:
+                logging.warning(f"Casting {name} of the snapshot from {frame[name].dtype} to " +
+                                f"{np.dtype(dtypes[name])}, which copies it into this process")
+                frame[name] = frame[name].astype(dtypes[name])
+        frames.append(frame)
+
+    data = {}
+    for name in columns:
+        kind = meta["columns"][name]["kind"]
+        if kind == "numeric":
+            continue
+        as_categorical = kind == "categorical" and max_category_ratio is not None and \
+            len(read_categories(directory, name)) <= max_category_ratio * meta["n_rows"]
+        data[name] = load_column(directory, name, as_categorical=as_categorical, meta=meta)
+    frames.append(pd.DataFrame(data, copy=False))
+
+    # Combine the blocks as they are, without consolidating or copying them
+    return pd.concat(frames, axis=1, copy=False)
+
+
+def compact(df, dtypes=None, max_category_ratio=0.5):
+    """ Same narrowing as load_snapshot, for a DataFrame that is already loaded. """
+    dtypes = dtypes or {}
+    for name, col in df.items():
+        if name in dtypes:
+            df[name] = col.astype(dtypes[name], copy=False)
+        elif col.dtype == object and col.nunique() <= max_category_ratio * len(df):
+            df[name] = col.astype("category")
+
+    return df
+
+
+def memory_report(df):
+    """ Returns a table of the memory usage of each column, largest first. """
+    usage = df.memory_usage(deep=True, index=False).sort_values(ascending=False)
+    lines = [f"{'column':<32}{'dtype':<16}{'bytes':>14}"]
+    for name, n_bytes in usage.items():
+        lines.append(f"{name:<32}{str(df[name].dtype):<16}{n_bytes:>14,}")
+    lines.append(f"{'total':<48}{usage.sum():>14,}")
+
+    return "\n".join(lines)
@@ -0,0 +1,139 @@
+""" MAP TILES
+Renders XYZ raster tiles (Web Mercator, 256 px) of the listings with
+datashader, for use as a raster layer of the map. Only the listings within a
+tile are aggregated, and rendered tiles are cached on disk per filter state,
+so point density shows at every zoom level without sending the listings to
+the browser.
+
+datashader is imported when the first tile is rendered, since it is slow to
+import and most maps do not show tiles.
+"""
+
+import os
+import io
+import json
+import shutil
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+TILE_SIZE = 256
+
+# Part of the key of every cached tile. Bump it whenever the rendering changes.
+TILE_FORMAT = 1
+EARTH_RADIUS = 6378137.0
+HALF_CIRCUMFERENCE = np.pi * EARTH_RADIUS
+
+
+def to_web_mercator(longitudes, latitudes):
+    """ Web Mercator (EPSG:3857) coordinates in meters. """
+    x = np.radians(np.asarray(longitudes, dtype=np.float64)) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(np.asarray(latitudes, dtype=np.float64)) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def tile_bounds(z, x, y):
+    """ Returns x_min, x_max, y_min, y_max of tile x, y at zoom z, in Web Mercator meters. """
+    size = 2 * HALF_CIRCUMFERENCE / 2 ** z
+    x_min = -HALF_CIRCUMFERENCE + x * size
+    y_max = HALF_CIRCUMFERENCE - y * size
+    return x_min, x_min + size, y_max - size, y_max
+
+
+def snap_to_tiles(lon_min, lon_max, lat_min, lat_max, zoom, margin=1):
+    """
+    Returns the bounds (lon_min, lon_max, lat_min, lat_max) of the tiles at
+    zoom level floor(zoom) covering the given bounds, extended by margin
+    tiles on every side. Small changes of the bounds then give the same result.
+    """
+    z = max(0, int(np.floor(zoom)))
+    n = 2 ** z
+    x, y = to_web_mercator([lon_min, lon_max], [lat_max, lat_min])
+    tile_x = np.clip(np.floor((x + HALF_CIRCUMFERENCE) / (2 * HALF_CIRCUMFERENCE) * n) + [-margin, margin + 1], 0, n)
+    tile_y = np.clip(np.floor((HALF_CIRCUMFERENCE - y) / (2 * HALF_CIRCUMFERENCE) * n) + [-margin, margin + 1], 0, n)
+
+    longitudes = tile_x / n * 360 - 180
+    latitudes = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * tile_y / n))))
+    return float(longitudes[0]), float(longitudes[1]), float(latitudes[1]), float(latitudes[0])
+
+
+def empty_tile():
+    f = io.BytesIO()
+    Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(f, format="PNG")
+    return f.getvalue()
+
+EMPTY_TILE = empty_tile()
+
+
+def render_tile(x, y, values, bounds, span, cmap):
+    """
+    Returns a PNG of the mean of values per pixel, for points at Web
+    Mercator coordinates x, y, colored linearly from span[0] to span[1].
+    """
+    if len(values) == 0:
+        return EMPTY_TILE
+
+    import datashader as ds
+    import datashader.transfer_functions as tf
+
+    x_min, x_max, y_min, y_max = bounds
+    cvs = ds.Canvas(plot_width=TILE_SIZE, plot_height=TILE_SIZE, x_range=(x_min, x_max), y_range=(y_min, y_max))
+    agg = cvs.points(pd.DataFrame({"x": x, "y": y, "value": values}), x="x", y="y", agg=ds.mean("value"))
+    img = tf.dynspread(tf.shade(agg, cmap=cmap, how="linear", span=span), threshold=0.5, max_px=3)
+
+    f = io.BytesIO()
+    img.to_pil().save(f, format="PNG")
+    return f.getvalue()
+
+
+def state_key(state):
+    """ Key of the tiles of a filter state in the TileCache, which changes with TILE_FORMAT. """
+    return hashlib.sha1(json.dumps([TILE_FORMAT, state], sort_keys=True).encode("utf8")).hexdigest()
+
+
+class TileCache(object):
+    """
+    Rendered tiles in directory/<filter state key>/<z>/<x>/<y>.png. When more
+    than max_states filter states are cached, the least recently added are removed.
+    """
+    def __init__(self, directory, max_states=64):
+        self.directory = directory
+        self.max_states = max_states
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, z, x, y):
+        return os.path.join(self.directory, key, str(z), str(x), f"{y}.png")
+
+    def get(self, key, z, x, y):
+        try:
+            with open(self._path(key, z, x, y), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, z, x, y, png):
+        if not os.path.isdir(os.path.join(self.directory, key)):
+            self._evict()
+
+        path = self._path(key, z, x, y)
+        temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                f.write(png)
+            os.replace(temp_path, path)
+        except FileNotFoundError:
+            pass # The state was evicted by another worker meanwhile, the tile is just not cached
+
+    def _evict(self):
+        states = []
+        for e in os.scandir(self.directory):
+            try:
+                states.append((e.stat().st_mtime, e.path))
+            except FileNotFoundError:
+                pass # Evicted by another worker meanwhile
+        states.sort()
+        for _, path in states[:max(0, len(states) - self.max_states + 1)]:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,36 @@
+""" TRENDS
+Reads the rolling aggregates per polygon, room bucket and month written by
+9_build_trend_aggregates.py in the data scraping pipeline, for the trend
+view. The arrays are memory-mapped read-only, and a series is a slice of
+one of them, so nothing is aggregated when a trend is shown.
+"""
+
+import os
+import json
+import numpy as np
+
+
+def trends_exist(directory):
+    return os.path.isfile(os.path.join(directory, "meta.json"))
+
+
+class TrendAggregates(object):
+    def __init__(self, directory):
+        """ directory is the directory of one snapshot version and polygon layer. """
+        with open(os.path.join(directory, "meta.json"), encoding="utf8") as f:
+            self.meta = json.load(f)
+
+        self.polygons = {name: i for i, name in enumerate(self.meta["polygons"])}
+        self.room_buckets = self.meta["room_buckets"]
+        self.windows = self.meta["windows"]
+        self.months = np.datetime64(self.meta["first_month"], "M") + np.arange(self.meta["n_months"])
+        self.arrays = {
+            (statistic, window): np.load(os.path.join(directory, f"{statistic}_{window}.npy"), mmap_mode="r")
+            for statistic in self.meta["statistics"] for window in self.windows
+        }
+
+    def series(self, statistic, window, polygon, room_bucket):
+        """ Values of statistic over window months for each month, or None if there is no such polygon. """
+        if polygon not in self.polygons:
+            return None
+        return self.arrays[statistic, window][self.polygons[polygon], self.room_buckets.index(room_bucket)]
@@ -14,7 +14,7 @@ import logging
 import json
 import pandas as pd
 from helper_functions import setup_logging, get_settings, respectful_requesting, \
-                                missing_field_decorator, append_to_csv
+                                missing_field_decorator, append_to_csv, number_value
 from numpy.random import normal
 from working_dir import WORKING_DIR
 
@@ -22,10 +22,16 @@ from working_dir import WORKING_DIR
 URL_TEMPLATE = r"https://www.booli.se{listing_URL}"
 TARGET_DIR = os.path.join(WORKING_DIR, "data", "listings_data")
 SAVE_TO_FILE_EVERY_N_LISTINGS = 100
-# ------------------------------------------------------
 
-settings = get_settings()
-setup_logging(__file__)
+# Prices stored as integers (kr), from the raw values of Booli
+PRICE_COLUMNS = [
+    "estimate_price",
+    "estimate_low",
+    "estimate_high",
+    "listing_sold_price",
+    "listing_listed_price"
+]
+# ------------------------------------------------------
 
 class ParseProperty(object):
     def __init__(self, listing_id, listing_URL, apollo_state_json):
@@ -137,15 +143,15 @@ class ParseProperty(object):
         
     @missing_field_decorator
     def get_estimate(self):
-        return self.property_data["estimate"]["price"]["formatted"]
+        return number_value(self.property_data["estimate"]["price"])
     
     @missing_field_decorator
     def get_estimate_low(self):
-        return self.property_data["estimate"]["low"]["formatted"]
+        return number_value(self.property_data["estimate"]["low"])
     
     @missing_field_decorator
     def get_estimate_high(self):
-        return self.property_data["estimate"]["high"]["formatted"]
+        return number_value(self.property_data["estimate"]["high"])
 
     def get_areas(self):
         try:
@@ -239,8 +245,8 @@ class ParseListings(object):
             days_active = listing["daysActive"]
             sold_date = listing["soldDate"]
             sold_price_type = listing["soldPriceType"]
-            sold_price = listing["soldPrice"]["formatted"]
-            listed_price = listing["listPrice"]["formatted"]
+            sold_price = number_value(listing["soldPrice"])
+            listed_price = number_value(listing["listPrice"])
 
             data.append([
                 agent, 
@@ -333,84 +339,91 @@ def get_scraped_listings():
     else:
         return []
 
-# Make sure listing data is available
-listing_URLs_csv_path = os.path.join(WORKING_DIR, "data", "listings_URLs.csv")
-assert os.path.isfile(listing_URLs_csv_path), "Can't find 'listings_URLs.csv' in data folder"
+def main():
+    settings = get_settings()
+    setup_logging(__file__)
 
-# Create output folder, if not already present
-if not os.path.isdir(TARGET_DIR):
-    os.mkdir(TARGET_DIR)
+    # Make sure listing data is available
+    listing_URLs_csv_path = os.path.join(WORKING_DIR, "data", "listings_URLs.csv")
+    assert os.path.isfile(listing_URLs_csv_path), "Can't find 'listings_URLs.csv' in data folder"
 
-listing_URLs_df = pd.read_csv(listing_URLs_csv_path, delimiter=";", encoding="utf8", index_col=0)
-listing_URLs = listing_URLs_df.sort_values(by="listing_id").drop_duplicates()
+    # Create output folder, if not already present
+    if not os.path.isdir(TARGET_DIR):
+        os.mkdir(TARGET_DIR)
 
-# Get previously scraped listings to avoid scraping them again
-scraped_listings = get_scraped_listings()
+    listing_URLs_df = pd.read_csv(listing_URLs_csv_path, delimiter=";", encoding="utf8", index_col=0)
+    listing_URLs = listing_URLs_df.sort_values(by="listing_id").drop_duplicates()
 
-# Initialize dataframes
-listings_df = pd.DataFrame()
-property_to_area_df = pd.DataFrame()
-areas_df = pd.DataFrame()
-agents_df = pd.DataFrame()
+    # Get previously scraped listings to avoid scraping them again
+    scraped_listings = get_scraped_listings()
 
-for _, (listing_id, listing_URL) in listing_URLs.iterrows():
-    if listing_URL in scraped_listings:
-        logging.info(f"Already scraped {listing_URL}, continuing to next listing...")
-        continue
+    # Initialize dataframes
+    listings_df = pd.DataFrame()
+    property_to_area_df = pd.DataFrame()
+    areas_df = pd.DataFrame()
+    agents_df = pd.DataFrame()
 
-    curr_URL = URL_TEMPLATE.format(listing_URL=listing_URL)
-    status_code, data = respectful_requesting(curr_URL)
-    
-    # If a 404 is returned, log a warning and continue to next listing
-    if status_code == 404:
-        logging.warning(f"Status code 404 returned for {listing_URL}, continuing to next listing...")
-        continue
-
-    # Measure time for processing
-    start = time.time()
-
-    # Load the apollo state, containing json data for the page
-    apollo_state = re.findall(r'<script>window\.__APOLLO_STATE__ = (.+?)</script>', data)
-    if len(apollo_state) == 0:
-        raise(Exception("Could not find APOLLO_STATE."))
-    apollo_state_json = json.loads(apollo_state[0])
-    
-    try:
-        curr_property_df, curr_property_to_area_df = ParseProperty(listing_id, listing_URL, apollo_state_json).extract_data()
-        curr_areas_df = ParseAreas(apollo_state_json).extract_data()
-        curr_agents_df = ParseAgents(apollo_state_json).extract_data()
-        curr_listings_df = ParseListings(listing_id, listing_URL, apollo_state_json).extract_data()
-
-    except Exception as e:
-        logging.exception(e)
-        continue
-
-    # Merge listings and property df; replicate property df for multiple sales of same property
-    n_sales = len(curr_listings_df)
-    curr_property_df = pd.concat([curr_property_df] * n_sales, ignore_index=True)
-    curr_listings_df = pd.concat([curr_property_df, curr_listings_df], axis=1)
-
-    # Append to dataframes
-    listings_df = pd.concat([listings_df, curr_listings_df], ignore_index=True)
-    property_to_area_df = pd.concat([property_to_area_df, curr_property_to_area_df], ignore_index=True)
-    areas_df = pd.concat([areas_df, curr_areas_df], ignore_index=True)
-    agents_df = pd.concat([agents_df, curr_agents_df], ignore_index=True)
-
-    if len(listings_df) >= SAVE_TO_FILE_EVERY_N_LISTINGS:
-        # Save to CSV
-        append_to_csv(os.path.join(TARGET_DIR, "listings.csv"), listings_df)
-        append_to_csv(os.path.join(TARGET_DIR, "property_to_area.csv"), property_to_area_df)
-        append_to_csv(os.path.join(TARGET_DIR, "areas.csv"), areas_df, avoid_duplicates=True, key_column="area_id")
-        append_to_csv(os.path.join(TARGET_DIR, "agents.csv"), agents_df, avoid_duplicates=True, key_column="agent_id")
-        logging.info(f"Saved {len(listings_df)} scraped listings to file.")
-
-        # Reset dataframes
-        listings_df = pd.DataFrame()
-        property_to_area_df = pd.DataFrame()
-        areas_df = pd.DataFrame()
-        agents_df = pd.DataFrame()
-
-    logging.debug("Time elapsed for processing: " + str(time.time() - start))
-
-    if settings["debug"]:
-        break
\ No newline at end of file
+    for _, (listing_id, listing_URL) in listing_URLs.iterrows():
+        if listing_URL in scraped_listings:
+            logging.info(f"Already scraped {listing_URL}, continuing to next listing...")
+            continue
+
+        curr_URL = URL_TEMPLATE.format(listing_URL=listing_URL)
+        status_code, data = respectful_requesting(curr_URL)
+
+        # If a 404 is returned, log a warning and continue to next listing
+        if status_code == 404:
+            logging.warning(f"Status code 404 returned for {listing_URL}, continuing to next listing...")
+            continue
+
+        # Measure time for processing
+        start = time.time()
+
+        # Load the apollo state, containing json data for the page
+        apollo_state = re.findall(r'<script>window\.__APOLLO_STATE__ = (.+?)</script>', data)
+        if len(apollo_state) == 0:
+            raise(Exception("Could not find APOLLO_STATE."))
+        apollo_state_json = json.loads(apollo_state[0])
+
+        try:
+            curr_property_df, curr_property_to_area_df = ParseProperty(listing_id, listing_URL, apollo_state_json).extract_data()
+            curr_areas_df = ParseAreas(apollo_state_json).extract_data()
+            curr_agents_df = ParseAgents(apollo_state_json).extract_data()
+            curr_listings_df = ParseListings(listing_id, listing_URL, apollo_state_json).extract_data()
+
+        except Exception as e:
+            logging.exception(e)
+            continue
+
+        # Merge listings and property df; replicate property df for multiple sales of same property
+        n_sales = len(curr_listings_df)
+        curr_property_df = pd.concat([curr_property_df] * n_sales, ignore_index=True)
+        curr_listings_df = pd.concat([curr_property_df, curr_listings_df], axis=1)
+
+        # Append to dataframes
+        listings_df = pd.concat([listings_df, curr_listings_df], ignore_index=True)
+        property_to_area_df = pd.concat([property_to_area_df, curr_property_to_area_df], ignore_index=True)
+        areas_df = pd.concat([areas_df, curr_areas_df], ignore_index=True)
+        agents_df = pd.concat([agents_df, curr_agents_df], ignore_index=True)
+
+        if len(listings_df) >= SAVE_TO_FILE_EVERY_N_LISTINGS:
+            # Save to CSV
+            append_to_csv(os.path.join(TARGET_DIR, "listings.csv"), listings_df, integer_columns=PRICE_COLUMNS)
+            append_to_csv(os.path.join(TARGET_DIR, "property_to_area.csv"), property_to_area_df)
+            append_to_csv(os.path.join(TARGET_DIR, "areas.csv"), areas_df, avoid_duplicates=True, key_column="area_id")
+            append_to_csv(os.path.join(TARGET_DIR, "agents.csv"), agents_df, avoid_duplicates=True, key_column="agent_id")
+            logging.info(f"Saved {len(listings_df)} scraped listings to file.")
+
+            # Reset dataframes
+            listings_df = pd.DataFrame()
+            property_to_area_df = pd.DataFrame()
+            areas_df = pd.DataFrame()
+            agents_df = pd.DataFrame()
+
+        logging.debug("Time elapsed for processing: " + str(time.time() - start))
+
+        if settings["debug"]:
+            break
+
+if __name__ == "__main__":
+    main()
@@ -10,17 +10,22 @@ import json
 import pandas as pd
 import numpy as np
 from helper_functions import setup_logging, get_settings, respectful_requesting, \
-                                missing_field_decorator, append_to_csv
+                                missing_field_decorator, append_to_csv, number_value
 from numpy.random import normal
 from working_dir import WORKING_DIR
 # ----------------------- CONFIG -----------------------
 URL_TEMPLATE = r"https://www.booli.se{brf_URL}"
 TARGET_DIR = os.path.join(WORKING_DIR, "data", "brf_data")
 LISTINGS_CSV = os.path.join(WORKING_DIR, "data", "listings_data", "listings_data.csv")
-# ------------------------------------------------------
 
-settings = get_settings()
-setup_logging(__file__) # Formats logging and store warnings/exceptions to file
+# Columns stored as integers, from the raw values of Booli
+INTEGER_COLUMNS = [
+    "brf_annual_report_rental_units",
+    "brf_annual_report_units",
+    "brf_annual_report_savings",
+    "brf_annual_report_total_loan"
+]
+# ------------------------------------------------------
 
 class ParseBRF(object):
     def __init__(self, brf_URL, apollo_state_json):
@@ -73,15 +78,15 @@ class ParseBRF(object):
 
     @missing_field_decorator
     def get_annual_report_leased_units(self):
-        return self.annual_report["numberOfRentalUnits"]["formatted"]
+        return number_value(self.annual_report["numberOfRentalUnits"])
 
     @missing_field_decorator
     def get_annual_report_units(self):
-        return self.annual_report["numberOfUnits"]["formatted"]
+        return number_value(self.annual_report["numberOfUnits"])
     
     @missing_field_decorator
     def get_annual_report_savings(self):
-        return self.annual_report["savings"]["formatted"]
+        return number_value(self.annual_report["savings"])
     
     @missing_field_decorator
     def get_annual_report_commercial_area(self):
@@ -97,7 +102,7 @@ class ParseBRF(object):
 
     @missing_field_decorator
     def get_annual_report_total_loan(self):
-        return self.annual_report["totalLoan"]["formatted"]
+        return number_value(self.annual_report["totalLoan"])
 
     @missing_field_decorator
     def get_annual_report_plot_area(self):
@@ -137,49 +142,56 @@ def get_scraped_IDs():
     else:
         return []
 
-# Make sure listing data is available
-assert os.path.isfile(LISTINGS_CSV), "Can't find file 'listings_data.csv'"
+def main():
+    settings = get_settings()
+    setup_logging(__file__) # Formats logging and store warnings/exceptions to file
 
-# Create output folder, if not already present
-if not os.path.isdir(TARGET_DIR):
-    os.mkdir(TARGET_DIR)
+    # Make sure listing data is available
+    assert os.path.isfile(LISTINGS_CSV), "Can't find file 'listings_data.csv'"
 
-# Get brf URLs to scrape
-brf_URLs = get_brf_URLs()
+    # Create output folder, if not already present
+    if not os.path.isdir(TARGET_DIR):
+        os.mkdir(TARGET_DIR)
 
-# Get previously scraped URLs to avoid scraping them again
-scraped_IDs = get_scraped_IDs()
+    # Get brf URLs to scrape
+    brf_URLs = get_brf_URLs()
 
-# Initialize dataframe
-for brf_URL in brf_URLs:
-    brf_id = int(brf_URL.split("/")[-1])
-    if brf_id in scraped_IDs:
-        logging.info(f"Already scraped {brf_URL}, continuing to next listing...")
-        continue
+    # Get previously scraped URLs to avoid scraping them again
+    scraped_IDs = get_scraped_IDs()
 
-    curr_URL = URL_TEMPLATE.format(brf_URL=brf_URL)
-    status_code, data = respectful_requesting(curr_URL)
-    
-    # If a 404 is returned, log a warning and continue to next listing
-    if status_code == 404:
-        logging.warning(f"Status code 404 returned for {brf_URL}, continuing to next listing...")
-        continue
-
-    # Load the apollo state, containing json data for the page
-    apollo_state = re.findall(r'<script>window\.__APOLLO_STATE__ = (.+?)</script>', data)
-    if len(apollo_state) == 0:
-        raise(Exception("Could not find APOLLO_STATE."))
-    apollo_state_json = json.loads(apollo_state[0])
-    
-    try:
-        brf_df = ParseBRF(brf_URL, apollo_state_json).extract_data()
+    # Initialize dataframe
+    for brf_URL in brf_URLs:
+        brf_id = int(brf_URL.split("/")[-1])
+        if brf_id in scraped_IDs:
+            logging.info(f"Already scraped {brf_URL}, continuing to next listing...")
+            continue
+
+        curr_URL = URL_TEMPLATE.format(brf_URL=brf_URL)
+        status_code, data = respectful_requesting(curr_URL)
+
+        # If a 404 is returned, log a warning and continue to next listing
+        if status_code == 404:
+            logging.warning(f"Status code 404 returned for {brf_URL}, continuing to next listing...")
+            continue
+
+        # Load the apollo state, containing json data for the page
+        apollo_state = re.findall(r'<script>window\.__APOLLO_STATE__ = (.+?)</script>', data)
+        if len(apollo_state) == 0:
+            raise(Exception("Could not find APOLLO_STATE."))
+        apollo_state_json = json.loads(apollo_state[0])
+
+        try:
+            brf_df = ParseBRF(brf_URL, apollo_state_json).extract_data()
+
+        except Exception as e:
+            logging.exception(e)
+            continue
 
-    except Exception as e:
-        logging.exception(e)
-        continue
+        # Save to CSV
+        append_to_csv(os.path.join(TARGET_DIR, "brf_data.csv"), brf_df, integer_columns=INTEGER_COLUMNS)
 
-    # Save to CSV
-    append_to_csv(os.path.join(TARGET_DIR, "brf_data.csv"), brf_df)
+        if settings["debug"]:
+            break
 
-    if settings["debug"]:
-        break
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,154 @@
 import os
 import json
 import logging
-import pandas as pd
+import time
 import numpy as np
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
+import pandas as pd
 from helper_functions import setup_logging
+from polygon_raster import load_or_build_polygon_raster
+from spatial_join import PolygonLayer
 from working_dir import WORKING_DIR
 
 # ----------------------- CONFIG -----------------------
 LISTINGS_CSV = os.path.join(WORKING_DIR, "data", "listings_data", "listings_data.csv")
-POLYGONS_GEOJSON = os.path.join(WORKING_DIR, "data", "area_polygons", "polygons.geojson")
+LISTING_POLYGONS_CSV = os.path.join(WORKING_DIR, "data", "listings_data", "listing_polygons.csv")
+POLYGONS_DIR = os.path.join(WORKING_DIR, "data", "area_polygons")
+
+# Polygon layers to assign listings to. Each layer is a GeoJSON file in 
+# POLYGONS_DIR, and gives the columns <prefix>_id and <prefix>_name.
+POLYGON_LAYERS_JSON = os.path.join(POLYGONS_DIR, "layers.json")
+RASTER_CACHE_DIR = os.path.join(POLYGONS_DIR, "raster_cache")
+
+USE_POLYGON_RASTER = True # If False, test every listing against the polygons with shapely
+RASTER_RESOLUTION = 0.00025 # Cell size in degrees, roughly 28 x 14 m in Stockholm
+
+# If True, only resolve properties that are new or have moved since the last run,
+# and store the result in LISTING_POLYGONS_CSV (keyed by property_id) instead of
+# rewriting LISTINGS_CSV.
+INCREMENTAL = True
 # ------------------------------------------------------
 
-setup_logging(__file__) # Formats logging and store warnings/exceptions to file
+def load_polygon_layer(layer):
+    """ 
+    Returns the layer and its assignment function. The layer's raster is 
+    cached on disk, and only rebuilt when the layer's GeoJSON file changes.
+    """
+    geojson_path = os.path.join(POLYGONS_DIR, layer["file"])
+
+    if USE_POLYGON_RASTER:
+        polygon_layer = load_or_build_polygon_raster(
+            geojson_path, 
+            os.path.join(RASTER_CACHE_DIR, layer["prefix"]), 
+            resolution=RASTER_RESOLUTION,
+            id_property=layer["id_property"],
+            name_property=layer["name_property"]
+        )
+        return polygon_layer, polygon_layer.lookup
+
+    polygon_layer = PolygonLayer.from_geojson(
+        geojson_path, 
+        id_property=layer["id_property"], 
+        name_property=layer["name_property"]
+    )
+    return polygon_layer, polygon_layer.assign
+
+def same_coordinates(a, b):
+    """ 
+    Elementwise equality of two coordinate series, up to the rounding of the 
+    CSV round trip, where two NaNs are equal. 
+    """
+    a, b = a.values.astype(np.float64), b.values.astype(np.float64)
+    return np.isclose(a, b, rtol=0, atol=1e-9) | (np.isnan(a) & np.isnan(b))
+
+def get_previous_assignments(polygon_layers):
+    """
+    Returns the side table from the previous incremental run, without the 
+    columns of the polygon_layers whose polygons have changed since it was
+    written.
+    """
+    if not os.path.isfile(LISTING_POLYGONS_CSV):
+        return pd.DataFrame(columns=["latitude", "longitude"], index=pd.Index([], name="property_id"))
+
+    assigned = pd.read_csv(
+        LISTING_POLYGONS_CSV, 
+        sep=";", 
+        encoding="utf8", 
+        index_col="property_id",
+        dtype={f"{layer['prefix']}_{c}": "str" for layer in polygon_layers for c in ["id", "name"]}
+    )
+
+    for layer in polygon_layers:
+        geojson_path = os.path.join(POLYGONS_DIR, layer["file"])
+        if os.path.getmtime(geojson_path) > os.path.getmtime(LISTING_POLYGONS_CSV):
+            logging.info(f"Polygons of layer '{layer['prefix']}' have changed since the last run, " + 
+                         "reassigning all listings")
+            assigned = assigned.drop(columns=[f"{layer['prefix']}_id", f"{layer['prefix']}_name"], 
+                                     errors="ignore")
+
+    return assigned
+
+def main():
+    setup_logging(__file__) # Formats logging and store warnings/exceptions to file
+
+    # Make sure listing data is available
+    assert os.path.isfile(LISTINGS_CSV), "Can't find file 'listings_data.csv'"
+
+    with open(POLYGON_LAYERS_JSON, encoding="utf-8") as f:
+        polygon_layers = json.load(f)
+
+    if INCREMENTAL:
+        # Only the coordinates are needed, one row per property
+        df = pd.read_csv(
+            LISTINGS_CSV, 
+            sep=";", 
+            encoding="utf8", 
+            usecols=["property_id", "latitude", "longitude"]
+        )
+        df = df.drop_duplicates(subset="property_id", keep="last").set_index("property_id")
 
-# Make sure listing data is available
-assert os.path.isfile(LISTINGS_CSV), "Can't find file 'listings_data.csv'"
+        previous = get_previous_assignments(polygon_layers).reindex(df.index)
+        moved = ~(same_coordinates(df["latitude"], previous["latitude"]) & 
+                  same_coordinates(df["longitude"], previous["longitude"]))
+    else:
+        df = pd.read_csv(
+            LISTINGS_CSV, 
+            sep=";", 
+            encoding="utf8",
+            index_col=0, 
+            low_memory=False
+        )
 
-df = pd.read_csv(
-    LISTINGS_CSV, 
-    sep=";", 
-    encoding="utf8",
-    index_col=0, 
-    low_memory=False
-)
+    latitudes = df["latitude"].values
+    longitudes = df["longitude"].values
 
-with open(POLYGONS_GEOJSON, encoding='utf-8') as f:
-    polygon_data = json.load(f)
+    # Resolve every layer over the same coordinate arrays
+    for layer in polygon_layers:
+        id_col, name_col = f"{layer['prefix']}_id", f"{layer['prefix']}_name"
 
-df["polygon_id"] = None
-df["polygon_name"] = None
+        start = time.time()
+        polygon_layer, assign = load_polygon_layer(layer)
+        logging.info(f"Loaded {len(polygon_layer)} polygons of layer '{layer['prefix']}' " + 
+                     f"in {time.time() - start:.2f} seconds")
 
-pol = np.array(polygon_data["features"][0]["geometry"]["coordinates"][0])
-areas = polygon_data["features"]
+        # Select properties without an assigned polygon, or whose coordinates changed
+        if INCREMENTAL and id_col in previous.columns:
+            df[id_col], df[name_col] = previous[id_col], previous[name_col]
+            to_resolve = (previous[id_col].isna().values | moved)
+        else:
+            df[id_col], df[name_col] = None, None
+            to_resolve = np.ones(len(df), dtype=bool)
 
-for ind, row in df.iterrows():
-    lat = row["latitude"]
-    long = row["longitude"]
-    
-    for area in areas:
-        polygon = Polygon(area["geometry"]["coordinates"][0])
-        point = Point(long, lat)
+        start = time.time()
+        codes = assign(latitudes[to_resolve], longitudes[to_resolve])
+        df.loc[to_resolve, id_col], df.loc[to_resolve, name_col] = polygon_layer.to_columns(codes)
 
-        if point.within(polygon):
-            polygon_id = area["properties"]["NYCKELKOD_"]
-            polygon_name = area["properties"]["NAMN"]
-            
-            df.loc[ind, "polygon_id"] = polygon_id
-            df.loc[ind, "polygon_name"] = polygon_name
-            break
-    if ind % 1000 == 0:
-        logging.info(f"Assigned {ind} listings to polygons")
+        logging.info(f"Assigned {(codes >= 0).sum()} of {to_resolve.sum()} listings to layer " + 
+                     f"'{layer['prefix']}' in {time.time() - start:.2f} seconds")
 
+    if INCREMENTAL:
+        df.sort_index().to_csv(LISTING_POLYGONS_CSV, sep=";", encoding="utf8")
+    else:
+        df.to_csv(LISTINGS_CSV, sep=";", encoding="utf8")
 
-df.to_csv(LISTINGS_CSV, sep=";", encoding="utf8")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+""" BUILD DASHBOARD SNAPSHOT
+Parses listings_data.csv once, with vectorized string operations, into a typed
+columnar snapshot that the dashboard memory-maps at startup instead of parsing
+the CSV. The snapshot is a directory of .npy files and a meta.json describing
+the columns:
+    - Numeric columns are stored in their final (narrowed) dtype, with all
+      columns of a dtype in one 2D array (<dtype>.block.npy, one row per
+      column). The dashboard maps each block as is into its DataFrame, so
+      that all worker processes share the pages of the file read-only,
+      without copying or converting anything.
+    - Datetime columns are stored as is (<column>.npy).
+    - String columns are dictionary encoded, i.e. stored as integer codes
+      (<column>.codes.npy) into a list of categories (<column>.categories.json),
+      where -1 means missing.
+Prices are read as numbers, as stored by stage 3 (files written before it did
+are converted once by migrate_formatted_numbers.py). Columns derived from
+others, such as the price per m², are computed here once instead of in every
+dashboard process. These include the hexagonal cell of every listing at each
+size in HEX_SIZES, for the hexbin plot of the dashboard, as packed axial
+coordinates (hex_<size>, see hex_grid.py in the dashboard). The sizes and
+HEX_GRID_FORMAT are recorded in meta.json, and the dashboard only uses the
+cells if both match its own grid. The listings are sorted by listing_sold_date.
+
+Every run writes a new version of the snapshot to its own directory in
+dashboard_snapshot, named by the time it was built, and then points the file
+CURRENT in dashboard_snapshot to it. A running dashboard picks up the new
+version from CURRENT and swaps to it, while still serving the previous one
+until then. Versions are never modified once written, and the oldest are
+removed, keeping KEEP_VERSIONS of them.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+from helper_functions import setup_logging
+from working_dir import WORKING_DIR
+
+# ----------------------- CONFIG -----------------------
+LISTINGS_CSV = os.path.join(WORKING_DIR, "data", "listings_data", "listings_data.csv")
+LISTING_POLYGONS_CSV = os.path.join(WORKING_DIR, "data", "listings_data", "listing_polygons.csv")
+SNAPSHOT_DIR = os.path.join(WORKING_DIR, "data", "dashboard_snapshot")
+
+# Number of snapshot versions to keep. Dashboard processes that have not swapped
+# to the newest version yet still read (cold columns of) the previous ones.
+KEEP_VERSIONS = 3
+
+NUMERIC_COLUMNS = {
+    'property_id': np.uint32,
+    'latitude': np.float64,
+    'longitude': np.float64,
+    'construction_year': np.float64,
+    'rent': np.float64,
+    'rooms': np.float64,
+    'sqm': np.float64,
+    'operating_cost': np.float64,
+    'listing_days_active': np.uint32,
+    # Prices, stored as integers by stage 3 (or migrate_formatted_numbers.py)
+    'estimate_price': np.float64,
+    'estimate_low': np.float64,
+    'estimate_high': np.float64,
+    'listing_sold_price': np.float64,
+    'listing_listed_price': np.float64,
+}
+
+# Narrower dtypes where the value range allows. The dashboard uses the columns
+# in the dtypes they are stored with, as recorded in meta.json.
+# Prices as float32 are exact up to 16 777 216 kr, and within a krona up to
+# twice that.
+COMPACT_DTYPES = {
+    'construction_year': np.float32,
+    'rent': np.float32,
+    'rooms': np.float32,
+    'sqm': np.float32,
+    'operating_cost': np.float32,
+    'listing_days_active': np.uint16,
+    'estimate_price': np.float32,
+    'estimate_low': np.float32,
+    'estimate_high': np.float32,
+    'listing_sold_price': np.float32,
+    'listing_listed_price': np.float32,
+    'listing_sold_price_per_sqm': np.float32,
+    'listing_rent_per_sqm': np.float32,
+}
+
+# Sizes (Web Mercator metres from center to corner) of the hex cells the
+# listings are assigned to, those of HEX_ZOOM_LEVELS in the dashboard
+HEX_SIZES = [4000, 2000, 1000, 500, 250]
+
+# Version of the grid and packing of hex_cell_ids, GRID_FORMAT in hex_grid.py
+# of the dashboard. Bump both whenever either changes.
+HEX_GRID_FORMAT = 1
+# ------------------------------------------------------
+
+def hex_cell_ids(longitudes, latitudes, sizes):
+    """
+    Packed axial coordinates of the pointy-top hexagon containing each
+    listing, for each of sizes, as a dict of arrays by size, -1 for listings
+    without coordinates. The projection is computed once for all sizes. Same
+    grid and packing as hex_grid.py in the dashboard.
+    """
+    earth_radius = 6378137.0
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    located = np.isfinite(longitudes) & np.isfinite(latitudes)
+    x = np.radians(longitudes[located]) * earth_radius
+    y = np.log(np.tan(np.pi / 4 + np.radians(latitudes[located]) / 2)) * earth_radius
+
+    cells = {}
+    for size in sizes:
+        fractional_q = (np.sqrt(3) / 3 * x - y / 3) / size
+        fractional_r = 2 / 3 * y / size
+        fractional_s = -fractional_q - fractional_r
+
+        # Round to the nearest cell in cube coordinates, where q + r + s = 0
+        q, r, s = np.round(fractional_q), np.round(fractional_r), np.round(fractional_s)
+        q_error, r_error, s_error = np.abs(q - fractional_q), np.abs(r - fractional_r), np.abs(s - fractional_s)
+        fix_q = (q_error > r_error) & (q_error > s_error)
+        fix_r = ~fix_q & (r_error > s_error)
+        q, r = np.where(fix_q, -r - s, q), np.where(fix_r, -q - s, r)
+
+        cells[size] = np.full(len(longitudes), -1, dtype=np.int64)
+        cells[size][located] = ((r.astype(np.int64) + (1 << 30)) << 31) | (q.astype(np.int64) + (1 << 30))
+    return cells
+
+def read_listings():
+    # Read every column as strings and convert the typed ones in bulk
+    df = pd.read_csv(
+        LISTINGS_CSV,
+        sep=";",
+        encoding="utf8",
+        dtype=str,
+        index_col=0
+    )
+
+    for c, dtype in NUMERIC_COLUMNS.items():
+        df[c] = pd.to_numeric(df[c]).astype(dtype)
+
+    # Align area names format somewhat
+    df["descriptive_area_name"] = df["descriptive_area_name"] \
+        .str.replace(" ?(-|/) ?", " ", regex=True) \
+        .str.title()
+
+    df["listing_sold_date"] = pd.to_datetime(df["listing_sold_date"])
+
+    # Polygons assigned incrementally by stage 7 take precedence
+    if os.path.isfile(LISTING_POLYGONS_CSV):
+        listing_polygons = pd.read_csv(
+            LISTING_POLYGONS_CSV,
+            sep=";",
+            encoding="utf8",
+            dtype=str,
+            index_col="property_id"
+        )
+        listing_polygons.index = listing_polygons.index.astype(np.uint32)
+        listing_polygons = listing_polygons.drop(columns=["latitude", "longitude"])
+        df = df.drop(columns=listing_polygons.columns, errors="ignore")
+        df = df.join(listing_polygons, on="property_id")
+
+    # Derived columns, computed before narrowing the dtypes
+    df["listing_sold_price_per_sqm"] = (df["listing_sold_price"] / df["sqm"]).round(0)
+    df["listing_rent_per_sqm"] = (df["rent"] / df["sqm"]).round(0)
+    for size, cells in hex_cell_ids(df["longitude"].values, df["latitude"].values, HEX_SIZES).items():
+        df[f"hex_{size}"] = cells
+
+    for c, dtype in COMPACT_DTYPES.items():
+        df[c] = df[c].astype(dtype)
+
+    # The dashboard relies on the listings being sorted by sold date
+    df = df.sort_values("listing_sold_date", kind="mergesort", na_position="last")
+
+    return df.reset_index(drop=True)
+
+def write_snapshot(df, directory):
+    """
+    Writes df as a snapshot to directory. The snapshot is written to a
+    temporary directory first, so a partially written snapshot is never read.
+    """
+    temp_directory = directory + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+
+    columns = {}
+    blocks = {}
+    for name, col in df.items():
+        if pd.api.types.is_datetime64_dtype(col):
+            np.save(os.path.join(temp_directory, f"{name}.npy"), col.values)
+            columns[name] = {"kind": "datetime"}
+        elif pd.api.types.is_numeric_dtype(col):
+            blocks.setdefault(str(col.dtype), []).append(name)
+            columns[name] = {"kind": "numeric", "block": str(col.dtype), "index": len(blocks[str(col.dtype)]) - 1}
+        else:
+            categorical = pd.Categorical(col)
+            np.save(os.path.join(temp_directory, f"{name}.codes.npy"), categorical.codes)
+            with open(os.path.join(temp_directory, f"{name}.categories.json"), "w", encoding="utf8") as f:
+                json.dump(categorical.categories.tolist(), f, ensure_ascii=False)
+            columns[name] = {"kind": "categorical"}
+
+        columns[name]["dtype"] = str(col.dtype)
+
+    for dtype, names in blocks.items():
+        np.save(os.path.join(temp_directory, f"{dtype}.block.npy"), np.vstack([df[name].values for name in names]))
+
+    with open(os.path.join(temp_directory, "meta.json"), "w", encoding="utf8") as f:
+        json.dump({
+            "n_rows": len(df),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            "columns": columns,
+            "blocks": blocks,
+            "hex_grid": {"format": HEX_GRID_FORMAT, "sizes": HEX_SIZES}
+        }, f, indent=4)
+
+    os.rename(temp_directory, directory)
+
+def publish_version(snapshot_dir, version):
+    """ Points CURRENT to version, replacing the file so it is never read half written. """
+    temp_path = os.path.join(snapshot_dir, "CURRENT.tmp")
+    with open(temp_path, "w", encoding="utf8") as f:
+        f.write(version)
+    os.replace(temp_path, os.path.join(snapshot_dir, "CURRENT"))
+
+def remove_old_versions(snapshot_dir, keep):
+    """ Removes all but the keep newest versions, never the current one. """
+    with open(os.path.join(snapshot_dir, "CURRENT"), encoding="utf8") as f:
+        current = f.read().strip()
+
+    # Version names sort in the order they were built
+    versions = sorted(
+        e.name for e in os.scandir(snapshot_dir) if e.is_dir() and not e.name.endswith(".tmp")
+    )
+    for version in versions[:max(0, len(versions) - keep)]:
+        if version != current:
+            shutil.rmtree(os.path.join(snapshot_dir, version), ignore_errors=True)
+            logging.info(f"Removed snapshot version {version}")
+
+    # Files of a snapshot written directly to snapshot_dir, before it had versions
+    for e in os.scandir(snapshot_dir):
+        if e.is_file() and e.name != "CURRENT":
+            os.remove(e.path)
+
+def main():
+    setup_logging(__file__) # Formats logging and store warnings/exceptions to file
+
+    # Make sure listing data is available
+    assert os.path.isfile(LISTINGS_CSV), "Can't find file 'listings_data.csv'"
+
+    start = time.time()
+    df = read_listings()
+    logging.info(f"Parsed {len(df)} listings in {time.time() - start:.2f} seconds")
+
+    # Name the version by the build time, made unique if built twice in a second
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    version = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+    if os.path.exists(os.path.join(SNAPSHOT_DIR, version)):
+        version += f"-{time.time_ns() % 1_000_000_000:09d}"
+
+    start = time.time()
+    write_snapshot(df, os.path.join(SNAPSHOT_DIR, version))
+    publish_version(SNAPSHOT_DIR, version)
+    logging.info(f"Wrote snapshot version {version} to {SNAPSHOT_DIR} in {time.time() - start:.2f} seconds")
+
+    remove_old_versions(SNAPSHOT_DIR, KEEP_VERSIONS)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+""" BUILD TREND AGGREGATES
+Precomputes rolling aggregates of the sold listings per polygon, room bucket
+and month, for the trend view of the dashboard, so that it only slices
+arrays instead of grouping the listings on every request. For every window
+in WINDOWS (in months), the aggregates of a month are over the listings sold
+in that month and the window - 1 months before it:
+    - median and mean price per m²,
+    - number of listings sold,
+    - mean number of days the listings were active.
+Medians are exact: the prices of every polygon, room bucket and month are
+expanded into the months of the windows they are in, and sorted once. That
+takes an int64 key per priced listing and month of the window, and as much
+again to sort them: about 2 * 8 * 12 = 192 bytes per priced listing for the
+12-month window. Every listing is also in ALL_AREAS, ALL_ROOMS and both,
+which would make it four times that, so the medians of each of those and
+of the polygons and room buckets themselves are computed one at a time.
+
+The aggregates are also computed over all polygons (as ALL_AREAS) and all
+numbers of rooms (as ALL_ROOMS). They are computed from the current
+dashboard snapshot (see 8_build_dashboard_snapshot.py), and written next to
+it, per snapshot version and polygon layer, to
+    trend_aggregates/<snapshot version>/<layer prefix>/
+as one array of shape (polygons, room buckets, months) per statistic and
+window (<statistic>_<window>.npy), and meta.json naming the polygons, room
+buckets and months. The dashboard memory-maps them. A version that has
+already been built is skipped, and the versions of removed snapshots are
+removed.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+from helper_functions import setup_logging
+from working_dir import WORKING_DIR
+
+# ----------------------- CONFIG -----------------------
+SNAPSHOT_DIR = os.path.join(WORKING_DIR, "data", "dashboard_snapshot")
+TREND_AGGREGATES_DIR = os.path.join(WORKING_DIR, "data", "trend_aggregates")
+POLYGON_LAYERS_JSON = os.path.join(WORKING_DIR, "data", "area_polygons", "layers.json")
+
+WINDOWS = [3, 12] # Months
+
+# Room buckets by lower limit of the number of rooms, the last without upper limit
+ROOM_BUCKETS = {"1-1.5": 1, "2-2.5": 2, "3-3.5": 3, "4-4.5": 4, "5+": 5}
+
+# Names of the aggregates over all polygons and all room buckets. ALL_AREAS
+# matches the dashboard, which also shows it in the repeat-sales index.
+ALL_AREAS = "All areas"
+ALL_ROOMS = "All"
+# ------------------------------------------------------
+
+def read_columns(snapshot_dir, names):
+    """ Columns of a dashboard snapshot, as arrays, and string columns as pd.Categorical. """
+    with open(os.path.join(snapshot_dir, "meta.json"), encoding="utf8") as f:
+        meta = json.load(f)
+
+    columns = {}
+    for name in names:
+        column = meta["columns"][name]
+        if column["kind"] == "numeric":
+            block = np.load(os.path.join(snapshot_dir, f"{column['block']}.block.npy"), mmap_mode="r")
+            columns[name] = block[column["index"]]
+        elif column["kind"] == "datetime":
+            columns[name] = np.load(os.path.join(snapshot_dir, f"{name}.npy"), mmap_mode="r")
+        else:
+            codes = np.load(os.path.join(snapshot_dir, f"{name}.codes.npy"))
+            with open(os.path.join(snapshot_dir, f"{name}.categories.json"), encoding="utf8") as f:
+                columns[name] = pd.Categorical.from_codes(codes, categories=json.load(f))
+    return columns
+
+def rolling_sums(cells, months, values, n_cells, n_months, window):
+    """ Rolling sums over window months of values per cell, as an array of shape (cells, months). """
+    sums = np.bincount(cells * n_months + months, weights=values, minlength=n_cells * n_months)
+    sums = np.cumsum(sums.reshape(n_cells, n_months), axis=1)
+    sums[:, window:] = sums[:, window:] - sums[:, :-window]
+    return sums
+
+def rolling_medians(cells, months, values, n_cells, n_months, window):
+    """
+    Rolling medians over window months of values (non-negative) per cell, as
+    an array of shape (cells, months), NaN where there are no values. Every
+    value is repeated for the months of the windows it is in, as a key of its
+    cell and month in the upper 32 bits and the value in the lower 32 bits.
+    Sorting the keys sorts the values of each window, without an argsort.
+    """
+    values = values.astype(np.float32)
+    assert (values >= 0).all(), "Values must be non-negative to sort by their bits."
+    value_bits = values.view(np.uint32).astype(np.int64)
+    medians = np.full(n_cells * n_months, np.nan, dtype=np.float32)
+    if len(values) == 0:
+        return medians.reshape(n_cells, n_months)
+
+    keys = []
+    for offset in range(window):
+        in_range = months + offset < n_months
+        window_cells = cells[in_range] * n_months + months[in_range] + offset
+        keys.append((window_cells.astype(np.int64) << 32) | value_bits[in_range])
+    keys = np.sort(np.concatenate(keys))
+
+    window_cells = keys >> 32
+    sorted_values = (keys & 0xFFFFFFFF).astype(np.uint32).view(np.float32)
+    starts = np.flatnonzero(np.r_[True, window_cells[1:] != window_cells[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+
+    medians[window_cells[starts]] = (
+        sorted_values[starts + (counts - 1) // 2].astype(np.float64) + sorted_values[starts + counts // 2]
+    ) / 2
+    return medians.reshape(n_cells, n_months)
+
+def trend_aggregates(polygons, rooms, sold_dates, price_per_sqm, days_active):
+    """
+    Rolling aggregates per polygon, room bucket and month. Returns a dict of
+    arrays of shape (polygons + 1, room buckets + 1, months) by (statistic,
+    window), where the last polygon and room bucket are all of them, and the
+    first month. There must be sales with a sold date.
+    """
+    dated = ~np.isnat(sold_dates)
+    polygons, rooms, sold_dates = polygons[dated], rooms[dated], sold_dates[dated]
+    price_per_sqm = price_per_sqm[dated].astype(np.float64)
+    days_active = days_active[dated].astype(np.float64)
+
+    months = sold_dates.astype("datetime64[M]")
+    first_month = months.min()
+    months = (months - first_month).astype(np.int64)
+    n_months = months.max() + 1
+
+    # Polygon -1 is none, and room bucket -1 too, they only count in ALL_AREAS and ALL_ROOMS
+    polygon_codes = np.asarray(polygons.codes, dtype=np.int64)
+    n_polygons = len(polygons.categories)
+    with np.errstate(invalid="ignore"):
+        buckets = np.searchsorted(list(ROOM_BUCKETS.values()), rooms, side="right") - 1
+    buckets[np.isnan(rooms)] = -1
+    n_buckets = len(ROOM_BUCKETS)
+
+    # Every listing is in four cells: its polygon and bucket, and all of either or both
+    n_cells = (n_polygons + 1) * (n_buckets + 1)
+    variants = [
+        (polygon_codes, buckets),
+        (polygon_codes, np.full(len(buckets), n_buckets)),
+        (np.full(len(polygon_codes), n_polygons), buckets),
+        (np.full(len(polygon_codes), n_polygons), np.full(len(buckets), n_buckets))
+    ]
+    cells, listings, variant_ids = [], [], []
+    for i, (variant_polygons, variant_buckets) in enumerate(variants):
+        valid = np.flatnonzero((variant_polygons >= 0) & (variant_buckets >= 0))
+        cells.append(variant_polygons[valid] * (n_buckets + 1) + variant_buckets[valid])
+        listings.append(valid)
+        variant_ids.append(np.full(len(valid), i))
+    cells, listings, variant_ids = np.concatenate(cells), np.concatenate(listings), np.concatenate(variant_ids)
+    months = months[listings]
+    prices, days = price_per_sqm[listings], days_active[listings]
+    has_price, has_days = ~np.isnan(prices), ~np.isnan(days)
+
+    aggregates = {}
+    shape = (n_polygons + 1, n_buckets + 1, n_months)
+    for window in WINDOWS:
+        count = rolling_sums(cells, months, np.ones(len(cells)), n_cells, n_months, window)
+        price_count = rolling_sums(cells[has_price], months[has_price], np.ones(has_price.sum()), n_cells, n_months, window)
+        price_sum = rolling_sums(cells[has_price], months[has_price], prices[has_price], n_cells, n_months, window)
+        days_count = rolling_sums(cells[has_days], months[has_days], np.ones(has_days.sum()), n_cells, n_months, window)
+        days_sum = rolling_sums(cells[has_days], months[has_days], days[has_days], n_cells, n_months, window)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            aggregates["count", window] = np.round(count).astype(np.uint32).reshape(shape)
+            aggregates["mean", window] = (price_sum / price_count).astype(np.float32).reshape(shape)
+            aggregates["days_active", window] = (days_sum / days_count).astype(np.float32).reshape(shape)
+
+        # The cells of the variants are distinct, so their medians are computed one at a time
+        medians = np.full((n_cells, n_months), np.nan, dtype=np.float32)
+        for i in range(len(variants)):
+            in_variant = has_price & (variant_ids == i)
+            variant_medians = rolling_medians(
+                cells[in_variant], months[in_variant], prices[in_variant], n_cells, n_months, window
+            )
+            filled = ~np.isnan(variant_medians)
+            medians[filled] = variant_medians[filled]
+        aggregates["median", window] = medians.reshape(shape)
+
+    return aggregates, first_month
+
+def write_aggregates(directory, aggregates, first_month, polygon_names, snapshot_version):
+    """ Writes the aggregates to directory, via a temporary directory so they are never read half written. """
+    temp_directory = directory + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+
+    for (statistic, window), values in aggregates.items():
+        np.save(os.path.join(temp_directory, f"{statistic}_{window}.npy"), values)
+
+    n_months = next(iter(aggregates.values())).shape[2]
+    with open(os.path.join(temp_directory, "meta.json"), "w", encoding="utf8") as f:
+        json.dump({
+            "snapshot_version": snapshot_version,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            "polygons": [*polygon_names, ALL_AREAS],
+            "room_buckets": [*ROOM_BUCKETS, ALL_ROOMS],
+            "first_month": str(first_month),
+            "n_months": int(n_months),
+            "windows": WINDOWS,
+            "statistics": sorted({statistic for statistic, _ in aggregates})
+        }, f, indent=4, ensure_ascii=False)
+
+    os.rename(temp_directory, directory)
+
+def remove_old_versions(aggregates_dir, snapshot_dir):
+    """ Removes the aggregates of snapshot versions that no longer exist, and those left half written. """
+    for e in os.scandir(aggregates_dir):
+        if e.is_dir() and (e.name.endswith(".tmp") or not os.path.isdir(os.path.join(snapshot_dir, e.name))):
+            shutil.rmtree(e.path, ignore_errors=True)
+            logging.info(f"Removed trend aggregates {e.name}")
+
+def build_version(version, version_dir, prefixes):
+    """ Builds the trend aggregates of every polygon layer of snapshot version into version_dir. """
+    start = time.time()
+    columns = read_columns(
+        os.path.join(SNAPSHOT_DIR, version),
+        ["rooms", "listing_sold_date", "listing_sold_price_per_sqm", "listing_days_active"] +
+        [f"{prefix}_name" for prefix in prefixes]
+    )
+
+    # Without sold dates there are no months to aggregate, and the dashboard shows no trend
+    if np.isnat(columns["listing_sold_date"]).all():
+        logging.warning(f"Snapshot version {version} has no sales with a sold date, no trend aggregates built")
+        return
+
+    # Written per layer to a temporary version directory, renamed when all are written
+    temp_version_dir = version_dir + ".tmp"
+    shutil.rmtree(temp_version_dir, ignore_errors=True)
+    for prefix in prefixes:
+        polygons = columns[f"{prefix}_name"]
+        aggregates, first_month = trend_aggregates(
+            polygons,
+            columns["rooms"].astype(np.float64),
+            columns["listing_sold_date"],
+            columns["listing_sold_price_per_sqm"],
+            columns["listing_days_active"]
+        )
+        write_aggregates(
+            os.path.join(temp_version_dir, prefix), aggregates, first_month, polygons.categories.tolist(), version
+        )
+        logging.info(f"Built trend aggregates of {prefix} for {len(polygons.categories)} polygons " +
+                     f"and {aggregates['count', WINDOWS[0]].shape[2]} months")
+
+    os.rename(temp_version_dir, version_dir)
+    logging.info(f"Wrote trend aggregates of snapshot version {version} in {time.time() - start:.2f} seconds")
+
+def main():
+    setup_logging(__file__) # Formats logging and store warnings/exceptions to file
+
+    # Make sure a snapshot is available
+    assert os.path.isfile(os.path.join(SNAPSHOT_DIR, "CURRENT")), "Can't find a dashboard snapshot, run stage 8 first"
+    with open(os.path.join(SNAPSHOT_DIR, "CURRENT"), encoding="utf8") as f:
+        version = f.read().strip()
+
+    with open(POLYGON_LAYERS_JSON, encoding="utf8") as f:
+        prefixes = [layer["prefix"] for layer in json.load(f)]
+
+    version_dir = os.path.join(TREND_AGGREGATES_DIR, version)
+    if os.path.isdir(version_dir):
+        logging.info(f"Trend aggregates of snapshot version {version} already built")
+    else:
+        build_version(version, version_dir, prefixes)
+
+    remove_old_versions(TREND_AGGREGATES_DIR, SNAPSHOT_DIR)
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,36 @@
+""" HELPER FUNCTIONS
+Shared by the stages of the pipeline. Importing this module has no side
+effects: the settings are read, and the requests session or selenium driver
+created, when first used. Heavy libraries are imported there too, so that
+e.g. the parsers can be imported without them.
+"""
+
 import logging
 import os
 import time
 import json
-import requests
-import pandas as pd
-from numpy.random import normal
-from selenium import webdriver
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+import random
 from working_dir import WORKING_DIR
 
-def get_settings():
-    """ Read settings from settings.json file, return it as a parsed json object. """
-    with open(os.path.join(WORKING_DIR, "data_scraping_pipeline", "settings.json")) as f:
-        return json.load(f)
-
-# Import settings to make it available to subsequent functions
-settings = get_settings()
+_settings = None
+_session = None
+_selenium_driver = None
 
-def setup_logging(filename):
-    """ Sets up logging, saving log files to the logs folder. """
+def get_settings():
+    """ Settings from the settings.json file, read once, as a parsed json object. """
+    global _settings
+    if _settings is None:
+        with open(os.path.join(WORKING_DIR, "data_scraping_pipeline", "settings.json")) as f:
+            _settings = json.load(f)
+    return _settings
+
+def setup_logging(filename, log_to_file=None):
+    """ 
+    Sets up logging, saving log files to the logs folder. log_to_file
+    overrides the setting of the same name in settings.json.
+    """
+    settings = get_settings()
+    log_to_file = settings["log_to_file"] if log_to_file is None else log_to_file
     # Logging both to console (with level = DEBUG) and to file (with level = WARNING)
     logging.basicConfig(level=logging.DEBUG)
     root_logger = logging.getLogger()
@@ -28,7 +40,7 @@ def setup_logging(filename):
     root_logger.handlers[0].setFormatter(log_formatter) 
 
     # File logging. If debug=True, do not log to file to avoid cluttering
-    if settings["log_to_file"] and not settings["debug"]:
+    if log_to_file and not settings["debug"]:
         logging_dir = os.path.join(WORKING_DIR, "logs")
         if not os.path.isdir(logging_dir):
             os.mkdir(logging_dir)
@@ -46,7 +58,8 @@ def throttle_decorator(f):
     Throttles a function according to the parameters set in settins.json
     """
     def wrapper(*args, latest_request_timestamp=[-1]):
-        pause_length = normal(settings["seconds_between_requests"], settings["seconds_between_requests"]/3)
+        settings = get_settings()
+        pause_length = random.gauss(settings["seconds_between_requests"], settings["seconds_between_requests"]/3)
         pause_length = max(1, pause_length)
         time_since_last_request = time.time() - latest_request_timestamp[0]
 
@@ -73,7 +86,7 @@ def respectful_requesting(url):
     pause length at each failure. This is to make the program back off from 
     sending frequent requests for example if the server experiences issues. 
     """
-
+    settings = get_settings()
     if settings["use_selenium"]:
         request_func = respectful_requesting_selenium
     else:
@@ -99,22 +112,34 @@ def respectful_requesting_requests(url):
     Circumventing being blacklisted is not encouraged, but possible by using
     selenium instead of the requests library. 
     """
-    resp = requests.get(url)
+    resp = get_session().get(url)
     return (resp.status_code, resp.content)
 
+def get_session():
+    """ The requests session, created on first use, which reuses connections between requests. """
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
+def get_selenium_driver():
+    """ The selenium Chrome driver, launched on first use. """
+    global _selenium_driver
+    if _selenium_driver is None:
+        from selenium import webdriver
+        from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+
+        # Specify selenium desired capabilities that will allow reading HTTP status code from logs
+        selenium_logging_capabilities = DesiredCapabilities.CHROME.copy()
+        selenium_logging_capabilities["goog:loggingPrefs"] = {"performance": "WARNING"}
+
+        _selenium_driver = webdriver.Chrome(
+            get_settings()["selenium_chrome_driver_path"], 
+            desired_capabilities=selenium_logging_capabilities
+        )
+    return _selenium_driver
 
-
-# Specify selenium desired capabilities that will allow reading HTTP status code from logs
-selenium_logging_capabilities = DesiredCapabilities.CHROME.copy()
-selenium_logging_capabilities["goog:loggingPrefs"] = {"performance": "WARNING"}
-
-# Initialize driver, if selenium should be used.
-selenium_driver = None
-if settings["use_selenium"]:
-    selenium_driver = webdriver.Chrome(
-        settings["selenium_chrome_driver_path"], 
-        desired_capabilities=selenium_logging_capabilities
-    )
 def get_status(logs):
     """ 
     Taken from https://stackoverflow.com/a/63876668, thank you Jarad.
@@ -141,6 +166,7 @@ def respectful_requesting_selenium(url):
     
     (Not that scraping while blacklisted is encouraged)
     """
+    selenium_driver = get_selenium_driver()
     selenium_driver.get(url)
     logs = selenium_driver.get_log('performance')
     status_code = get_status(logs)
@@ -148,6 +174,34 @@ def respectful_requesting_selenium(url):
     return (status_code, selenium_driver.page_source)
 
 
+def parse_number(formatted):
+    """ Number in a string formatted by Booli, like "3 450 000 kr", or None if there is none. """
+    number = "".join(c for c in formatted if c in "0123456789-,.").replace(",", ".")
+    return float(number) if number not in ["", "-", "."] else None
+
+def number_value(field):
+    """ 
+    Number of a Booli value field, e.g. {"raw": 3450000, "formatted": "3 450 000 kr"}:
+    its raw value where Booli provides it, and otherwise parsed from the formatted string.
+    """
+    if field.get("raw") is not None:
+        return field["raw"]
+    return parse_number(field["formatted"])
+
+def parse_numbers(col):
+    """ 
+    Vectorized version of parse_number, for a column of numbers and/or formatted 
+    strings (as written before stages 3 and 4 stored numbers). Returns integers, 
+    as the nullable Int64 so that missing values do not make them floats.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if not pd.api.types.is_numeric_dtype(col):
+        digits = col.astype(str).str.replace(r"[^0-9,.\-]", "", regex=True).str.replace(",", ".", regex=False)
+        col = pd.to_numeric(digits, errors="coerce")
+    return pd.Series(np.trunc(col.astype(np.float64)), index=col.index).astype("Int64")
+
 def missing_field_decorator(f):
     def wrapper(*args):
         try:
@@ -156,10 +210,21 @@ def missing_field_decorator(f):
             return None
     return wrapper
 
-def append_to_csv(filepath, df, avoid_duplicates=False, key_column=None):
+def append_to_csv(filepath, df, avoid_duplicates=False, key_column=None, integer_columns=None):
+    """ 
+    Appends df to the CSV at filepath. integer_columns are stored as integers,
+    also those of rows that were written as formatted strings before.
+    """
+    import pandas as pd
+
+    def normalize(df):
+        for c in integer_columns or []:
+            df[c] = parse_numbers(df[c])
+        return df
+
     # If no file exists, simply write to filepath
     if not os.path.isfile(filepath):
-        df.to_csv(filepath, sep=";", encoding="utf8")
+        normalize(df.copy()).to_csv(filepath, sep=";", encoding="utf8")
         return
     
     old_df = pd.read_csv(filepath, delimiter=";", encoding="utf8", index_col=0)
@@ -171,5 +236,5 @@ def append_to_csv(filepath, df, avoid_duplicates=False, key_column=None):
     else:
         combined_df = pd.concat([old_df, df], ignore_index=True)
 
-    combined_df.to_csv(filepath, sep=";", encoding="utf8")
+    normalize(combined_df).to_csv(filepath, sep=";", encoding="utf8")
     return
\ No newline at end of file
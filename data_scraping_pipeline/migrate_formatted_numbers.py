@@ -0,0 +1,78 @@
+""" MIGRATE FORMATTED NUMBERS
+One-off migration of the CSV files written before stages 3 and 4 stored
+numbers as integers. Prices and the numbers of the BRF annual reports were
+stored as formatted strings, like "3 450 000 kr", which every consumer had to
+parse. This rewrites them as integers, with vectorized string operations, so
+that all later stages and the dashboard read them as numbers.
+
+All other columns are read and written back as the same strings. Files that
+are already migrated are left untouched, so running this again is harmless.
+"""
+
+import os
+import time
+import logging
+import pandas as pd
+from helper_functions import setup_logging, parse_numbers
+from working_dir import WORKING_DIR
+
+# ----------------------- CONFIG -----------------------
+LISTINGS_DIR = os.path.join(WORKING_DIR, "data", "listings_data")
+BRF_DIR = os.path.join(WORKING_DIR, "data", "brf_data")
+
+PRICE_COLUMNS = [
+    "estimate_price",
+    "estimate_low",
+    "estimate_high",
+    "listing_sold_price",
+    "listing_listed_price"
+]
+BRF_INTEGER_COLUMNS = [
+    "brf_annual_report_rental_units",
+    "brf_annual_report_units",
+    "brf_annual_report_savings",
+    "brf_annual_report_total_loan"
+]
+
+# Files to migrate, and their columns of formatted numbers
+MIGRATIONS = {
+    os.path.join(LISTINGS_DIR, "listings.csv"): PRICE_COLUMNS,
+    os.path.join(LISTINGS_DIR, "listings_data.csv"): PRICE_COLUMNS,
+    os.path.join(BRF_DIR, "brf_data.csv"): BRF_INTEGER_COLUMNS,
+}
+# ------------------------------------------------------
+
+def is_migrated(col):
+    """ Whether the (string) column only holds integers, or nothing. """
+    return col.dropna().str.fullmatch(r"-?[0-9]+").all()
+
+def migrate(path, columns):
+    """ Rewrites the columns of the CSV at path as integers, via a temporary file. """
+    df = pd.read_csv(path, sep=";", encoding="utf8", dtype=str, index_col=0)
+    columns = [c for c in columns if c in df.columns]
+    if all(is_migrated(df[c]) for c in columns):
+        logging.info(f"{path} is already migrated")
+        return
+
+    for c in columns:
+        n_values = df[c].notna().sum()
+        df[c] = parse_numbers(df[c])
+        if df[c].notna().sum() < n_values:
+            logging.warning(f"{n_values - df[c].notna().sum()} values of {c} in {path} are not numbers, left empty")
+
+    temp_path = path + ".tmp"
+    df.to_csv(temp_path, sep=";", encoding="utf8")
+    os.replace(temp_path, path)
+    logging.info(f"Migrated {', '.join(columns)} of {len(df)} rows in {path}")
+
+def main():
+    setup_logging(__file__) # Formats logging and store warnings/exceptions to file
+
+    start = time.time()
+    for path, columns in MIGRATIONS.items():
+        if os.path.isfile(path):
+            migrate(path, columns)
+    logging.info(f"Migration done in {time.time() - start:.2f} seconds")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+""" POLYGON LOOKUP RASTER
+Rasterizes the polygons of a GeoJSON layer into an integer grid, where each
+cell holds the index of the polygon covering it, OUTSIDE if no polygon covers
+it, or BOUNDARY if a polygon edge passes through it. A lookup is then a single
+array index per point. Only points in boundary cells are tested exactly, with
+a numpy ray casting test against the few polygons touching their cell, so no
+geometry library is needed, neither to build nor to query the raster.
+
+The grid is stored as a .npy file and memory-mapped when loaded.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+OUTSIDE = -1
+BOUNDARY = -2
+
+GRID_FILE = "grid.npy"
+ARRAYS_FILE = "arrays.npz"
+META_FILE = "meta.json"
+
+# Max number of point/edge pairs evaluated at once in the ray casting test
+RAY_CASTING_CHUNK_SIZE = 2**22
+
+
+def get_rings(geometry):
+    """ Returns all rings (exterior and holes) of a Polygon or MultiPolygon as arrays. """
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        raise Exception(f"Unsupported geometry type {geometry['type']}")
+
+    return [np.asarray(ring, dtype=np.float64)[:, :2] for polygon in polygons for ring in polygon]
+
+
+def get_edges(geometry):
+    """ Returns an (n_edges, 4) array with the (x1, y1, x2, y2) of every edge. """
+    edges = []
+    for ring in get_rings(geometry):
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        edges.append(np.hstack([ring[:-1], ring[1:]]))
+
+    return np.vstack(edges)
+
+
+def points_in_polygon(x, y, edges):
+    """
+    Even-odd ray casting test of the points (x, y) against a polygon given by
+    its edges. Holes are handled by including their edges.
+    """
+    x1, y1, x2, y2 = edges.T
+    inside = np.zeros(len(x), dtype=bool)
+
+    step = max(1, RAY_CASTING_CHUNK_SIZE // max(1, len(edges)))
+    for start in range(0, len(x), step):
+        px = x[start:start + step, None]
+        py = y[start:start + step, None]
+
+        # An edge is crossed by a ray cast in positive x direction if it spans
+        # the y coordinate of the point, and it does so to the right of the point.
+        spans = (y1 > py) != (y2 > py)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_at_py = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = (spans & (px < x_at_py)).sum(axis=1)
+        inside[start:start + step] = crossings % 2 == 1
+
+    return inside
+
+
+def get_source_hash(filepath, resolution, id_property, name_property):
+    """ Hash identifying the input of a raster build, used to detect stale rasters. """
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        sha1.update(f.read())
+    sha1.update(f"{resolution};{id_property};{name_property}".encode("utf8"))
+
+    return sha1.hexdigest()
+
+
+class PolygonRaster(object):
+    def __init__(self, grid, origin, resolution, edges, edge_offsets,
+                 boundary_cells, candidate_offsets, candidates, ids, names, source_hash=None):
+        self.grid = grid # (n_rows, n_cols) int16, rows by latitude and columns by longitude
+        self.origin = origin # (min longitude, min latitude) of the grid
+        self.resolution = resolution # Cell size in degrees
+
+        # Edges of all polygons, edges of polygon i at edge_offsets[i]:edge_offsets[i+1]
+        self.edges = edges
+        self.edge_offsets = edge_offsets
+
+        # Sorted flat indices of the boundary cells, and for each of them the
+        # candidate polygons at candidate_offsets[j]:candidate_offsets[j+1]
+        self.boundary_cells = boundary_cells
+        self.candidate_offsets = candidate_offsets
+        self.candidates = candidates
+
+        self.ids = np.array(ids, dtype=object)
+        self.names = np.array(names, dtype=object)
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, features, resolution=0.00025, id_property="NYCKELKOD_", name_property="NAMN",
+              source_hash=None):
+        n_polygons = len(features)
+        polygon_edges = [get_edges(f["geometry"]) for f in features]
+        edge_offsets = np.zeros(n_polygons + 1, dtype=np.int64)
+        edge_offsets[1:] = np.cumsum([len(e) for e in polygon_edges])
+        edges = np.vstack(polygon_edges)
+
+        # Grid covering all polygons, with a margin of one cell
+        min_x = min(edges[:, 0].min(), edges[:, 2].min()) - resolution
+        min_y = min(edges[:, 1].min(), edges[:, 3].min()) - resolution
+        max_x = max(edges[:, 0].max(), edges[:, 2].max()) + resolution
+        max_y = max(edges[:, 1].max(), edges[:, 3].max()) + resolution
+        n_rows = int(np.ceil((max_y - min_y) / resolution))
+        n_cols = int(np.ceil((max_x - min_x) / resolution))
+        assert n_polygons < np.iinfo(np.int16).max, "Too many polygons for an int16 grid."
+
+        # Label each cell with the first polygon containing the cell center
+        grid = np.full((n_rows, n_cols), OUTSIDE, dtype=np.int16)
+        for i in range(n_polygons):
+            e = polygon_edges[i]
+            col_start = int((min(e[:, 0].min(), e[:, 2].min()) - min_x) / resolution)
+            col_stop = int((max(e[:, 0].max(), e[:, 2].max()) - min_x) / resolution) + 1
+            row_start = int((min(e[:, 1].min(), e[:, 3].min()) - min_y) / resolution)
+            row_stop = int((max(e[:, 1].max(), e[:, 3].max()) - min_y) / resolution) + 1
+
+            rows, cols = np.mgrid[row_start:row_stop, col_start:col_stop]
+            rows, cols = rows.ravel(), cols.ravel()
+            unlabeled = grid[rows, cols] == OUTSIDE
+            rows, cols = rows[unlabeled], cols[unlabeled]
+
+            center_x = min_x + (cols + 0.5) * resolution
+            center_y = min_y + (rows + 0.5) * resolution
+            inside = points_in_polygon(center_x, center_y, e)
+            grid[rows[inside], cols[inside]] = i
+
+        # Find the cells touched by each polygon's edges. Sampling every edge at
+        # half the cell size and adding the neighbouring cells of every sample
+        # is guaranteed to cover every cell an edge passes through.
+        lengths = np.abs(edges[:, 2:] - edges[:, :2]).max(axis=1)
+        n_samples = np.ceil(lengths / (resolution / 2)).astype(np.int64) + 1
+        edge_index = np.repeat(np.arange(len(edges)), n_samples)
+        t = (np.arange(n_samples.sum()) - np.repeat(np.cumsum(n_samples) - n_samples, n_samples)) / \
+            np.repeat(np.maximum(n_samples - 1, 1), n_samples)
+        sample_x = edges[edge_index, 0] + t * (edges[edge_index, 2] - edges[edge_index, 0])
+        sample_y = edges[edge_index, 1] + t * (edges[edge_index, 3] - edges[edge_index, 1])
+        sample_polygon = np.searchsorted(edge_offsets, edge_index, side="right") - 1
+
+        sample_rows = ((sample_y - min_y) / resolution).astype(np.int64)
+        sample_cols = ((sample_x - min_x) / resolution).astype(np.int64)
+        pairs = []
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                cells = (sample_rows + d_row) * n_cols + (sample_cols + d_col)
+                pairs.append(cells * n_polygons + sample_polygon)
+        pairs = np.unique(np.concatenate(pairs))
+        pair_cells, pair_polygons = pairs // n_polygons, pairs % n_polygons
+
+        # The polygon holding the cell center may cover the whole cell without
+        # any of its edges touching it, so it is a candidate as well.
+        boundary_cells = np.unique(pair_cells)
+        center_polygons = grid.ravel()[boundary_cells]
+        has_center_polygon = center_polygons >= 0
+        pairs = np.union1d(
+            pairs,
+            boundary_cells[has_center_polygon] * n_polygons + center_polygons[has_center_polygon]
+        )
+        pair_cells, pair_polygons = pairs // n_polygons, pairs % n_polygons
+
+        candidate_offsets = np.zeros(len(boundary_cells) + 1, dtype=np.int64)
+        candidate_offsets[1:] = np.cumsum(np.bincount(np.searchsorted(boundary_cells, pair_cells),
+                                                      minlength=len(boundary_cells)))
+        grid.ravel()[boundary_cells] = BOUNDARY
+
+        return cls(
+            grid=grid,
+            origin=(min_x, min_y),
+            resolution=resolution,
+            edges=edges,
+            edge_offsets=edge_offsets,
+            boundary_cells=boundary_cells,
+            candidate_offsets=candidate_offsets,
+            candidates=pair_polygons.astype(np.int16),
+            ids=[f["properties"][id_property] for f in features],
+            names=[f["properties"][name_property] for f in features],
+            source_hash=source_hash
+        )
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, GRID_FILE), self.grid)
+        np.savez(
+            os.path.join(directory, ARRAYS_FILE),
+            edges=self.edges,
+            edge_offsets=self.edge_offsets,
+            boundary_cells=self.boundary_cells,
+            candidate_offsets=self.candidate_offsets,
+            candidates=self.candidates
+        )
+        with open(os.path.join(directory, META_FILE), "w", encoding="utf8") as f:
+            json.dump({
+                "origin": list(self.origin),
+                "resolution": self.resolution,
+                "ids": self.ids.tolist(),
+                "names": self.names.tolist(),
+                "source_hash": self.source_hash
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, META_FILE), encoding="utf8") as f:
+            meta = json.load(f)
+        arrays = np.load(os.path.join(directory, ARRAYS_FILE))
+
+        return cls(
+            grid=np.load(os.path.join(directory, GRID_FILE), mmap_mode="r"),
+            origin=tuple(meta["origin"]),
+            resolution=meta["resolution"],
+            ids=meta["ids"],
+            names=meta["names"],
+            source_hash=meta["source_hash"],
+            **{name: arrays[name] for name in arrays.files}
+        )
+
+    def lookup(self, latitudes, longitudes):
+        """
+        Returns the index of the polygon containing each point, or -1 if the
+        point is not within any polygon (or lacks coordinates). If polygons
+        overlap, the first one in the file wins.
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        codes = np.full(len(latitudes), OUTSIDE, dtype=np.int32)
+
+        n_rows, n_cols = self.grid.shape
+        rows = np.floor((latitudes - self.origin[1]) / self.resolution)
+        cols = np.floor((longitudes - self.origin[0]) / self.resolution)
+        on_grid = np.flatnonzero((rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols))
+        cells = rows[on_grid].astype(np.int64) * n_cols + cols[on_grid].astype(np.int64)
+
+        values = self.grid.ravel()[cells]
+        codes[on_grid] = values
+
+        on_boundary = values == BOUNDARY
+        self._resolve_boundary_points(
+            codes, on_grid[on_boundary], cells[on_boundary], latitudes, longitudes
+        )
+
+        return codes
+
+    def _resolve_boundary_points(self, codes, points, cells, latitudes, longitudes):
+        """ Exact test of the points in boundary cells against their candidate polygons. """
+        codes[points] = OUTSIDE
+        if len(points) == 0:
+            return
+
+        # Expand to one (point, candidate polygon) pair per candidate of the point's cell
+        position = np.searchsorted(self.boundary_cells, cells)
+        starts = self.candidate_offsets[position]
+        counts = self.candidate_offsets[position + 1] - starts
+        pair_points = np.repeat(points, counts)
+        pair_candidates = self.candidates[
+            np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        ]
+
+        # Test the pairs one candidate polygon at a time. Going from the last
+        # polygon to the first lets the first polygon in the file win.
+        order = np.argsort(pair_candidates, kind="stable")
+        pair_points, pair_candidates = pair_points[order], pair_candidates[order]
+        polygons, polygon_starts = np.unique(pair_candidates, return_index=True)
+        polygon_stops = np.append(polygon_starts[1:], len(pair_candidates))
+
+        for polygon, start, stop in reversed(list(zip(polygons, polygon_starts, polygon_stops))):
+            p = pair_points[start:stop]
+            edges = self.edges[self.edge_offsets[polygon]:self.edge_offsets[polygon + 1]]
+            inside = points_in_polygon(longitudes[p], latitudes[p], edges)
+            codes[p[inside]] = polygon
+
+    def to_columns(self, codes):
+        """ Maps polygon indices from lookup() to (ids, names), None where unassigned. """
+        assigned = codes >= 0
+        polygon_ids = np.where(assigned, self.ids[codes], None)
+        polygon_names = np.where(assigned, self.names[codes], None)
+
+        return polygon_ids, polygon_names
+
+
+def load_or_build_polygon_raster(geojson_path, raster_dir, resolution=0.00025,
+                                 id_property="NYCKELKOD_", name_property="NAMN"):
+    """
+    Loads the raster stored in raster_dir, rebuilding it first if it is
+    missing or was built from another version of the GeoJSON file or settings.
+    """
+    source_hash = get_source_hash(geojson_path, resolution, id_property, name_property)
+
+    if os.path.isfile(os.path.join(raster_dir, META_FILE)):
+        raster = PolygonRaster.load(raster_dir)
+        if raster.source_hash == source_hash:
+            return raster
+
+    with open(geojson_path, encoding="utf-8") as f:
+        polygon_data = json.load(f)
+
+    raster = PolygonRaster.build(
+        polygon_data["features"],
+        resolution=resolution,
+        id_property=id_property,
+        name_property=name_property,
+        source_hash=source_hash
+    )
+    raster.save(raster_dir)
+
+    return PolygonRaster.load(raster_dir)
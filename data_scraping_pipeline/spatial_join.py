@@ -0,0 +1,74 @@
+""" SPATIAL JOIN OF COORDINATES TO AREA POLYGONS
+Assigns coordinates to the polygons of a GeoJSON layer in bulk. Every polygon
+is built and prepared once. The points are indexed by sorting them on
+longitude, so each polygon only runs the vectorized containment test on the
+points inside its bounding box instead of on every point.
+"""
+
+import json
+import numpy as np
+from shapely.geometry import shape
+from shapely.prepared import prep
+from shapely.vectorized import contains
+
+
+class PolygonLayer(object):
+    def __init__(self, features, id_property="NYCKELKOD_", name_property="NAMN"):
+        self.polygons = [shape(f["geometry"]) for f in features]
+        self.prepared_polygons = [prep(p) for p in self.polygons]
+
+        # (minx, miny, maxx, maxy) per polygon, i.e. (min long, min lat, max long, max lat)
+        self.bounds = np.array([p.bounds for p in self.polygons], dtype=np.float64)
+
+        self.ids = np.array([f["properties"][id_property] for f in features], dtype=object)
+        self.names = np.array([f["properties"][name_property] for f in features], dtype=object)
+
+    @classmethod
+    def from_geojson(cls, filepath, id_property="NYCKELKOD_", name_property="NAMN"):
+        with open(filepath, encoding="utf-8") as f:
+            polygon_data = json.load(f)
+
+        return cls(polygon_data["features"], id_property=id_property, name_property=name_property)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def assign(self, latitudes, longitudes):
+        """
+        Returns the index of the polygon containing each point, or -1 if the
+        point is not within any polygon (or lacks coordinates). If polygons
+        overlap, the first one in the file wins.
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        codes = np.full(len(latitudes), -1, dtype=np.int32)
+
+        # Sort the points on longitude once, so that the points within the
+        # longitude span of a polygon's bounding box is a contiguous slice.
+        valid = np.flatnonzero(~(np.isnan(latitudes) | np.isnan(longitudes)))
+        order = valid[np.argsort(longitudes[valid], kind="stable")]
+        sorted_longitudes = longitudes[order]
+
+        for i, (min_long, min_lat, max_long, max_lat) in enumerate(self.bounds):
+            start = np.searchsorted(sorted_longitudes, min_long, side="left")
+            stop = np.searchsorted(sorted_longitudes, max_long, side="right")
+            candidates = order[start:stop]
+
+            lat = latitudes[candidates]
+            in_box = (lat >= min_lat) & (lat <= max_lat) & (codes[candidates] == -1)
+            candidates = candidates[in_box]
+            if len(candidates) == 0:
+                continue
+
+            inside = contains(self.prepared_polygons[i], longitudes[candidates], latitudes[candidates])
+            codes[candidates[inside]] = i
+
+        return codes
+
+    def to_columns(self, codes):
+        """ Maps polygon indices from assign() to (ids, names), None where unassigned. """
+        assigned = codes >= 0
+        polygon_ids = np.where(assigned, self.ids[codes], None)
+        polygon_names = np.where(assigned, self.names[codes], None)
+
+        return polygon_ids, polygon_names